@@ -0,0 +1,175 @@
+# answer_cache.py
+import re
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Optional, Set
+
+import numpy as np
+
+_WS = re.compile(r"\s+")
+_TRAILING_PUNCT = re.compile(r"[\s?？!！。.、,]+$")
+
+
+def normalize_question(q: str) -> str:
+    """全角/半角・大文字小文字・空白・末尾の句読点の揺れを吸収したキャッシュキー"""
+    s = unicodedata.normalize("NFKC", q or "").lower()
+    s = _WS.sub(" ", s).strip()
+    return _TRAILING_PUNCT.sub("", s)
+
+
+@dataclass
+class _Entry:
+    value: Dict[str, Any]
+    emb: Optional[np.ndarray]      # 正規化済み float32
+    sources: FrozenSet[str]
+    size: int
+    expires_at: float
+    tokens: int
+
+
+class AnswerCache:
+    """
+    /query の回答キャッシュ。
+
+    1 段目: 正規化した質問文の完全一致
+    2 段目: 質問埋め込みのコサイン距離が semantic_max_dist 以内、かつ
+            検索で得た参照チャンク ID の集合が一致するものを再利用
+
+    LRU + TTL + おおよそのメモリ上限で追い出す。version_fn が返す値が変わったら
+    （embed_articles.py がコレクションを更新したら）全消去する。
+    イベントループ上から呼ぶ前提でロックは持たない。
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024,
+                 ttl_secs: float = 3600.0, semantic_max_dist: float = 0.08,
+                 version_fn: Optional[Callable[[], str]] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.semantic_max_dist = semantic_max_dist
+        self._version_fn = version_fn
+        self._version = version_fn() if version_fn else ""
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_sources: Dict[FrozenSet[str], Set[str]] = {}
+        self._bytes = 0
+        self.counters = {
+            "hits_exact": 0,
+            "hits_semantic": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "invalidations": 0,
+            "tokens_saved": 0,
+        }
+
+    # ── 内部 ──────────────────────────────────────────────────────────
+    def _check_version(self) -> None:
+        if not self._version_fn:
+            return
+        v = self._version_fn()
+        if v != self._version:
+            self._version = v
+            if self._entries:
+                self.clear()
+                self.counters["invalidations"] += 1
+
+    def _remove(self, key: str) -> None:
+        e = self._entries.pop(key, None)
+        if e is None:
+            return
+        self._bytes -= e.size
+        keys = self._by_sources.get(e.sources)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_sources[e.sources]
+
+    def _alive(self, key: str, e: _Entry, now: float) -> bool:
+        if e.expires_at < now:
+            self._remove(key)
+            self.counters["expired"] += 1
+            return False
+        return True
+
+    def _hit(self, key: str, e: _Entry, kind: str) -> Dict[str, Any]:
+        self._entries.move_to_end(key)
+        self.counters[kind] += 1
+        self.counters["tokens_saved"] += e.tokens
+        return dict(e.value)
+
+    @staticmethod
+    def _normalize_emb(emb: Optional[Iterable[float]]) -> Optional[np.ndarray]:
+        if emb is None:
+            return None
+        v = np.asarray(emb, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n > 0 else None
+
+    # ── 公開 API ─────────────────────────────────────────────────────
+    def get_exact(self, question: str) -> Optional[Dict[str, Any]]:
+        self._check_version()
+        key = normalize_question(question)
+        e = self._entries.get(key)
+        if e is None or not self._alive(key, e, time.time()):
+            return None
+        return self._hit(key, e, "hits_exact")
+
+    def get_semantic(self, emb: Iterable[float], source_ids: Iterable[str]) -> Optional[Dict[str, Any]]:
+        """完全一致に外れた後、検索結果が出た段階で呼ぶ。外れたら misses を数える"""
+        self._check_version()
+        q = self._normalize_emb(emb)
+        keys = self._by_sources.get(frozenset(source_ids))
+        if self.semantic_max_dist > 0 and q is not None and keys:
+            now = time.time()
+            best_key, best_dist = None, self.semantic_max_dist
+            for key in list(keys):
+                e = self._entries[key]
+                if e.emb is None or not self._alive(key, e, now):
+                    continue
+                dist = 1.0 - float(np.dot(q, e.emb))
+                if dist <= best_dist:
+                    best_key, best_dist = key, dist
+            if best_key is not None:
+                return self._hit(best_key, self._entries[best_key], "hits_semantic")
+        self.counters["misses"] += 1
+        return None
+
+    def put(self, question: str, value: Dict[str, Any], emb: Optional[Iterable[float]] = None,
+            source_ids: Iterable[str] = (), tokens: int = 0) -> None:
+        self._check_version()
+        key = normalize_question(question)
+        self._remove(key)
+        v = self._normalize_emb(emb)
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8")) + len(key) * 4
+        size += v.nbytes if v is not None else 0
+        if size > self.max_bytes:
+            return
+        sources = frozenset(source_ids)
+        self._entries[key] = _Entry(value=dict(value), emb=v, sources=sources, size=size,
+                                    expires_at=time.time() + self.ttl_secs, tokens=tokens)
+        self._by_sources.setdefault(sources, set()).add(key)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.counters["evictions"] += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_sources.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        c = self.counters
+        hits = c["hits_exact"] + c["hits_semantic"]
+        total = hits + c["misses"]
+        return {
+            **c,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "llm_calls_saved": hits,
+        }
@@ -0,0 +1,204 @@
+# api_client.py
+"""
+UI（app.py / streamlit_app.py）と search_articles.py から main.py の API を呼ぶクライアント。
+
+- requests.Session を 1 つ使い回し、HTTPAdapter のコネクションプールで keep-alive する
+  （操作のたびに TCP 接続を張り直さない）。接続エラーだけ少し再試行する
+- 同じ path・本文への POST の応答を cache_ttl 秒だけ覚える（LRU）。Streamlit は操作のたびに
+  スクリプト全体を再実行するので、入力が変わっていない再実行で API を呼び直さない
+- モデルも Chroma も読まないので、UI のプロセスは軽いまま起動できる
+
+Streamlit では st.cache_resource で 1 つ作ってセッション間で共有する（キャッシュはロックで守る）。
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_URL            = os.environ.get("NOTE_RAG_API_URL", "http://localhost:8000/query")  # FastAPI /query
+API_TIMEOUT_SECS   = float(os.environ.get("API_TIMEOUT_SECS", "60"))
+API_POOL_SIZE      = int(os.environ.get("API_POOL_SIZE", "10"))          # 同じホストに張っておく接続数
+API_CACHE_TTL_SECS = float(os.environ.get("API_CACHE_TTL_SECS", "60"))   # 0 でキャッシュしない
+API_CACHE_MAX_ENTRIES = int(os.environ.get("API_CACHE_MAX_ENTRIES", "256"))
+
+
+class ApiError(Exception):
+    """API が 200 以外を返した（status=None は接続できなかった）"""
+
+    def __init__(self, status: Optional[int], detail: Any):
+        super().__init__(f"{status}: {detail}" if status is not None else str(detail))
+        self.status = status
+        self.detail = detail
+
+
+def api_base(url: str) -> str:
+    """NOTE_RAG_API_URL（…/query）から API の根元の URL にする"""
+    url = url.rstrip("/")
+    for suffix in ("/query/stream", "/query"):
+        if url.endswith(suffix):
+            return url[:-len(suffix)]
+    return url
+
+
+class TtlCache:
+    """件数上限つきの LRU。各エントリは入れてから ttl 秒で切れる"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class ApiClient:
+    def __init__(self, base_url: str, timeout: float = 60.0, pool_size: int = 10,
+                 cache_ttl: float = 60.0, cache_max_entries: int = 256):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache = TtlCache(cache_ttl, cache_max_entries)
+        self.session = requests.Session()
+        # POST は読み取り中の失敗では再試行しない（同じ質問で LLM を 2 回呼ばない）。接続できなかったときだけ
+        retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_env(cls) -> "ApiClient":
+        return cls(api_base(API_URL), API_TIMEOUT_SECS, API_POOL_SIZE, API_CACHE_TTL_SECS, API_CACHE_MAX_ENTRIES)
+
+    def url(self, path: str) -> str:
+        """path は base_url からの相対（/search など）。http(s):// で始まればそのまま"""
+        return path if path.startswith(("http://", "https://")) else self.base_url + path
+
+    def post(self, path: str, body: Dict[str, Any], cache: bool = True) -> Dict[str, Any]:
+        """JSON を POST して JSON を返す。200 以外・接続失敗は ApiError。cache なら成功した応答を覚える"""
+        key = path + "\n" + json.dumps(body, ensure_ascii=False, sort_keys=True)
+        use_cache = cache and self.cache.enabled
+        if use_cache:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return hit
+        try:
+            r = self.session.post(self.url(path), json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ApiError(None, e)
+        if r.status_code != 200:
+            raise ApiError(r.status_code, _detail(r))
+        try:
+            data = r.json()
+        except ValueError:
+            raise ApiError(r.status_code, f"不正なJSON: {r.text[:200]}")
+        if use_cache:
+            self.cache.put(key, data)
+        return data
+
+    def search(self, query: str, page: int = 1, page_size: int = 10, filters: Optional[Dict[str, Any]] = None,
+               highlight: bool = True, snippet_chars: Optional[int] = None,
+               recency_half_life_days: Optional[float] = None) -> Dict[str, Any]:
+        """POST /search（検索のみ。LLM は呼ばない）"""
+        body: Dict[str, Any] = {"query": query, "page": page, "page_size": page_size, "highlight": highlight}
+        if filters:
+            body["filters"] = filters
+        if snippet_chars is not None:
+            body["snippet_chars"] = snippet_chars
+        if recency_half_life_days is not None:
+            body["recency_half_life_days"] = recency_half_life_days
+        return self.post("/search", body)
+
+    def query(self, question: str, cache: bool = True, **extra: Any) -> Dict[str, Any]:
+        """POST /query。session_id 付きの会話は前のやりとりに依存するので cache=False で呼ぶ"""
+        return self.post("/query", {"question": question, **extra}, cache=cache)
+
+    def stream(self, path: str, body: Dict[str, Any]) -> Iterator[Tuple[str, Any]]:
+        """SSE の (event, data) を到着順に返す。200 以外・接続失敗は ApiError（最初の next で）"""
+        try:
+            r = self.session.post(self.url(path), json=body, stream=True, timeout=(5, self.timeout),
+                                  headers={"Accept": "text/event-stream"})
+        except requests.RequestException as e:
+            raise ApiError(None, e)
+        with r:
+            if r.status_code != 200:
+                raise ApiError(r.status_code, _detail(r))
+            r.encoding = "utf-8"
+            event, data_lines = "message", []
+            for line in r.iter_lines(decode_unicode=True):
+                if line is None:
+                    continue
+                if line == "":
+                    if data_lines:
+                        try:
+                            yield event, json.loads("\n".join(data_lines))
+                        except json.JSONDecodeError:
+                            pass
+                    event, data_lines = "message", []
+                elif line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data_lines.append(line[len("data:"):].lstrip())
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def _detail(r: requests.Response) -> Any:
+    try:
+        body = r.json()
+    except ValueError:
+        return r.text
+    return body.get("detail", body) if isinstance(body, dict) else body
+
+
+def highlight_markdown(text: str, spans: Any, mark: str = "**") -> str:
+    """/search の highlights の位置を mark で囲む（Markdown の太字。元の * などはエスケープする）"""
+    def esc(s: str) -> str:
+        return "".join("\\" + c if c in "\\`*_[]<>#|~" else c for c in s)
+
+    out, pos = [], 0
+    for s, e in sorted(spans or []):
+        if s < pos:
+            continue
+        out.append(esc(text[pos:s]))
+        out.append(mark + esc(text[s:e]) + mark)
+        pos = e
+    out.append(esc(text[pos:]))
+    return "".join(out).replace("\n", " ")
@@ -1,77 +1,101 @@
 # app.py
 
 import os
-import json
-import requests
 import streamlit as st
-import chromadb
-from sentence_transformers import SentenceTransformer
 
-# ── 環境変数 ────────────────────────────────────────────────────────────────
-PERSIST_DIR = os.environ.get("CHROMA_PERSIST_DIR", "./chroma_db")
-COLLECTION  = os.environ.get("CHROMA_COLLECTION", "note_articles")
-EMBED_MODEL = os.environ.get("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
-API_URL     = os.environ.get("NOTE_RAG_API_URL", "http://localhost:8000/query")  # FastAPI /query
+from api_client import ApiClient, ApiError, highlight_markdown
+# 検索も API（/search）に任せるので、この UI ではモデルも Chroma も読まない
 
-# ── キャッシュ化（起動高速化） ────────────────────────────────────────────
-@st.cache_resource
-def get_collection():
-    client = chromadb.PersistentClient(path=PERSIST_DIR)
-    return client.get_collection(COLLECTION)
+# ── 環境変数 ────────────────────────────────────────────────────────────────
+# API の URL・接続プール・キャッシュは api_client.py（NOTE_RAG_API_URL, API_*）
+PAGE_SIZE = int(os.environ.get("UI_SEARCH_PAGE_SIZE", "5"))
 
+# ── API クライアント（keep-alive・応答の TTL キャッシュ。セッション間で共有） ─────
 @st.cache_resource
-def get_embedder():
-    return SentenceTransformer(EMBED_MODEL)
+def get_api() -> ApiClient:
+    return ApiClient.from_env()
 
-col = get_collection()
-embedder = get_embedder()
+def show_error(e: ApiError):
+    if e.status is None:
+        st.error(f"APIに接続できませんでした: {e.detail}")
+    else:
+        st.error(f"APIエラー: {e.status} - {e.detail}")
 
 # ── UI ─────────────────────────────────────────────────────────────────────
 st.title("Note記事検索Bot")
 
-tab_llm, tab_vector = st.tabs(["💬 LLM回答（/query 使用）", "🔎 ベクトル検索（ローカル）"])
+tab_llm, tab_vector = st.tabs(["💬 LLM回答（/query 使用）", "🔎 記事検索（/search 使用）"])
 
 with tab_llm:
-    st.caption("FastAPI の /query を呼び出して、構造化JSON（summary, points）で回答します。")
+    st.caption("FastAPI の /query を呼び出して、構造化JSON（answer, suggestions）で回答します。")
     q = st.text_input("知りたいことを入力してください（LLM）", key="llm_q")
     display_mode = st.radio("表示モード", ["Markdown", "プレーンテキスト"], horizontal=True)
 
     if q:
         try:
-            resp = requests.post(API_URL, json={"question": q}, timeout=60)
-            if resp.status_code != 200:
-                st.error(f"APIエラー: {resp.status_code} - {resp.text}")
-            else:
-                data = resp.json()
-                summary = data.get("summary", "")
-                points  = data.get("points", [])
+            # 表示モードの切り替えなどで再実行されても、同じ質問なら TTL の間は API を呼び直さない
+            with st.spinner("回答を生成中..."):
+                data = get_api().query(q)
+        except ApiError as e:
+            show_error(e)
+        else:
+            # 旧形式（summary, points）の API にも対応
+            answer = data.get("answer") or data.get("summary", "")
+            points = data.get("suggestions") if "answer" in data else data.get("points", [])
+            points_label = "深掘りの候補" if "answer" in data else "重要ポイント"
 
-                if display_mode == "Markdown":
-                    st.markdown("### 要約")
-                    st.markdown(summary)
-                    if points:
-                        st.markdown("### 重要ポイント")
-                        st.markdown("\n".join([f"- {p}" for p in points]))
-                else:
-                    st.write("要約")
-                    st.write(summary)
-                    if points:
-                        st.write("重要ポイント")
-                        for p in points:
-                            st.write(f"・{p}")
-        except Exception as e:
-            st.exception(e)
+            if display_mode == "Markdown":
+                st.markdown("### 回答")
+                st.markdown(answer)
+                if points:
+                    st.markdown(f"### {points_label}")
+                    st.markdown("\n".join([f"- {p}" for p in points]))
+            else:
+                st.write("回答")
+                st.write(answer)
+                if points:
+                    st.write(points_label)
+                    for p in points:
+                        st.write(f"・{p}")
 
 with tab_vector:
-    st.caption("ChromaDBへ直接ベクトル検索します（LLMには投げません）。")
-    q2 = st.text_input("検索したい内容を入力してください（ベクトル検索）", key="vec_q")
-    topk = st.slider("件数", 1, 10, 3)
+    st.caption("API の /search で記事を検索します（LLMには投げません）。")
+    q2 = st.text_input("検索したい内容を入力してください", key="vec_q")
+    col_size, col_hl = st.columns([3, 1])
+    page_size = col_size.slider("1ページの件数", 1, 20, PAGE_SIZE)
+    highlight = col_hl.checkbox("一致箇所を強調", value=True)
+
+    # 検索語・件数が変わったら 1 ページ目に戻す
+    search_key = (q2, page_size)
+    if st.session_state.get("search_key") != search_key:
+        st.session_state.search_key = search_key
+        st.session_state.search_page = 1
+
     if q2:
-        q_emb = embedder.encode([q2])[0].tolist()
-        res = col.query(query_embeddings=[q_emb], n_results=topk)
-        docs   = (res.get("documents") or [[]])[0]
-        metas  = (res.get("metadatas") or [[]])[0]
+        page = st.session_state.search_page
+        try:
+            data = get_api().search(q2, page=page, page_size=page_size, highlight=highlight)
+        except ApiError as e:
+            show_error(e)
+        else:
+            results = data.get("results") or []
+            if not results:
+                st.info("該当する記事が見つかりませんでした。")
+            for r in results:
+                title = r.get("title") or r.get("filename") or "(no name)"
+                url = r.get("url")
+                st.write(f"### [{r.get('rank')}] " + (f"[{title}]({url})" if url else title))
+                st.caption(f"{r.get('filename', '')}（距離 {r.get('distance', 0):.3f}）")
+                if highlight:
+                    st.markdown(highlight_markdown(r.get("text", ""), r.get("highlights")))
+                else:
+                    st.text(r.get("text", ""))
 
-        for i, (doc, meta) in enumerate(zip(docs, metas), start=1):
-            st.write(f"### [{i}] {meta.get('filename','(no name)')}")
-            st.text(doc[:1000])
+            col_prev, col_page, col_next = st.columns([1, 2, 1])
+            if col_prev.button("← 前へ", disabled=page <= 1):
+                st.session_state.search_page = page - 1
+                st.rerun()
+            col_page.caption(f"{page} ページ目")
+            if col_next.button("次へ →", disabled=not data.get("has_more")):
+                st.session_state.search_page = page + 1
+                st.rerun()
@@ -0,0 +1,143 @@
+# bulk_qa.py
+"""
+質問をまとめて回答する CLI（main.py の検索・回答処理をそのまま使う。API サーバは不要）。
+
+  python bulk_qa.py questions.jsonl -o answers.jsonl
+  python bulk_qa.py questions.jsonl -o answers.jsonl --resume   # 出力済みの id は飛ばして追記
+  cat questions.txt | python bulk_qa.py - > answers.jsonl        # 1 行 1 質問のテキストでもよい
+
+入力は JSONL（1 行 1 件）。{"id": ..., "question": ...} のほか、requests.jsonl と同じ形の
+{"request_id": ..., "title": ..., "body": ...} も受け付ける（title と body をつないで質問にする）。
+出力は /query/batch と同じ行（終わった順）。埋め込み・ベクトル検索は BATCH_RETRIEVE_SIZE 件ずつまとめ、
+LLM 呼び出しは --concurrency 件まで並行させる。
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Any, List, Set, Tuple, Union
+
+
+def _item(obj: Any, index: int) -> Tuple[str, str]:
+    if isinstance(obj, str):
+        item_id, question = str(index), obj
+    elif isinstance(obj, dict):
+        item_id = obj.get("id", obj.get("request_id", index))
+        question = obj.get("question") or "\n".join(str(obj[k]) for k in ("title", "body") if obj.get(k))
+    else:
+        raise ValueError(f"#{index}: 質問は文字列かオブジェクトで指定してください")
+    question = (question or "").strip()
+    if not question:
+        raise ValueError(f"#{index}: 質問が空です")
+    return str(item_id), question
+
+
+def parse_items(data: Union[bytes, str]) -> List[Tuple[str, str]]:
+    """
+    /query/batch の本文や入力ファイルを (id, 質問) の列にする。
+    JSON（配列 / {"questions": [...]}）か JSONL。JSON でない行は 1 行 1 質問のテキストとして扱う
+    """
+    text = data.decode("utf-8") if isinstance(data, bytes) else data
+    try:
+        doc = json.loads(text)
+    except ValueError:
+        doc = None
+    if isinstance(doc, dict) and "questions" in doc:
+        doc = doc["questions"]
+    if isinstance(doc, list):
+        return [_item(obj, i) for i, obj in enumerate(doc)]
+    if isinstance(doc, dict):
+        return [_item(doc, 0)]
+
+    items: List[Tuple[str, str]] = []
+    for n, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] in "{[\"":
+            try:
+                obj = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"line {n}: {e}")
+        else:
+            obj = line
+        items.append(_item(obj, len(items)))
+    return items
+
+
+def done_ids(path: str) -> Set[str]:
+    """出力済みの id（エラーだった行はやり直す）"""
+    ids: Set[str] = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # 中断時の書きかけ行
+                if "error" not in row:
+                    ids.add(str(row.get("id")))
+    except OSError:
+        pass
+    return ids
+
+
+async def run(rag, items: List[Tuple[str, str]], out, progress_secs: float) -> None:
+    t0 = last = time.perf_counter()
+    n = cached = errors = 0
+    async for row in rag.answer_batch(items):
+        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+        n += 1
+        cached += row.get("cached") is True
+        errors += "error" in row
+        if time.perf_counter() - last >= progress_secs:
+            last = time.perf_counter()
+            print(f"[bulk_qa] {n}/{len(items)} ({n / (last - t0):.2f} q/s) cached={cached} errors={errors}",
+                  file=sys.stderr)
+    secs = time.perf_counter() - t0
+    print(f"[bulk_qa] 完了 {n} 件 in {secs:.1f}s ({n / max(secs, 1e-9):.2f} q/s) cached={cached} errors={errors}",
+          file=sys.stderr)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="質問 JSONL にまとめて回答して JSONL で書き出す")
+    ap.add_argument("input", help="入力ファイル（- で標準入力）")
+    ap.add_argument("-o", "--output", help="出力ファイル（省略時は標準出力）")
+    ap.add_argument("--resume", action="store_true", help="出力ファイルにある id は飛ばして追記する")
+    ap.add_argument("--concurrency", type=int, default=0, help="LLM の同時呼び出し数（既定・上限は LLM_CONCURRENCY）")
+    ap.add_argument("--progress-secs", type=float, default=10.0)
+    args = ap.parse_args()
+
+    if args.input == "-":
+        items = parse_items(sys.stdin.read())
+    else:
+        with open(args.input, "r", encoding="utf-8") as f:
+            items = parse_items(f.read())
+    if args.resume and args.output:
+        skip = done_ids(args.output)
+        items = [it for it in items if it[0] not in skip]
+        print(f"[bulk_qa] resume: {len(skip)} 件は出力済み", file=sys.stderr)
+    print(f"[bulk_qa] {len(items)} 件", file=sys.stderr)
+    if not items:
+        return
+
+    import main as rag  # モデル等は最初のバッチで読み込まれる
+
+    # API と違って対話リクエストは来ないので、既定では LLM の枠を全部使う
+    concurrency = min(args.concurrency or rag.LLM_CONCURRENCY, rag.LLM_CONCURRENCY)
+    rag.BATCH_LLM_CONCURRENCY = concurrency
+    rag.batch_llm_slots = asyncio.Semaphore(concurrency)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "a" if args.resume else "w", encoding="utf-8") as out:
+            asyncio.run(run(rag, items, out, args.progress_secs))
+    else:
+        asyncio.run(run(rag, items, sys.stdout, args.progress_secs))
+
+
+if __name__ == "__main__":
+    main()
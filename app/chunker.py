@@ -0,0 +1,148 @@
+# chunker.py
+"""
+記事本文のチャンク分割。どちらも Chunk(text, start, end, tokens) を順に返すジェネレータで、
+start / end は本文（strip 済み）での文字位置。メタに入れておけば main.py 側で隣り合うチャンクを
+ファイルを読み直さずに継ぎ合わせられる。
+
+- SentenceChunker: 日本語・英語の文境界で切り、埋め込みモデルのトークナイザで数えて
+  max_tokens（既定はモデルの max_seq_length）に収まるだけ文を詰める。重なりは末尾の文を
+  overlap_tokens 分だけ次のチャンクに持ち越す。max_tokens を超える長い文は読点、最後は文字数で割る
+- CharChunker: 従来の固定文字数スライス（CHUNKER=chars。既存のチャンクをそのまま使いたいとき）
+"""
+import re
+import copy
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Iterator, Tuple
+
+# 文末（。！？ と閉じ括弧・引用符まで）、空白が続く英語のピリオド、改行
+_SENTENCE_END = re.compile(r"[。！？!?]+[」』）)】〕”’\"']*|\.(?=\s|$)|\n+")
+# 長すぎる文を割るときの区切り
+_CLAUSE_END = re.compile(r"[、，,；;：:]+")
+
+
+@dataclass
+class Chunk:
+    text: str
+    start: int
+    end: int
+    tokens: int = 0
+
+
+def _trimmed(text: str, s: int, e: int) -> Iterator[Tuple[int, int]]:
+    while s < e and text[s].isspace():
+        s += 1
+    while e > s and text[e - 1].isspace():
+        e -= 1
+    if s < e:
+        yield s, e
+
+
+def _split_at(pattern: "re.Pattern", text: str, s: int, e: int) -> Iterator[Tuple[int, int]]:
+    pos = s
+    for m in pattern.finditer(text, s, e):
+        yield from _trimmed(text, pos, m.end())
+        pos = m.end()
+    yield from _trimmed(text, pos, e)
+
+
+def iter_sentences(text: str) -> Iterator[Tuple[int, int]]:
+    """文の (開始, 終了) 位置を順に返す。前後の空白は含めない"""
+    return _split_at(_SENTENCE_END, text, 0, len(text))
+
+
+def token_counter(tokenizer) -> Callable[[str], int]:
+    """
+    HF トークナイザで特殊トークン抜きのトークン数を数える関数。読み込みスレッドから並行に呼ぶので、
+    fast tokenizer はモデル側と状態（truncation 設定など）を共有しない複製を使う
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        backend = copy.deepcopy(backend)
+        backend.no_truncation()
+        backend.no_padding()
+        return lambda s: len(backend.encode(s, add_special_tokens=False).ids)
+    lock = threading.Lock()
+
+    def count(s: str) -> int:
+        with lock:
+            return len(tokenizer.encode(s, add_special_tokens=False))
+
+    return count
+
+
+class SentenceChunker:
+    def __init__(self, count_tokens: Callable[[str], int], max_tokens: int, overlap_tokens: int = 0):
+        if max_tokens <= 0:
+            raise ValueError("max_tokens must be positive")
+        self.count = count_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = max(0, min(overlap_tokens, max_tokens // 2))
+
+    def _hard_split(self, text: str, s: int, e: int, n: int) -> Iterator[Tuple[int, int, int]]:
+        """区切りが無い長い塊は、トークン密度から見積もった文字数で切り、はみ出たら縮める"""
+        pos = s
+        while pos < e:
+            width = max(1, int((e - s) / max(n, 1) * self.max_tokens * 0.9))
+            end = min(e, pos + width)
+            c = self.count(text[pos:end])
+            while c > self.max_tokens and end - pos > 1:
+                end = pos + max(1, (end - pos) * 3 // 4)
+                c = self.count(text[pos:end])
+            for ps, pe in _trimmed(text, pos, end):
+                yield ps, pe, self.count(text[ps:pe])
+            pos = end
+
+    def _pieces(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """文（長すぎる文は読点・文字数で割ったもの）と、そのトークン数"""
+        for s, e in iter_sentences(text):
+            n = self.count(text[s:e])
+            if n <= self.max_tokens:
+                yield s, e, n
+                continue
+            for cs, ce in _split_at(_CLAUSE_END, text, s, e):
+                cn = self.count(text[cs:ce])
+                if cn <= self.max_tokens:
+                    yield cs, ce, cn
+                else:
+                    yield from self._hard_split(text, cs, ce, cn)
+
+    def chunks(self, text: str) -> Iterator[Chunk]:
+        window: Deque[Tuple[int, int, int]] = deque()
+        total = 0
+        for s, e, n in self._pieces(text):
+            if window and total + n > self.max_tokens:
+                yield Chunk(text[window[0][0]:window[-1][1]], window[0][0], window[-1][1], total)
+                # 末尾の文を overlap_tokens まで次のチャンクに持ち越す
+                keep: Deque[Tuple[int, int, int]] = deque()
+                kept = 0
+                for item in reversed(window):
+                    if kept + item[2] > self.overlap_tokens or kept + item[2] + n > self.max_tokens:
+                        break
+                    keep.appendleft(item)
+                    kept += item[2]
+                window, total = keep, kept
+            window.append((s, e, n))
+            total += n
+        if window:
+            yield Chunk(text[window[0][0]:window[-1][1]], window[0][0], window[-1][1], total)
+
+
+class CharChunker:
+    """max_chars 文字ごと（overlap 文字重ねて）に切る従来の分割。各チャンクは前後の空白を除く"""
+
+    def __init__(self, max_chars: int, overlap: int = 0):
+        self.max_chars = max_chars
+        self.overlap = overlap
+
+    def chunks(self, text: str) -> Iterator[Chunk]:
+        if not text:
+            return
+        if self.max_chars <= 0:
+            yield from (Chunk(text[s:e], s, e) for s, e in _trimmed(text, 0, len(text)))
+            return
+        step = max(1, self.max_chars - max(0, self.overlap))
+        for i in range(0, len(text), step):
+            for s, e in _trimmed(text, i, min(len(text), i + self.max_chars)):
+                yield Chunk(text[s:e], s, e)
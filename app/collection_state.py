@@ -0,0 +1,120 @@
+# collection_state.py
+"""
+embed_articles.py（書き込み側）と main.py（読み取り側）で共有する、
+コレクションの状態ファイルまわりのユーティリティ。
+
+- <PERSIST_DIR>/<COLLECTION>.version : コレクション内容が変わるたびに更新される世代番号
+- <PERSIST_DIR>/<COLLECTION>.alias   : クエリに使う実コレクション名（blue/green 切り替え）
+
+全件作り直しは新しい版 <COLLECTION>-v<時刻> を裏で作って検証し、エイリアスを書き換えて切り替える。
+エイリアスが無ければ論理名のコレクション（従来の作り方）をそのまま使う。
+"""
+import os
+import time
+from typing import Callable, Optional
+
+
+def version_path(persist_dir: str, collection: str) -> str:
+    return os.path.join(persist_dir, f"{collection}.version")
+
+
+def _atomic_write(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def bump_version(persist_dir: str, collection: str) -> str:
+    """コレクション内容が変わったことを記録し、新しい世代番号を返す"""
+    ver = str(time.time_ns())
+    _atomic_write(version_path(persist_dir, collection), ver)
+    return ver
+
+
+def read_version(persist_dir: str, collection: str) -> str:
+    try:
+        with open(version_path(persist_dir, collection), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def alias_path(persist_dir: str, collection: str) -> str:
+    return os.path.join(persist_dir, f"{collection}.alias")
+
+
+def versioned_name(collection: str) -> str:
+    """新しい版のコレクション名（Chroma の名前は [a-zA-Z0-9._-] のみなので @ ではなく -v で区切る）"""
+    return f"{collection}-v{time.time_ns()}"
+
+
+def is_version_of(name: str, collection: str) -> bool:
+    return name == collection or name.startswith(f"{collection}-v")
+
+
+def read_alias(persist_dir: str, collection: str) -> str:
+    """いまクエリに使う実コレクション名。エイリアスが無ければ論理名"""
+    try:
+        with open(alias_path(persist_dir, collection), "r", encoding="utf-8") as f:
+            return f.read().strip() or collection
+    except OSError:
+        return collection
+
+
+def promote(persist_dir: str, collection: str, physical: str, bump: bool = True) -> str:
+    """
+    エイリアスを physical に切り替え、世代番号を返す。
+    中身が前の版と同じなら bump=False で世代番号を据え置く（回答キャッシュを捨てない）
+    """
+    _atomic_write(alias_path(persist_dir, collection), physical)
+    return bump_version(persist_dir, collection) if bump else read_version(persist_dir, collection)
+
+
+class _FileWatcher:
+    """状態ファイルを安価に監視する。ファイルの stat は min_interval 秒に 1 回まで"""
+
+    def __init__(self, path: str, read: Callable[[], str], min_interval: float = 1.0):
+        self.path = path
+        self._read = read
+        self.min_interval = min_interval
+        self._checked_at = 0.0
+        self._mtime: Optional[float] = None
+        self._value = read()
+
+    def refresh(self) -> str:
+        """次の current() を待たずに読み直す（参照先が消えていたときなど）"""
+        self._checked_at = 0.0
+        self._mtime = None
+        return self.current()
+
+    def current(self) -> str:
+        now = time.monotonic()
+        if now - self._checked_at < self.min_interval:
+            return self._value
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._value = self._read()
+        return self._value
+
+
+class VersionWatcher(_FileWatcher):
+    """世代番号の監視（回答キャッシュなどの無効化用）"""
+
+    def __init__(self, persist_dir: str, collection: str, min_interval: float = 1.0):
+        super().__init__(version_path(persist_dir, collection),
+                         lambda: read_version(persist_dir, collection), min_interval)
+
+
+class AliasWatcher(_FileWatcher):
+    """エイリアスの監視。current() がクエリに使う実コレクション名を返す"""
+
+    def __init__(self, persist_dir: str, collection: str, min_interval: float = 1.0):
+        super().__init__(alias_path(persist_dir, collection),
+                         lambda: read_alias(persist_dir, collection), min_interval)
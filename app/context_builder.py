@@ -0,0 +1,219 @@
+# context_builder.py
+"""
+検索結果 → LLM に渡す参考記事抜粋の組み立て（トークン数で予算管理）。
+
+- 同じ filename のチャンクは番号順に並べ、隣接・重なりを継ぎ目で 1 つにまとめる。
+  メタに char_start / char_end（embed_articles.py が入れる本文での位置）があればそれで重なりを切り、
+  無ければ（古いインデックス）本文の末尾と先頭の一致で探す。
+  離れたチャンクは同じ記事ブロック内に「…」で区切って並べる
+- 別記事でも中身が同じ、あるいは既に入れた範囲に含まれる抜粋は入れない
+- 記事ブロックは検索順位の高い順に、予算 budget_tokens に収まるだけ詰める。
+  最後の 1 ブロックが収まらなければ、残り予算分のトークンで切って入れる
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+
+SEPARATOR = "\n\n---\n\n"
+GAP = "\n…\n"
+MIN_PARTIAL_TOKENS = 48      # 残り予算がこれ未満なら途中切りのブロックは入れない
+MAX_OVERLAP_SCAN = 600       # 継ぎ目の重なりを探す最大文字数
+MIN_OVERLAP_CHARS = 20       # 番号が連続しないチャンクを重なりだけで継ぐときの最小一致長
+MAX_SPAN_GAP = 4             # 位置がこれ以下しか離れていないチャンクは（間の空白を改行にして）継ぐ
+
+_CHUNK_SUFFIX = re.compile(r"#(\d+)$")
+
+
+def load_encoding(model: str):
+    """tiktoken のエンコーダ（モデル名で引けなければ o200k_base → cl100k_base）"""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    for name in ("o200k_base", "cl100k_base"):
+        try:
+            return tiktoken.get_encoding(name)
+        except (KeyError, ValueError):
+            continue
+    raise RuntimeError(f"tiktoken encoding not found for {model}")
+
+
+def _overlap(a: str, b: str, limit: int = MAX_OVERLAP_SCAN) -> int:
+    """a の末尾と b の先頭が一致する最大長"""
+    n = min(len(a), len(b), limit)
+    for size in range(n, 0, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+
+@dataclass
+class _Piece:
+    rank: int          # 検索結果での順位（0 始まり）
+    chunk: Optional[int]
+    text: str
+    dist: Optional[float]
+    start: Optional[int] = None   # 本文での文字位置（char_start / char_end）
+    end: Optional[int] = None
+
+
+@dataclass
+class _Block:
+    filename: str
+    rank: int
+    dist: Optional[float]
+    segments: List[str] = field(default_factory=list)
+    ranks: List[int] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return GAP.join(self.segments)
+
+
+@dataclass
+class BuiltContext:
+    text: str
+    tokens: int                  # text のトークン数
+    blocks: int                  # 入れた記事ブロック数
+    used: List[int]              # 入れたチャンクの検索順位
+    truncated: bool = False      # 予算で途中切りしたか
+    dropped: int = 0             # 予算・重複で入らなかったチャンク数
+
+    def stats(self) -> Dict[str, Any]:
+        return {"tokens": self.tokens, "blocks": self.blocks, "chunks": len(self.used),
+                "truncated": self.truncated, "dropped": self.dropped}
+
+
+class ContextBuilder:
+    def __init__(self, encoding, budget_tokens: int = 3000, doc_max_tokens: int = 0):
+        self.enc = encoding
+        self.budget_tokens = budget_tokens
+        self.doc_max_tokens = doc_max_tokens
+
+    def count(self, text: str) -> int:
+        return len(self.enc.encode(text))
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        toks = self.enc.encode(text)
+        if len(toks) <= max_tokens:
+            return text
+        # 切れ目がマルチバイト文字の途中にかかると decode で U+FFFD になるので落とす
+        return self.enc.decode(toks[:max_tokens]).rstrip("�") + "…"
+
+    @staticmethod
+    def _chunk_no(doc_id: str, meta: Dict[str, Any]) -> Optional[int]:
+        c = meta.get("chunk")
+        if isinstance(c, int):
+            return c
+        m = _CHUNK_SUFFIX.search(doc_id or "")
+        return int(m.group(1)) if m else None
+
+    @staticmethod
+    def _span(meta: Dict[str, Any], text: str):
+        s, e = meta.get("char_start"), meta.get("char_end")
+        if isinstance(s, int) and isinstance(e, int) and e - s == len(text):
+            return s, e
+        return None, None
+
+    def _blocks(self, ids: Sequence[str], docs: Sequence[str], metas: Sequence[dict],
+                dists: Sequence[float]) -> List[_Block]:
+        by_file: Dict[str, List[_Piece]] = {}
+        for i, doc in enumerate(docs):
+            meta = (metas[i] if i < len(metas) else None) or {}
+            doc_id = ids[i] if i < len(ids) else ""
+            fn = meta.get("filename") or doc_id or "doc"
+            dist = float(dists[i]) if i < len(dists) and dists[i] is not None else None
+            text = (doc or "").strip()
+            start, end = self._span(meta, text)
+            by_file.setdefault(fn, []).append(_Piece(i, self._chunk_no(doc_id, meta), text, dist, start, end))
+
+        blocks: List[_Block] = []
+        for fn, pieces in by_file.items():
+            if all(p.start is not None for p in pieces):
+                pieces.sort(key=lambda p: (p.start, p.end))
+            else:
+                pieces.sort(key=lambda p: (p.chunk is None, p.chunk if p.chunk is not None else p.rank))
+            block = _Block(filename=fn, rank=min(p.rank for p in pieces),
+                           dist=min((p.dist for p in pieces if p.dist is not None), default=None))
+            prev: Optional[_Piece] = None
+            seg_end: Optional[int] = None   # 最後のセグメントが本文のどこまでか（位置が分かるとき）
+            for p in pieces:
+                if not p.text:
+                    continue
+                if seg_end is not None and p.start is not None and p.start <= seg_end + MAX_SPAN_GAP:
+                    # 位置で継ぐ: 重なりは切り落とし、空白だけの隙間は改行にする。含まれるチャンクは足さない
+                    if p.start < seg_end:
+                        block.segments[-1] += p.text[seg_end - p.start:] if p.end > seg_end else ""
+                    else:
+                        block.segments[-1] += ("\n" if p.start > seg_end else "") + p.text
+                    seg_end = max(seg_end, p.end)
+                    block.ranks.append(p.rank)
+                    prev = p
+                    continue
+                if prev is not None and block.segments and (p.start is None or seg_end is None):
+                    cur = block.segments[-1]
+                    if p.text in cur:
+                        block.ranks.append(p.rank)
+                        continue
+                    adjacent = p.chunk is not None and prev.chunk is not None and p.chunk == prev.chunk + 1
+                    ov = _overlap(cur, p.text)
+                    if adjacent or ov >= MIN_OVERLAP_CHARS:
+                        # 隣接チャンクは重なり部分を除いて継ぐ
+                        block.segments[-1] = cur + p.text[ov:]
+                        block.ranks.append(p.rank)
+                        prev = p
+                        seg_end = None
+                        continue
+                block.segments.append(p.text)
+                block.ranks.append(p.rank)
+                prev = p
+                seg_end = p.end
+            if block.segments:
+                blocks.append(block)
+        blocks.sort(key=lambda b: b.rank)
+        return blocks
+
+    def build(self, ids: Sequence[str], docs: Sequence[str], metas: Sequence[dict],
+              dists: Sequence[float]) -> BuiltContext:
+        blocks = self._blocks(ids, docs, metas, dists)
+        parts: List[str] = []
+        used: List[int] = []
+        seen: List[str] = []
+        total = 0
+        truncated = False
+        sep_tokens = self.count(SEPARATOR)
+
+        for block in blocks:
+            # 既に入れた抜粋と同じ・含まれる範囲は落とす（転載記事など）
+            block.segments = [s for s in block.segments if not any(s in t for t in seen)]
+            if not block.segments:
+                continue
+            body = block.text
+            if self.doc_max_tokens > 0:
+                body = self._truncate(body, self.doc_max_tokens)
+            dist = f" (dist={block.dist:.3f})" if block.dist is not None else ""
+            header = f"[{len(parts) + 1}] {block.filename}{dist}\n"
+            cost = self.count(header + body) + (sep_tokens if parts else 0)
+
+            remaining = self.budget_tokens - total if self.budget_tokens > 0 else None
+            if remaining is not None and cost > remaining:
+                room = remaining - self.count(header) - (sep_tokens if parts else 0)
+                if room < MIN_PARTIAL_TOKENS:
+                    break
+                body = self._truncate(body, room - 1)  # 末尾の「…」の分
+                cost = self.count(header + body) + (sep_tokens if parts else 0)
+                truncated = True
+
+            parts.append(header + body)
+            seen.extend(block.segments)
+            used.extend(sorted(block.ranks))
+            total += cost
+            if truncated:
+                break
+
+        text = SEPARATOR.join(parts)
+        # 継ぎ目でトークン境界が変わることがあるので、最後に全体を数え直す
+        return BuiltContext(text=text, tokens=self.count(text) if parts else 0, blocks=len(parts), used=used,
+                            truncated=truncated, dropped=len(docs) - len(used))
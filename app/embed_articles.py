@@ -2,12 +2,26 @@
 import os
 import glob
 import json
-from typing import List, Dict, Set
+import time
+import queue
+import random
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, List, Dict, Set, Tuple, Optional
 
 from dotenv import load_dotenv
 from chromadb import PersistentClient
 from sentence_transformers import SentenceTransformer
 
+from chunker import CharChunker, Chunk, SentenceChunker, token_counter
+from collection_state import bump_version, is_version_of, promote, read_alias, versioned_name
+from embedder import describe, load_embedder, model_key
+from embedding_cache import EmbeddingCache
+from lexical_index import LexicalIndex, lexical_path
+from search_filter import to_epoch
+from vector_snapshot import export_snapshot, pointer_path
+
 load_dotenv()
 
 # ── ENV ─────────────────────────────────────────────────────────────
@@ -17,11 +31,50 @@ ARTICLES_DIR  = os.environ.get("ARTICLES_DIR", "./articles")
 EMBED_MODEL   = os.environ.get("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
 FORCE_REINDEX = os.environ.get("FORCE_REINDEX", "0") == "1"
 
-CHUNK_MAX_CHARS      = int(os.environ.get("CHUNK_MAX_CHARS", "1200"))
-CHUNK_OVERLAP_CHARS  = int(os.environ.get("CHUNK_OVERLAP_CHARS", "100"))
+# チャンク分割: sentence（文境界＋埋め込みモデルのトークン数）/ chars（従来の固定文字数）
+CHUNKER              = os.environ.get("CHUNKER", "sentence")
+CHUNK_MAX_TOKENS     = int(os.environ.get("CHUNK_MAX_TOKENS", "0"))       # 0 でモデルの max_seq_length に合わせる
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "24"))
+CHUNK_MAX_CHARS      = int(os.environ.get("CHUNK_MAX_CHARS", "1200"))     # CHUNKER=chars 用
+CHUNK_OVERLAP_CHARS  = int(os.environ.get("CHUNK_OVERLAP_CHARS", "100"))  # CHUNKER=chars 用
 BATCH_SIZE           = int(os.environ.get("EMBED_BATCH_ADD_SIZE", "200"))
 ENCODE_BATCH_SIZE    = int(os.environ.get("ENCODE_BATCH_SIZE", "32"))
 
+# 全件作り直し（FORCE_REINDEX / 埋め込みモデル変更）は新しい版を裏で作り、検証してから切り替える
+COLLECTION_KEEP          = int(os.environ.get("COLLECTION_KEEP", "2"))            # 残す版の数（稼働中を含む）
+REINDEX_VALIDATE_SAMPLES = int(os.environ.get("REINDEX_VALIDATE_SAMPLES", "5"))   # 自己検索で確かめるチャンク数
+REINDEX_MIN_RATIO        = float(os.environ.get("REINDEX_MIN_RATIO", "0.5"))      # 旧版に対する件数の下限（記事ディレクトリの取り違え対策）
+
+# 差分インデックス用マニフェスト（ファイル/チャンク単位のハッシュ）
+MANIFEST_PATH = os.environ.get("EMBED_MANIFEST", os.path.join(PERSIST_DIR, f"{COLLECTION}.manifest.json"))
+
+# 埋め込みキャッシュ（モデル名＋テキストハッシュ → ベクトル）
+EMBED_CACHE     = os.environ.get("EMBED_CACHE", "1") == "1"
+EMBED_CACHE_DIR = os.environ.get("EMBED_CACHE_DIR", os.path.join(PERSIST_DIR, "embed_cache"))
+
+# 埋め込みの推論バックエンド（main.py と同じ設定。embedder.py 参照）
+EMBED_BACKEND       = os.environ.get("EMBED_BACKEND", "torch")
+EMBED_ONNX_QUANTIZE = os.environ.get("EMBED_ONNX_QUANTIZE", "")
+EMBED_ONNX_DIR      = os.environ.get("EMBED_ONNX_DIR") or os.path.join(PERSIST_DIR, "onnx")
+EMBED_THREADS       = int(os.environ.get("EMBED_THREADS", "0"))
+
+# 文字 n-gram の BM25 インデックス（main.py のハイブリッド検索用）
+LEXICAL_INDEX      = os.environ.get("LEXICAL_INDEX", "1") == "1"
+LEXICAL_INDEX_PATH = os.environ.get("LEXICAL_INDEX_PATH") or lexical_path(PERSIST_DIR, COLLECTION)
+
+# API の行列検索用の読み取り専用ベクトルスナップショット（RETRIEVAL_BACKEND=matrix）
+VECTOR_SNAPSHOT       = os.environ.get("VECTOR_SNAPSHOT", "0") == "1"
+VECTOR_SNAPSHOT_DTYPE = os.environ.get("VECTOR_SNAPSHOT_DTYPE", "float32")  # 候補絞り込み用の行列: float32 / float16 / int8
+ANN_INDEX             = os.environ.get("ANN_INDEX", "auto")                 # auto（hnswlib があれば HNSW、無ければ IVF）/ hnsw / ivf / none
+ANN_MIN_ROWS          = int(os.environ.get("ANN_MIN_ROWS", "50000"))        # これ未満のチャンク数なら総当たり
+
+# パイプライン（読み込み/チャンク化 → エンコード → 書き込み）
+READ_WORKERS       = int(os.environ.get("EMBED_READ_WORKERS", str(min(8, os.cpu_count() or 1))))
+PIPELINE_DEPTH     = int(os.environ.get("EMBED_PIPELINE_DEPTH", "64"))   # 読み込み済みファイルのキュー長
+WRITE_QUEUE_DEPTH  = int(os.environ.get("EMBED_WRITE_QUEUE_DEPTH", "2"))  # エンコード済みバッチのキュー長
+ENCODE_PROCESSES   = int(os.environ.get("ENCODE_PROCESSES", "0"))         # 2 以上で multi-process encode
+PROGRESS_SECS      = float(os.environ.get("EMBED_PROGRESS_SECS", "5"))
+
 # ── utils ───────────────────────────────────────────────────────────
 def read_text(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
@@ -38,31 +91,28 @@ def read_sidecar_json(txt_path: str) -> Dict:
             return {}
     return {}
 
-def chunk_text(s: str, max_chars: int, overlap: int) -> List[str]:
-    if not s:
-        return []
-    if max_chars <= 0:
-        return [s]
-    chunks: List[str] = []
-    i = 0
-    n = len(s)
-    step = max(1, max_chars - max(0, overlap))
-    while i < n:
-        j = min(n, i + max_chars)
-        piece = s[i:j].strip()
-        if piece:
-            chunks.append(piece)
-        i += step
-    return chunks
+def chunker_signature() -> str:
+    """分割方法が変わったら全チャンクを作り直すため、マニフェストに残す識別子"""
+    if CHUNKER == "chars":
+        return f"chars:{CHUNK_MAX_CHARS}:{CHUNK_OVERLAP_CHARS}"
+    return f"sentence:{CHUNK_MAX_TOKENS or 'auto'}:{CHUNK_OVERLAP_TOKENS}"
+
+def make_chunker(model):
+    if CHUNKER == "chars":
+        return CharChunker(CHUNK_MAX_CHARS, CHUNK_OVERLAP_CHARS)
+    # 特殊トークン（[CLS]/[SEP] など）の分を引いた、モデルが切り捨てずに読める長さ
+    limit = max(16, int(getattr(model, "max_seq_length", None) or 256) - 2)
+    max_tokens = min(CHUNK_MAX_TOKENS, limit) if CHUNK_MAX_TOKENS > 0 else limit
+    return SentenceChunker(token_counter(model.tokenizer), max_tokens, CHUNK_OVERLAP_TOKENS)
 
 def paged_get_all_ids(col, page_size: int = 10000) -> Set[str]:
     existing: Set[str] = set()
     offset = 0
     while True:
         try:
-            res = col.get(include=["ids"], limit=page_size, offset=offset)
+            res = col.get(include=[], limit=page_size, offset=offset)
         except TypeError:
-            res = col.get(include=["ids"])
+            res = col.get(include=[])
         ids = res.get("ids") or []
         if not ids:
             break
@@ -76,16 +126,47 @@ def paged_get_all_ids(col, page_size: int = 10000) -> Set[str]:
         offset += page_size
     return existing
 
-def drop_collection_safely(client: PersistentClient, col, name: str) -> None:
-    try:
-        client.delete_collection(name)
-        print(f"[embed] dropped collection: {name}")
-    except Exception as e:
-        print(f"[embed] delete_collection failed ({e}); fallback to delete-by-ids")
-        ids = paged_get_all_ids(col)
-        if ids:
-            col.delete(ids=list(ids))
-            print(f"[embed] deleted {len(ids)} items by ids")
+def collection_names(client: PersistentClient) -> List[str]:
+    # Chroma 0.6 以降は名前の一覧、それより前は Collection の一覧を返す
+    return [getattr(c, "name", c) for c in client.list_collections()]
+
+def gc_collections(client: PersistentClient, collection: str, live: str, keep: int) -> None:
+    """
+    稼働中の版と、その直前の版を keep - 1 個だけ残して古い版を消す。
+    直前の版は切り替え直後にまだ参照しているプロセスがあるのと、戻すときのために残す。
+    稼働中より新しい版（検証で落ちた・中断した作りかけ）も消す
+    """
+    versions = [n for n in collection_names(client) if is_version_of(n, collection) and n != live]
+    # 論理名そのもの（版を使う前のコレクション）が一番古い
+    older = sorted((n for n in versions if n == collection or n < live), key=lambda n: (n != collection, n))
+    doomed = older[:max(0, len(older) - (keep - 1))] + [n for n in versions if n not in older]
+    for name in doomed:
+        try:
+            client.delete_collection(name)
+            print(f"[embed] dropped old collection: {name}")
+        except Exception as e:
+            print(f"[embed] delete_collection failed: {name}: {e}")
+
+def validate_collection(col, expected: int, previous: int) -> None:
+    """
+    切り替え前の検証。件数と、ランダムなチャンクの自己検索（自分の埋め込みで上位に自分が来るか）を確かめ、
+    駄目なら RuntimeError（エイリアスは切り替えない）
+    """
+    count = col.count()
+    if count == 0 or count != expected:
+        raise RuntimeError(f"validation failed: count={count}, expected={expected}")
+    if previous and count < previous * REINDEX_MIN_RATIO:
+        raise RuntimeError(f"validation failed: count={count} < {REINDEX_MIN_RATIO} x previous={previous}")
+    n = min(REINDEX_VALIDATE_SAMPLES, count)
+    if n <= 0:
+        return
+    res = col.get(include=["embeddings"], limit=n, offset=random.randrange(count - n + 1))
+    ids = list(res.get("ids") or [])
+    hits = col.query(query_embeddings=[list(e) for e in res["embeddings"]], n_results=min(3, count), include=[])
+    missed = [doc_id for doc_id, top in zip(ids, hits.get("ids") or []) if doc_id not in (top or [])]
+    if missed:
+        raise RuntimeError(f"validation failed: self-query missed {missed}")
+    print(f"[embed] validated {col.name}: count={count} (previous={previous}), self-query {len(ids)}/{len(ids)}")
 
 def build_flat_metadata(base_meta: Dict, json_meta: Dict) -> Dict:
     """
@@ -116,6 +197,9 @@ def build_flat_metadata(base_meta: Dict, json_meta: Dict) -> Dict:
             v = ts.get(subk)
             if isinstance(v, (str, int, float, bool)) or v is None:
                 out[subk] = v
+        # 期間での絞り込み（where の $gte / $lte）用に epoch 秒も入れておく
+        for subk in ("published", "updated"):
+            out[f"{subk}_ts"] = to_epoch(ts.get(f"{subk}_at"))
 
     # 注意: links は配列なのでメタからは省略（link_count を使う）
     # 他に残った入れ子/配列は入れない
@@ -123,80 +207,507 @@ def build_flat_metadata(base_meta: Dict, json_meta: Dict) -> Dict:
     # None を落として返す
     return {k: v for k, v in out.items() if v is not None}
 
+# ── manifest ────────────────────────────────────────────────────────
+# {"model": str, "files": {fname: {"mtime", "size", "json_mtime", "json_size",
+#                                  "sha1", "meta_sha1", "meta_version", "chunks": {doc_id: sha1},
+#                                  "spans": [[char_start, char_end], ...]}},
+#  "chunker": "sentence:auto:24" など（chunker_signature）}
+# メタの作り方（build_flat_metadata）を変えたら上げる。上がると全チャンクのメタを入れ直す（再エンコードはしない）
+METADATA_VERSION = 2
+
+def sha1_text(s: str) -> str:
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+def load_manifest(path: str) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            m = json.load(f)
+        if isinstance(m, dict) and isinstance(m.get("files"), dict):
+            return m
+    except (OSError, ValueError):
+        pass
+    return {"model": EMBED_MODEL, "chunker": chunker_signature(), "files": {}}
+
+def content_key(manifest: Dict) -> Tuple:
+    """本文・サイドカー・チャンク分割が同じなら同じ値（作り直しても回答キャッシュを捨てなくてよいか）"""
+    return (manifest.get("model"), sorted(
+        (fname, ent.get("sha1"), ent.get("meta_sha1"), sorted((ent.get("chunks") or {}).items()))
+        for fname, ent in (manifest.get("files") or {}).items()
+    ))
+
+def save_manifest(path: str, manifest: Dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def file_signature(txt_path: str) -> Dict:
+    """本文とサイドカーJSONの mtime/size（変化が無ければ本文を読まずにスキップできる）"""
+    st = os.stat(txt_path)
+    sig = {"mtime": st.st_mtime, "size": st.st_size, "json_mtime": None, "json_size": None}
+    json_path = os.path.splitext(txt_path)[0] + ".json"
+    if os.path.exists(json_path):
+        jst = os.stat(json_path)
+        sig["json_mtime"], sig["json_size"] = jst.st_mtime, jst.st_size
+    return sig
+
+def ids_by_file(ids: Set[str]) -> Dict[str, Set[str]]:
+    out: Dict[str, Set[str]] = {}
+    for doc_id in ids:
+        out.setdefault(doc_id.rsplit("#", 1)[0], set()).add(doc_id)
+    return out
+
+def bootstrap_chunk_hashes(col, ids: Set[str], page_size: int = 500) -> Dict[str, str]:
+    """
+    マニフェストに無い既存チャンク（旧バージョンで登録された分など）は、
+    Chroma に保存済みの本文からハッシュを復元する（再エンコードは不要）。
+    """
+    out: Dict[str, str] = {}
+    id_list = sorted(ids)
+    for i in range(0, len(id_list), page_size):
+        res = col.get(ids=id_list[i:i + page_size], include=["documents"])
+        for doc_id, doc in zip(res.get("ids") or [], res.get("documents") or []):
+            if doc is not None:
+                out[doc_id] = sha1_text(doc)
+    return out
+
+def sync_lexical(col, lex: LexicalIndex, existing: Set[str], files: Dict[str, Dict],
+                 page_size: int = 500) -> int:
+    """
+    BM25 インデックスを Chroma の現状に合わせる（初回作成時や前回の中断後）。
+    マニフェストのハッシュと食い違うチャンクだけ Chroma の本文から入れ直す。戻り値は入れ直した件数
+    """
+    lex.remove([doc_id for doc_id in list(lex.docs) if doc_id not in existing])
+    want = {doc_id: h for ent in files.values() for doc_id, h in (ent.get("chunks") or {}).items()}
+    missing = sorted(doc_id for doc_id in existing
+                     if doc_id not in lex.docs or (doc_id in want and lex.hashes.get(doc_id) != want[doc_id]))
+    for i in range(0, len(missing), page_size):
+        res = col.get(ids=missing[i:i + page_size], include=["documents"])
+        pairs = [(d, doc) for d, doc in zip(res.get("ids") or [], res.get("documents") or []) if doc is not None]
+        lex.add([d for d, _ in pairs], [doc for _, doc in pairs], [sha1_text(doc) for _, doc in pairs])
+    return len(missing)
+
+def plan_file(fname: str, chunks: Iterable[Chunk], old_chunks: Dict[str, str], old_spans: List,
+              existing: Set[str], meta_changed: bool
+              ) -> Tuple[List[int], List[int], List[str], Dict[str, str], Dict[int, str], List[Tuple[int, int]]]:
+    """
+    1 ファイル分の差分を計算する。チャンクはジェネレータから 1 つずつ受け取り、本文は埋め込むものだけ残す。
+    戻り値: (埋め込みが必要なチャンク番号, メタだけ更新するチャンク番号, 削除する doc_id,
+             新しいチャンクハッシュ, 埋め込むチャンクの本文, 全チャンクの文字位置)
+    """
+    new_chunks: Dict[str, str] = {}
+    texts: Dict[int, str] = {}
+    spans: List[Tuple[int, int]] = []
+    to_embed: List[int] = []
+    to_touch: List[int] = []
+    for i, ch in enumerate(chunks):
+        doc_id = f"{fname}#{i:03d}"
+        h = sha1_text(ch.text)
+        new_chunks[doc_id] = h
+        spans.append((ch.start, ch.end))
+        if doc_id in existing and old_chunks.get(doc_id) == h:
+            # 本文が同じでも位置が変わった（前に文が足された等）ならメタの char_start/char_end を直す
+            old = old_spans[i] if i < len(old_spans) else None
+            if meta_changed or old is None or tuple(old) != (ch.start, ch.end):
+                to_touch.append(i)
+        else:
+            to_embed.append(i)
+            texts[i] = ch.text
+    stale = sorted(existing - set(new_chunks))
+    return to_embed, to_touch, stale, new_chunks, texts, spans
+
+def chunk_meta(fname: str, i: int, span: Tuple[int, int]) -> Dict:
+    # char_start/char_end は本文（strip 済み）での位置。API 側で隣のチャンクとの重なりを切って継ぎ合わせる
+    return {"filename": fname, "chunk": i, "char_start": span[0], "char_end": span[1]}
+
+# ── pipeline ────────────────────────────────────────────────────────
+_DONE = object()
+
+@dataclass
+class FilePlan:
+    """読み込みスレッドが作る 1 ファイル分の処理計画"""
+    fname: str
+    sig: Dict
+    unchanged: bool = False
+    n_old: int = 0
+    texts: Dict[int, str] = field(default_factory=dict)          # 埋め込むチャンクの本文だけ
+    spans: List[Tuple[int, int]] = field(default_factory=list)   # 全チャンクの (char_start, char_end)
+    meta_json: Dict = field(default_factory=dict)
+    entry: Dict = field(default_factory=dict)
+    to_embed: List[int] = field(default_factory=list)
+    to_touch: List[int] = field(default_factory=list)
+    stale: List[str] = field(default_factory=list)
+    error: Optional[str] = None  # 読み込みに失敗した（既存のチャンク・マニフェストは触らない）
+
+class StageStats:
+    """ステージごとの待ち時間（秒）を集計する"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait: Dict[str, float] = {}
+
+    def add(self, stage: str, secs: float) -> None:
+        with self._lock:
+            self.wait[stage] = self.wait.get(stage, 0.0) + secs
+
+    def timed_put(self, stage: str, q: "queue.Queue", item) -> None:
+        t0 = time.perf_counter()
+        q.put(item)
+        self.add(stage, time.perf_counter() - t0)
+
+    def timed_get(self, stage: str, q: "queue.Queue"):
+        t0 = time.perf_counter()
+        item = q.get()
+        self.add(stage, time.perf_counter() - t0)
+        return item
+
+    def summary(self) -> str:
+        with self._lock:
+            return " ".join(f"{k}={v:.1f}s" for k, v in sorted(self.wait.items()))
+
+def plan_path(p: str, files: Dict[str, Dict], existing_by_file: Dict[str, Set[str]], chunker) -> FilePlan:
+    """読み込み＋チャンク化＋差分計算（スレッドから呼ぶ。files/existing_by_file は読むだけ）"""
+    fname = os.path.basename(p)
+    existing = existing_by_file.get(fname, set())
+    ent = files.get(fname) or {}
+    old_chunks: Dict[str, str] = ent.get("chunks") or {}
+
+    # mtime/size が同じで、登録済みチャンクも揃っていれば本文を読まない
+    sig = file_signature(p)
+    if (ent.get("mtime") == sig["mtime"] and ent.get("size") == sig["size"]
+            and ent.get("json_mtime") == sig["json_mtime"] and ent.get("json_size") == sig["json_size"]
+            and old_chunks and set(old_chunks) == existing and "spans" in ent
+            and ent.get("meta_version") == METADATA_VERSION):
+        return FilePlan(fname=fname, sig=sig, unchanged=True, n_old=len(old_chunks))
+
+    txt = read_text(p)
+    meta_json = read_sidecar_json(p)
+    meta_sha = sha1_text(json.dumps(meta_json, ensure_ascii=False, sort_keys=True))
+    meta_changed = ent.get("meta_sha1") != meta_sha or ent.get("meta_version") != METADATA_VERSION
+
+    to_embed, to_touch, stale, new_chunks, texts, spans = plan_file(
+        fname, chunker.chunks(txt), old_chunks, ent.get("spans") or [], existing, meta_changed)
+    entry = {**sig, "sha1": sha1_text(txt), "meta_sha1": meta_sha, "meta_version": METADATA_VERSION,
+             "chunks": new_chunks, "spans": [list(sp) for sp in spans]}
+    return FilePlan(fname=fname, sig=sig, texts=texts, spans=spans, meta_json=meta_json, entry=entry,
+                    to_embed=to_embed, to_touch=to_touch, stale=stale)
+
+def start_readers(paths: List[str], files: Dict[str, Dict], existing_by_file: Dict[str, Set[str]], chunker,
+                  out_q: "queue.Queue", stats: StageStats, n_workers: int) -> List[threading.Thread]:
+    """読み込み/チャンク化ワーカー群。全員終わると out_q に _DONE を 1 つ流す"""
+    path_q: "queue.Queue" = queue.Queue()
+    for p in paths:
+        path_q.put(p)
+    remaining = [max(1, n_workers)]
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                try:
+                    p = path_q.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    plan = plan_path(p, files, existing_by_file, chunker)
+                except Exception as e:
+                    print(f"[embed] 読み込み失敗: {p}: {e}")
+                    # 消えたファイルと区別するため、失敗したことを本体に知らせる
+                    plan = FilePlan(fname=os.path.basename(p), sig={}, error=str(e))
+                stats.timed_put("read->queue", out_q, plan)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                out_q.put(_DONE)
+
+    threads = [threading.Thread(target=worker, name=f"embed-read-{i}", daemon=True)
+               for i in range(max(1, n_workers))]
+    for t in threads:
+        t.start()
+    return threads
+
+class Writer(threading.Thread):
+    """Chroma への書き込み（upsert/delete/update）を 1 スレッドに集約し、次バッチのエンコードと重ねる"""
+    def __init__(self, col, in_q: "queue.Queue", stats: StageStats):
+        super().__init__(name="embed-writer", daemon=True)
+        self.col = col
+        self.in_q = in_q
+        self.stats = stats
+        self.added = 0
+        self.deleted = 0
+        self.touched = 0
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        while True:
+            item = self.stats.timed_get("write<-queue", self.in_q)
+            if item is _DONE:
+                return
+            if self.error is not None:
+                continue  # 失敗後は読み捨てて、エンコード側を詰まらせない
+            op, kwargs = item
+            try:
+                if op == "upsert":
+                    # 内容が変わったチャンクは同じ ID のまま置き換える
+                    self.col.upsert(**kwargs)
+                    self.added += len(kwargs["ids"])
+                elif op == "delete":
+                    self.col.delete(**kwargs)
+                    self.deleted += len(kwargs["ids"])
+                elif op == "update":
+                    self.col.update(**kwargs)
+                    self.touched += len(kwargs["ids"])
+            except BaseException as e:
+                self.error = e
+
+class MultiProcessEncoder:
+    """sentence-transformers の multi-process pool を model.encode と同じ形で呼べるようにする"""
+    def __init__(self, model, n_procs: int):
+        self.model = model
+        self.pool = model.start_multi_process_pool(target_devices=["cpu"] * n_procs)
+
+    def encode(self, texts, batch_size: int = 32, **_):
+        return self.model.encode_multi_process(texts, self.pool, batch_size=batch_size)
+
+    def close(self) -> None:
+        self.model.stop_multi_process_pool(self.pool)
+
 # ── main ────────────────────────────────────────────────────────────
-def main() -> None:
-    print(f"[embed] collection={COLLECTION} dir={os.path.abspath(PERSIST_DIR)} model={EMBED_MODEL}")
-    client = PersistentClient(path=PERSIST_DIR)
-    col = client.get_or_create_collection(COLLECTION, metadata={"embedding_model": EMBED_MODEL})
+def main(model: Optional[SentenceTransformer] = None, client: Optional[PersistentClient] = None) -> None:
+    """
+    model / client を渡すとそれを使う（API プロセス内のバックグラウンド取り込みで、
+    読み込み済みのモデルと Chroma クライアントを使い回すため）
+    """
+    live = read_alias(PERSIST_DIR, COLLECTION)
+    print(f"[embed] collection={COLLECTION} (live={live}) dir={os.path.abspath(PERSIST_DIR)} model={EMBED_MODEL}")
+    client = client or PersistentClient(path=PERSIST_DIR)
+    col = client.get_or_create_collection(live, metadata={"embedding_model": EMBED_MODEL})
 
-    total_existing = col.count()
-    if FORCE_REINDEX and total_existing > 0:
-        drop_collection_safely(client, col, COLLECTION)
-        col = client.get_or_create_collection(COLLECTION, metadata={"embedding_model": EMBED_MODEL})
-        print(f"[embed] re-created empty collection: {COLLECTION}")
-        total_existing = 0
+    manifest = load_manifest(MANIFEST_PATH)
+    old_content = content_key(manifest)
+    if manifest.get("model") != EMBED_MODEL:
+        # モデルが変わったらハッシュ一致でも埋め込み直す
+        print(f"[embed] manifest model mismatch ({manifest.get('model')}); 全チャンクを再埋め込みします")
+        manifest = {"model": EMBED_MODEL, "files": {}}
+    # chunker キーが無いのは固定文字数で切っていた頃のマニフェスト
+    old_chunker = manifest.get("chunker", "chars:1200:100")
+    chunker_changed = old_chunker != chunker_signature()
+    if chunker_changed:
+        print(f"[embed] chunker changed ({old_chunker} -> {chunker_signature()}); 全チャンクを作り直します")
+        manifest = {"model": EMBED_MODEL, "files": {}}
+    manifest["chunker"] = chunker_signature()
 
     paths = sorted(glob.glob(os.path.join(ARTICLES_DIR, "*.txt")))
     if not paths:
         print(f"[embed] 入力記事がありません: {ARTICLES_DIR}")
         return
 
+    total_existing = col.count()
+    live_model = (col.metadata or {}).get("embedding_model")
+    rebuild = total_existing > 0 and (FORCE_REINDEX or chunker_changed or live_model not in (None, EMBED_MODEL))
+    previous_count = total_existing
+    if rebuild:
+        # 稼働中のコレクションには触らず、新しい版に全件入れて検証してからエイリアスを切り替える
+        target = versioned_name(COLLECTION)
+        col = client.create_collection(target, metadata={**(col.metadata or {}), "embedding_model": EMBED_MODEL})
+        print(f"[embed] building new collection: {target} (live {live} keeps serving)")
+        total_existing = 0
+        manifest = {"model": EMBED_MODEL, "chunker": chunker_signature(), "files": {}}
+
     existing_ids: Set[str] = set()
     if total_existing > 0:
         existing_ids = paged_get_all_ids(col)
         print(f"[embed] 既存ID読み込み: {len(existing_ids)} 件")
+    existing_by_file = ids_by_file(existing_ids)
+    files: Dict[str, Dict] = manifest["files"]
 
-    model = SentenceTransformer(EMBED_MODEL)
-    print(f"[embed] embedding dim={model.get_sentence_embedding_dimension()}")
+    tracked = {doc_id for ent in files.values() for doc_id in (ent.get("chunks") or {})}
+    untracked = existing_ids - tracked
+    if untracked:
+        recovered = bootstrap_chunk_hashes(col, untracked)
+        for doc_id, h in recovered.items():
+            ent = files.setdefault(doc_id.rsplit("#", 1)[0], {"chunks": {}})
+            ent.setdefault("chunks", {})[doc_id] = h
+        print(f"[embed] マニフェスト未登録のチャンク {len(recovered)} 件のハッシュを復元")
+
+    lex: Optional[LexicalIndex] = None
+    if LEXICAL_INDEX:
+        lex = LexicalIndex() if rebuild else LexicalIndex.load(LEXICAL_INDEX_PATH)
+        synced = sync_lexical(col, lex, existing_ids, files)
+        print(f"[embed] lexical index: {LEXICAL_INDEX_PATH} ({len(lex)} chunks, synced={synced})")
+
+    model = model or load_embedder(EMBED_MODEL, EMBED_BACKEND, EMBED_ONNX_QUANTIZE, EMBED_ONNX_DIR,
+                                   threads=EMBED_THREADS)
+    print(f"[embed] embedding dim={model.get_sentence_embedding_dimension()} "
+          f"backend={describe(EMBED_BACKEND, EMBED_ONNX_QUANTIZE)}")
+    chunker = make_chunker(model)
+    if isinstance(chunker, SentenceChunker):
+        print(f"[embed] chunker: sentence max_tokens={chunker.max_tokens} overlap={chunker.overlap_tokens}")
+    else:
+        print(f"[embed] chunker: chars max={CHUNK_MAX_CHARS} overlap={CHUNK_OVERLAP_CHARS}")
+    cache = EmbeddingCache(EMBED_CACHE_DIR, model_key(EMBED_MODEL, EMBED_BACKEND, EMBED_ONNX_QUANTIZE)) \
+        if EMBED_CACHE else None
+    if cache is not None:
+        print(f"[embed] embedding cache: {cache.dir} ({len(cache)} vectors)")
+    encoder = MultiProcessEncoder(model, ENCODE_PROCESSES) if ENCODE_PROCESSES > 1 else model
+    print(f"[embed] pipeline: readers={READ_WORKERS}, encode_procs={max(1, ENCODE_PROCESSES)}, batch={BATCH_SIZE}")
+
+    stats = StageStats()
+    plan_q: "queue.Queue" = queue.Queue(maxsize=PIPELINE_DEPTH)
+    write_q: "queue.Queue" = queue.Queue(maxsize=WRITE_QUEUE_DEPTH)
+    writer = Writer(col, write_q, stats)
+    writer.start()
+    start_readers(paths, files, existing_by_file, chunker, plan_q, stats, READ_WORKERS)
 
     add_ids: List[str] = []
     add_docs: List[str] = []
     add_metas: List[Dict] = []
 
-    added = 0
+    encoded = 0
     skipped = 0
     files_processed = 0
+    files_unchanged = 0
+    encode_secs = 0.0
+    t_start = time.perf_counter()
+    last_report = t_start
 
     def flush_batch():
-        nonlocal add_ids, add_docs, add_metas, added
+        nonlocal add_ids, add_docs, add_metas, encoded, encode_secs
         if not add_ids:
             return
-        embs = model.encode(add_docs, batch_size=ENCODE_BATCH_SIZE, show_progress_bar=False).tolist()
-        col.add(ids=add_ids, documents=add_docs, metadatas=add_metas, embeddings=embs)
-        added += len(add_ids)
-        print(f"[embed] add: {len(add_ids)} docs (累計 {added})")
+        t0 = time.perf_counter()
+        if cache is not None:
+            embs = cache.encode(encoder, add_docs, batch_size=ENCODE_BATCH_SIZE, show_progress_bar=False).tolist()
+        else:
+            embs = encoder.encode(add_docs, batch_size=ENCODE_BATCH_SIZE, show_progress_bar=False).tolist()
+        encode_secs += time.perf_counter() - t0
+        encoded += len(add_ids)
+        stats.timed_put("encode->write", write_q, ("upsert", {
+            "ids": add_ids, "documents": add_docs, "metadatas": add_metas, "embeddings": embs,
+        }))
+        if lex is not None:
+            lex.add(add_ids, add_docs, [sha1_text(d) for d in add_docs])
         add_ids, add_docs, add_metas = [], [], []
 
-    for p in paths:
-        files_processed += 1
-        txt = read_text(p)
-        if not txt:
-            continue
-        fname = os.path.basename(p)
-        chunks = chunk_text(txt, CHUNK_MAX_CHARS, CHUNK_OVERLAP_CHARS)
-        if not chunks:
-            continue
-
-        meta_json = read_sidecar_json(p)
-
-        for i, ch in enumerate(chunks):
-            doc_id = f"{fname}#{i:03d}"
-            if existing_ids and doc_id in existing_ids:
-                skipped += 1
-                continue
-
-            base_meta = {"filename": fname, "chunk": i}
-            meta = build_flat_metadata(base_meta, meta_json)
-
-            add_ids.append(doc_id)
-            add_docs.append(ch)
-            add_metas.append(meta)
-
-            if len(add_ids) >= BATCH_SIZE:
-                flush_batch()
-
-    flush_batch()
-    print(f"[embed] 完了 files={files_processed}, added={added}, skipped={skipped}, total_in_collection={col.count()}")
+    def report(final: bool = False):
+        elapsed = max(1e-9, time.perf_counter() - t_start)
+        print(f"[embed] {'done' if final else 'progress'}: files {files_processed}/{len(paths)}, "
+              f"encoded={encoded} ({encoded / elapsed:.1f} chunks/s), written={writer.added}, "
+              f"encode={encode_secs:.1f}s wait[{stats.summary()}]")
+
+    seen_files: Set[str] = set()
+    failed_files: List[str] = []
+    try:
+        while True:
+            plan = stats.timed_get("encode<-read", plan_q)
+            if plan is _DONE:
+                break
+            files_processed += 1
+            seen_files.add(plan.fname)
+            if writer.error is not None:
+                raise writer.error
+
+            if plan.error is not None:
+                # 読めなかったファイルは前回の内容のまま残す（seen_files に入れて削除対象から外す）
+                failed_files.append(plan.fname)
+            elif plan.unchanged:
+                files_unchanged += 1
+                skipped += plan.n_old
+            else:
+                fname = plan.fname
+                skipped += len(plan.spans) - len(plan.to_embed) - len(plan.to_touch)
+                if plan.stale:
+                    stats.timed_put("encode->write", write_q, ("delete", {"ids": plan.stale}))
+                    if lex is not None:
+                        lex.remove(plan.stale)
+                if plan.to_touch:
+                    # 本文が同じでサイドカーだけ変わったチャンクはメタだけ更新（再エンコードしない）
+                    stats.timed_put("encode->write", write_q, ("update", {
+                        "ids": [f"{fname}#{i:03d}" for i in plan.to_touch],
+                        "metadatas": [build_flat_metadata(chunk_meta(fname, i, plan.spans[i]), plan.meta_json)
+                                      for i in plan.to_touch],
+                    }))
+                for i in plan.to_embed:
+                    add_ids.append(f"{fname}#{i:03d}")
+                    add_docs.append(plan.texts[i])
+                    add_metas.append(build_flat_metadata(chunk_meta(fname, i, plan.spans[i]), plan.meta_json))
+                    if len(add_ids) >= BATCH_SIZE:
+                        flush_batch()
+                files[fname] = plan.entry
+
+            if time.perf_counter() - last_report >= PROGRESS_SECS:
+                last_report = time.perf_counter()
+                report()
+
+        flush_batch()
+
+        # 記事ファイル自体が消えたものはチャンクごと削除
+        for fname in sorted((set(files) | set(existing_by_file)) - seen_files):
+            gone = sorted(existing_by_file.get(fname, set()))
+            if gone:
+                stats.timed_put("encode->write", write_q, ("delete", {"ids": gone}))
+                if lex is not None:
+                    lex.remove(gone)
+            files.pop(fname, None)
+    finally:
+        write_q.put(_DONE)
+        writer.join()
+        if encoder is not model:
+            encoder.close()
+    if writer.error is not None:
+        raise writer.error
+
+    report(final=True)
+    if failed_files and rebuild:
+        # 新しい版には読めなかった記事が入っていないので、切り替えずに止める
+        client.delete_collection(col.name)
+        print(f"[embed] {col.name} を破棄しました（{live} のまま）")
+        raise RuntimeError(f"読み込みに失敗したファイルがあります ({len(failed_files)} 件): "
+                           f"{', '.join(failed_files[:5])}")
+    if rebuild:
+        try:
+            validate_collection(col, expected=writer.added - writer.deleted, previous=previous_count)
+        except RuntimeError:
+            client.delete_collection(col.name)
+            print(f"[embed] {col.name} を破棄しました（{live} のまま）")
+            raise
+    save_manifest(MANIFEST_PATH, manifest)
+
+    def save_lexical() -> None:
+        if lex is not None and (lex.dirty or not os.path.exists(LEXICAL_INDEX_PATH)):
+            lex.save(LEXICAL_INDEX_PATH)
+            print(f"[embed] lexical index saved: {len(lex)} chunks, {len(lex.vocab)} terms")
+
+    # 作り直しのときは BM25 を切り替えの後で保存する（共有のパスなので、先に書くと稼働中の旧版と食い違う。
+    # 保存前に落ちても次回の sync_lexical が Chroma に合わせて直す）
+    if not rebuild:
+        save_lexical()
+    changed = bool(writer.added or writer.deleted or writer.touched)
+    if rebuild:
+        # 作り直しても中身が同じなら回答キャッシュは捨てない（切り替え直後にキャッシュが空にならない）
+        changed = content_key(manifest) != old_content
+    if VECTOR_SNAPSHOT and (changed or not os.path.exists(pointer_path(PERSIST_DIR, COLLECTION))):
+        t0 = time.perf_counter()
+        snap_dir = export_snapshot(col, PERSIST_DIR, COLLECTION, EMBED_MODEL, unit_dtype=VECTOR_SNAPSHOT_DTYPE,
+                                   ann=ANN_INDEX, ann_min_rows=ANN_MIN_ROWS)
+        print(f"[embed] vector snapshot: {snap_dir} ({time.perf_counter() - t0:.1f}s)")
+    if rebuild:
+        # API はエイリアスを読み直して次の検索から新しい版を使う。旧版はすぐには消さない
+        promote(PERSIST_DIR, COLLECTION, col.name, bump=changed)
+        print(f"[embed] promoted {col.name} (was {live})")
+        save_lexical()
+        gc_collections(client, COLLECTION, col.name, COLLECTION_KEEP)
+    elif changed:
+        # API 側の回答キャッシュなどに内容の変更を知らせる
+        bump_version(PERSIST_DIR, COLLECTION)
+    print(f"[embed] 完了 files={files_processed} (unchanged={files_unchanged}, failed={len(failed_files)}), "
+          f"added={writer.added}, "
+          f"updated_meta={writer.touched}, deleted={writer.deleted}, skipped={skipped}, "
+          f"total_in_collection={col.count()}")
+    if cache is not None:
+        print(f"[embed] embedding cache hits={cache.hits} misses={cache.misses}")
 
 if __name__ == "__main__":
     main()
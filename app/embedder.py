@@ -0,0 +1,121 @@
+# embedder.py
+"""
+埋め込みモデルの読み込み（main.py / embed_articles.py / app.py 共通）。
+
+- torch: 従来どおり SentenceTransformer(EMBED_MODEL)
+- onnx : ONNX Runtime で推論する SentenceTransformer(backend="onnx")。初回に ONNX へ書き出して
+         <EMBED_ONNX_DIR>/<model>/ に保存し、次からはそれを読むだけ（起動のたびに書き出さない）。
+         EMBED_ONNX_QUANTIZE=avx2 などで動的 int8 量子化したモデル（onnx/model_qint8_<config>.onnx）を使う
+
+どちらも encode / tokenizer / max_seq_length / start_multi_process_pool など同じ API。
+int8 はベクトルが少しずれるので、埋め込みキャッシュのキーは model_key() で分ける。
+精度と速度は bench/bench_embed_backends.py で確認する。
+
+onnx には optimum と onnxruntime が要る（pip install "sentence-transformers[onnx]"）。
+"""
+import os
+import shutil
+import importlib.util
+import logging
+from typing import Any, Dict
+
+from embedding_cache import _model_slug
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("torch", "onnx")
+QUANTIZE_CONFIGS = ("arm64", "avx2", "avx512", "avx512_vnni")
+
+
+def model_key(model_name: str, backend: str = "torch", quantize: str = "") -> str:
+    """埋め込みキャッシュのキー。fp32 の ONNX は torch と同じベクトルになるので同じキーにする"""
+    if backend == "onnx" and quantize:
+        return f"{model_name}#onnx-qint8-{quantize}"
+    return model_name
+
+
+def onnx_file_name(quantize: str = "") -> str:
+    return f"onnx/model_qint8_{quantize}.onnx" if quantize else "onnx/model.onnx"
+
+
+def export_onnx(model_name: str, cache_dir: str, quantize: str = "") -> str:
+    """
+    ONNX に書き出したモデルのディレクトリを返す（書き出し済みならそのまま）。
+    一時ディレクトリに書いてから rename するので、複数プロセスが同時に書き出しても壊れたものは読まない
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    out = os.path.join(cache_dir, _model_slug(model_name))
+    fname = onnx_file_name(quantize)
+    if os.path.exists(os.path.join(out, fname)):
+        return out
+
+    tmp = f"{out}.tmp.{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    if os.path.exists(os.path.join(out, onnx_file_name())):
+        shutil.copytree(out, tmp)  # fp32 は書き出し済みで、量子化版だけ足す
+        model = SentenceTransformer(tmp, backend="onnx", device="cpu")
+    else:
+        log.info(f"[embedder] exporting {model_name} to ONNX: {out}")
+        model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+        model.save(tmp)
+    if quantize:
+        log.info(f"[embedder] quantizing {model_name} (qint8, {quantize})")
+        export_dynamic_quantized_onnx_model(model, quantize, tmp)
+    os.makedirs(cache_dir, exist_ok=True)
+    old = f"{out}.old.{os.getpid()}"
+    if os.path.exists(out):
+        os.replace(out, old)
+    try:
+        os.replace(tmp, out)
+    except OSError:
+        # 別プロセスが先に置いた
+        shutil.rmtree(tmp, ignore_errors=True)
+    shutil.rmtree(old, ignore_errors=True)
+    return out
+
+
+def _session_options(threads: int) -> Dict[str, Any]:
+    if threads <= 0:
+        return {}
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = threads
+    opts.inter_op_num_threads = 1
+    return {"session_options": opts}
+
+
+def load_embedder(model_name: str, backend: str = "torch", quantize: str = "", cache_dir: str = "",
+                  threads: int = 0):
+    """backend に応じた SentenceTransformer を返す。threads は ONNX Runtime の推論スレッド数（0 で既定）"""
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS:
+        raise ValueError(f"EMBED_BACKEND must be one of {BACKENDS}: {backend}")
+    if quantize and quantize not in QUANTIZE_CONFIGS:
+        raise ValueError(f"EMBED_ONNX_QUANTIZE must be one of {QUANTIZE_CONFIGS}: {quantize}")
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+
+    if not onnx_available():
+        raise RuntimeError('EMBED_BACKEND=onnx には optimum / onnxruntime が必要です '
+                           '(pip install "sentence-transformers[onnx]")')
+    path = export_onnx(model_name, cache_dir, quantize)
+    model_kwargs: Dict[str, Any] = {"file_name": onnx_file_name(quantize), "provider": "CPUExecutionProvider"}
+    model_kwargs.update(_session_options(threads))
+    return SentenceTransformer(path, backend="onnx", device="cpu", model_kwargs=model_kwargs)
+
+
+def onnx_available() -> bool:
+    """optimum.onnxruntime が入っているか（import はしない）"""
+    try:
+        return importlib.util.find_spec("optimum.onnxruntime") is not None
+    except ImportError:  # optimum 自体が無い
+        return False
+
+
+def describe(backend: str, quantize: str = "") -> str:
+    if backend == "onnx":
+        return f"onnx ({'qint8/' + quantize if quantize else 'fp32'})"
+    return backend
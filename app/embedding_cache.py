@@ -0,0 +1,219 @@
+# embedding_cache.py
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:  # プロセス間の追記排他（Linux/macOS）。無ければプロセス内ロックのみ
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _model_slug(model_name: str) -> str:
+    short = re.sub(r"[^A-Za-z0-9._-]+", "_", model_name)[-48:]
+    return f"{short}-{hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:8]}"
+
+
+class EmbeddingCache:
+    """
+    (モデル名, sha1(テキスト)) → float32 ベクトル の永続キャッシュ。
+
+    <root>/<model>/vectors.f32 : 行優先の float32 生データ（追記のみ、読み出しは np.memmap）
+    <root>/<model>/keys.txt    : 各行の sha1（行番号 = vectors の行番号）
+    <root>/<model>/meta.json   : {"model", "dim"}
+
+    チャンク分割の設定変更やコレクション再構築で同じテキストを再エンコードしないためのもの。
+    ベクトルを先に書いてからキーを追記するので、途中で落ちてもキーが未書き込みの行を指すことはない。
+    """
+
+    def __init__(self, root: str, model_name: str):
+        self.model_name = model_name
+        self.dir = os.path.join(root, _model_slug(model_name))
+        os.makedirs(self.dir, exist_ok=True)
+        self._vec_path = os.path.join(self.dir, "vectors.f32")
+        self._keys_path = os.path.join(self.dir, "keys.txt")
+        self._meta_path = os.path.join(self.dir, "meta.json")
+        self._lock = threading.Lock()
+        self._index: Dict[str, int] = {}
+        self._keys_offset = 0
+        self._dim: Optional[int] = None
+        self._mmap: Optional[np.memmap] = None
+        self.hits = 0
+        self.misses = 0
+        with self._lock:
+            self._refresh()
+
+    # ── 内部 ──────────────────────────────────────────────────────────
+    @contextmanager
+    def _file_lock(self):
+        with open(os.path.join(self.dir, ".lock"), "a") as lf:
+            if fcntl:
+                fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def _refresh(self) -> None:
+        """他プロセスが追記した分を取り込み、memmap を張り直す"""
+        if self._dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                self._dim = int(json.load(f)["dim"])
+        if self._dim is None or not os.path.exists(self._keys_path):
+            return
+        with open(self._keys_path, "r", encoding="ascii") as f:
+            f.seek(self._keys_offset)
+            tail = f.read()
+        # 書きかけの最終行は次回に回す
+        complete = tail[:tail.rfind("\n") + 1]
+        row = len(self._index)
+        for key in complete.splitlines():
+            self._index[key] = row
+            row += 1
+        self._keys_offset += len(complete)
+        rows = len(self._index)
+        if rows and (self._mmap is None or self._mmap.shape[0] != rows):
+            self._mmap = np.memmap(self._vec_path, dtype=np.float32, mode="r", shape=(rows, self._dim))
+
+    def _append(self, keys: List[str], vecs: np.ndarray) -> None:
+        with self._file_lock():
+            self._refresh()
+            fresh, seen = [], set()
+            for i, k in enumerate(keys):
+                if k not in self._index and k not in seen:
+                    fresh.append(i)
+                    seen.add(k)
+            if not fresh:
+                return
+            if self._dim is None:
+                self._dim = int(vecs.shape[1])
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model_name, "dim": self._dim}, f)
+            rows = len(self._index)
+            with open(self._vec_path, "ab") as f:
+                # キー未登録のまま残った行（前回の中断など）は切り捨ててから追記
+                f.truncate(rows * self._dim * 4)
+                f.write(np.ascontiguousarray(vecs[fresh], dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._keys_path, "a", encoding="ascii") as f:
+                f.write("".join(keys[i] + "\n" for i in fresh))
+            self._refresh()
+
+    # ── 公開 API ─────────────────────────────────────────────────────
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        keys = [text_key(t) for t in texts]
+        with self._lock:
+            if any(k not in self._index for k in keys):
+                self._refresh()
+            out: List[Optional[np.ndarray]] = []
+            for k in keys:
+                row = self._index.get(k)
+                out.append(np.array(self._mmap[row]) if row is not None else None)
+        return out
+
+    def put_many(self, texts: Sequence[str], vecs) -> None:
+        arr = np.asarray(vecs, dtype=np.float32)
+        if arr.ndim != 2 or len(texts) != arr.shape[0]:
+            raise ValueError("texts と vecs の件数が一致しません")
+        with self._lock:
+            self._append([text_key(t) for t in texts], arr)
+
+    def encode(self, model, texts: Sequence[str], **encode_kwargs) -> np.ndarray:
+        """キャッシュを引き、無いものだけ model.encode して保存する。戻り値は (n, dim) の float32"""
+        texts = list(texts)
+        cached = self.get_many(texts)
+        miss_idx = [i for i, v in enumerate(cached) if v is None]
+        self.hits += len(texts) - len(miss_idx)
+        self.misses += len(miss_idx)
+        if miss_idx:
+            miss_texts = [texts[i] for i in miss_idx]
+            encoded = np.asarray(model.encode(miss_texts, **encode_kwargs), dtype=np.float32)
+            self.put_many(miss_texts, encoded)
+            for j, i in enumerate(miss_idx):
+                cached[i] = encoded[j]
+        if not cached:
+            return np.zeros((0, self._dim or 0), dtype=np.float32)
+        return np.stack(cached).astype(np.float32, copy=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses, "dir": self.dir}
+
+
+class QueryEmbeddingCache:
+    """
+    API のクエリ埋め込み用。永続キャッシュ（embed_articles.py が作ったもの）は読むだけで、
+    新しいクエリのベクトルはプロセス内の件数上限つき LRU にだけ置く。
+    ユーザーの質問は際限なく増えてほとんど繰り返されないので、ディスクへの追記（fsync・ファイルロック）を
+    リクエストの経路に入れない。
+    """
+
+    def __init__(self, store: EmbeddingCache, max_entries: int = 10000):
+        self.store = store
+        self.max_entries = max(0, max_entries)
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_memory(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        with self._lock:
+            out: List[Optional[np.ndarray]] = []
+            for k in keys:
+                v = self._lru.get(k)
+                if v is not None:
+                    self._lru.move_to_end(k)
+                out.append(v)
+            return out
+
+    def _put_memory(self, items: List[Tuple[str, np.ndarray]]) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            for k, v in items:
+                self._lru[k] = v
+                self._lru.move_to_end(k)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def encode(self, model, texts: Sequence[str], **encode_kwargs) -> np.ndarray:
+        """プロセス内 LRU → 永続キャッシュ（読むだけ）→ model.encode の順。戻り値は (n, dim) の float32"""
+        texts = list(texts)
+        keys = [text_key(t) for t in texts]
+        out = self._get_memory(keys)
+        rest = [i for i, v in enumerate(out) if v is None]
+        if rest:
+            for i, v in zip(rest, self.store.get_many([texts[i] for i in rest])):
+                out[i] = v
+        miss_idx = [i for i, v in enumerate(out) if v is None]
+        self.hits += len(texts) - len(miss_idx)
+        self.misses += len(miss_idx)
+        if miss_idx:
+            encoded = np.asarray(model.encode([texts[i] for i in miss_idx], **encode_kwargs), dtype=np.float32)
+            for j, i in enumerate(miss_idx):
+                out[i] = encoded[j]
+        self._put_memory([(keys[i], out[i]) for i in rest])
+        if not out:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(out).astype(np.float32, copy=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            memory = len(self._lru)
+        return {"entries": len(self.store), "memory_entries": memory, "memory_max": self.max_entries,
+                "hits": self.hits, "misses": self.misses, "dir": self.store.dir}
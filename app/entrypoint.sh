@@ -3,12 +3,23 @@ set -e
 
 cd /app
 
-echo "[entrypoint] embed_articles.py を実行してコレクションを用意します（既存ならスキップされます）..."
-if [ -f ./embed_articles.py ]; then
-  # 埋め込みスクリプトは idempotent（既存ならスキップ）にしてある想定
-  python embed_articles.py || echo "[entrypoint] embed_articles.py 実行でエラー（続行します）"
+# INGEST_MODE:
+#   blocking … 起動前に embed_articles.py を実行（従来どおり。既定）
+#   off      … 実行しない（UI コンテナや、API 側で INGEST_ON_STARTUP=1 にして裏で取り込む場合）
+INGEST_MODE="${INGEST_MODE:-blocking}"
+
+if [ "$INGEST_MODE" = "blocking" ]; then
+  echo "[entrypoint] embed_articles.py を実行してコレクションを用意します（既存ならスキップされます）..."
+  if [ -f ./embed_articles.py ]; then
+    # 埋め込みスクリプトは idempotent（既存ならスキップ）にしてある想定
+    START=$(date +%s)
+    python embed_articles.py || echo "[entrypoint] embed_articles.py 実行でエラー（続行します）"
+    echo "[entrypoint] embed_articles.py: $(( $(date +%s) - START ))s"
+  else
+    echo "[entrypoint] embed_articles.py が見つかりません。スキップします。"
+  fi
 else
-  echo "[entrypoint] embed_articles.py が見つかりません。スキップします。"
+  echo "[entrypoint] INGEST_MODE=${INGEST_MODE}: 起動前の取り込みはスキップします"
 fi
 
 echo "[entrypoint] アプリを起動します..."
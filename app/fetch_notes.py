@@ -1,16 +1,19 @@
 # fetch_notes.py
 import os
-import re
 import json
 import time
+import hashlib
+import threading
 import datetime as dt
-from typing import Dict, Any, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, List, Tuple, Optional
 
 import requests
-from bs4 import BeautifulSoup
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+import html_extract
+
 # ── 環境変数（必要に応じて .env で設定） ──────────────────────────────────
 USER_ID: str = os.environ.get("NOTE_USER_ID", "hinataptyan")
 
@@ -21,18 +24,32 @@ MAX_PAGES = int(MAX_PAGES_ENV) if MAX_PAGES_ENV and MAX_PAGES_ENV.isdigit() else
 # 既存ファイルがあればスキップ（デフォルト: True）
 SKIP_EXISTING: bool = os.environ.get("SKIP_EXISTING", "1") == "1"
 
-# 1リクエスト毎の待機（APIに優しく）
+# 1リクエスト毎の待機（APIに優しく）。FETCH_RATE 未指定時はここから秒間リクエスト数を決める
 SLEEP_SECS: float = float(os.environ.get("SLEEP_SECS", "0.3"))
 
+# 並行取得：同時に投げる詳細リクエスト数と、全リクエスト合計の上限（req/s, トークンバケット）
+FETCH_CONCURRENCY: int = int(os.environ.get("FETCH_CONCURRENCY", "4"))
+_rate_env = os.environ.get("FETCH_RATE")
+FETCH_RATE: float = float(_rate_env) if _rate_env else (1.0 / SLEEP_SECS if SLEEP_SECS > 0 else 0.0)
+FETCH_BURST: int = int(os.environ.get("FETCH_BURST", str(FETCH_CONCURRENCY)))
+
+# 差分取得：記事ごとの updated_at / ETag / Last-Modified / 本文ハッシュを保存するファイル
+FETCH_STATE_PATH: str = os.environ.get("FETCH_STATE_PATH", "")  # 空なら <ARTICLES_DIR>/.fetch_state.json
+# 一覧の 1 ページ分がすべて前回同期より古ければ、それ以降のページを取りに行かない
+STOP_AT_LAST_SYNC: bool = os.environ.get("STOP_AT_LAST_SYNC", "0") == "1"
+
 # ファイル名最大長（拡張子抜き）
 FNAME_MAXLEN: int = int(os.environ.get("FNAME_MAXLEN", "96"))
 
 SAVE_DIR: str = os.environ.get("ARTICLES_DIR", "articles")
 os.makedirs(SAVE_DIR, exist_ok=True)
+FETCH_STATE_PATH = FETCH_STATE_PATH or os.path.join(SAVE_DIR, ".fetch_state.json")
 
 # ── API エンドポイント ───────────────────────────────────────────────────
-BASE_LIST: str  = f"https://note.com/api/v2/creators/{USER_ID}/contents?kind=note&page={{page}}"
-DETAIL_URL: str = "https://note.com/api/v3/notes/{key}"
+# NOTE_API_BASE はローカルのスタブサーバ（note_api_stub.py）で試すときに差し替える
+NOTE_API_BASE: str = os.environ.get("NOTE_API_BASE", "https://note.com").rstrip("/")
+BASE_LIST: str  = f"{NOTE_API_BASE}/api/v2/creators/{USER_ID}/contents?kind=note&page={{page}}"
+DETAIL_URL: str = f"{NOTE_API_BASE}/api/v3/notes/{{key}}"
 
 # 実ブラウザっぽい UA を付与（ブロック回避の一助）
 DEFAULT_HEADERS = {
@@ -41,7 +58,7 @@ DEFAULT_HEADERS = {
 }
 
 # ── HTTP セッション（リトライ/タイムアウト） ────────────────────────────
-def make_session() -> requests.Session:
+def make_session(pool_size: int = 10) -> requests.Session:
     s = requests.Session()
     retry = Retry(
         total=5,
@@ -53,67 +70,133 @@ def make_session() -> requests.Session:
         allowed_methods=["GET"],
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    # 並行取得でも接続を使い回せるよう、プールはワーカー数以上にする
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
     s.mount("http://", adapter)
     s.mount("https://", adapter)
     s.headers.update(DEFAULT_HEADERS)
     return s
 
+# ── レート制御 ──────────────────────────────────────────────────────────
+class TokenBucket:
+    """
+    スレッドセーフなトークンバケット。rate 個/秒で補充、最大 burst 個まで貯まる。
+    rate <= 0 なら制限なし。
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def limited_get(sess: requests.Session, limiter: TokenBucket, url: str, **kwargs) -> requests.Response:
+    limiter.acquire()
+    return sess.get(url, timeout=(5, 20), **kwargs)
+
+# ── 取得状態（差分取得用） ──────────────────────────────────────────────
+def parse_ts(v: Any) -> Optional[dt.datetime]:
+    """note の日時文字列を aware datetime に（タイムゾーン無しはローカル時刻とみなす）"""
+    if not v or not isinstance(v, str):
+        return None
+    try:
+        t = dt.datetime.fromisoformat(v.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return t if t.tzinfo else t.astimezone()
+
+
+class FetchState:
+    """
+    記事キー → {updated_at, etag, last_modified, sha1, path} と、前回の同期時刻。
+    ワーカースレッドから更新されるのでロックで守る。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        data: Dict[str, Any] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f) or {}
+        except (OSError, ValueError):
+            pass
+        self.last_sync: Optional[str] = data.get("last_sync")
+        self.notes: Dict[str, Dict[str, Any]] = data.get("notes") or {}
+        self.failures = 0
+
+    def failed(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+    def get(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.notes.get(key) or {})
+
+    def update(self, key: str, **fields) -> None:
+        with self._lock:
+            self.notes.setdefault(key, {}).update({k: v for k, v in fields.items() if v is not None})
+
+    def save(self, last_sync: Optional[str] = None) -> None:
+        with self._lock:
+            if last_sync:
+                self.last_sync = last_sync
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"last_sync": self.last_sync, "notes": self.notes}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.path)
+
+
+def note_timestamps(c: Dict[str, Any]) -> Tuple[Any, Any]:
+    # Note API 側の日時キーは揺れる可能性があるため候補を横断的に拾う
+    published_at = pick_first(c, ["publishedAt", "publishAt", "published_at", "publish_at", "createdAt", "created_at"])
+    updated_at   = pick_first(c, ["updatedAt", "updated_at"])
+    return published_at, updated_at
+
+
+def page_older_than(contents: List[Dict[str, Any]], since: Optional[str]) -> bool:
+    """ページ内の全記事が since より前に公開/更新されていれば True（判定不能な記事があれば False）"""
+    limit = parse_ts(since)
+    if limit is None or not contents:
+        return False
+    for c in contents:
+        published_at, updated_at = note_timestamps(c)
+        stamps = [t for t in (parse_ts(published_at), parse_ts(updated_at)) if t is not None]
+        if not stamps or max(stamps) >= limit:
+            return False
+    return True
+
 # ── テキスト化＆リンク抽出 ────────────────────────────────────────────────
-ABS_HTTP = re.compile(r"^https?://", re.IGNORECASE)
+# "stream"（既定, 1 パス）または "bs4"（従来の BeautifulSoup 実装）。出力は同一
+HTML_EXTRACT_ENGINE: str = os.environ.get("HTML_EXTRACT_ENGINE", "stream")
+_extract = html_extract.get_engine(HTML_EXTRACT_ENGINE)
 
 def clean_text_and_extract_links(html: str) -> Tuple[str, List[str]]:
     """
     HTMLをざっくりテキスト化し、<figure> と 通常の <a> のリンクを抽出。
     - <figure> は本文から除去（data-src を優先、無ければ内部の <a href>）
-    - 通常の <a> は href を収集し、aタグ自体は unwrap（テキストは残す）
+    - 通常の <a> は href を収集（テキストは残す）
     - <script>/<style> は除去
     - 連続改行や空白を正規化
     戻り値: (テキスト本文, 抽出リンク配列[絶対HTTPのみ])
     """
-    soup = BeautifulSoup(html or "", "html.parser")
-
-    # 余計な属性を削除（必要なければ削ってOK）
-    for tag in soup.find_all(True):
-        tag.attrs.pop("name", None)
-        tag.attrs.pop("id",   None)
-
-    links: List[str] = []
-    seen: Set[str] = set()
-
-    # 1) figure の抽出（data-src 優先、なければ中の a[href]）
-    for fig in soup.find_all("figure"):
-        url = fig.get("data-src")
-        if not url:
-            a = fig.find("a", href=True)
-            url = a["href"] if a else None
-        if url and ABS_HTTP.match(url) and url not in seen:
-            links.append(url)
-            seen.add(url)
-        fig.decompose()  # 本文からは除去
-
-    # 2) script/style の除去
-    for tag in soup(["script", "style"]):
-        tag.decompose()
-
-    # 3) 通常の a[href] を抽出しつつ a タグだけ除去（テキストは残す）
-    for a in soup.find_all("a", href=True):
-        href = a["href"]
-        if ABS_HTTP.match(href) and href not in seen:
-            links.append(href)
-            seen.add(href)
-        a.unwrap()
-
-    # 4) テキスト化
-    text = soup.get_text(separator="\n")
-
-    # 5) 空行・空白を正規化
-    text = re.sub(r"\r\n?", "\n", text)          # CRLF→LF
-    text = re.sub(r"\n{2,}", "\n\n", text)       # 2連以上の改行は2つに
-    lines = [line.strip() for line in text.splitlines()]
-    clean = "\n".join(line for line in lines if line)
-
-    return clean, links
+    return _extract(html)
 
 # ── ユーティリティ ────────────────────────────────────────────────────────
 def sanitize_filename(s: str, max_len: int = 96) -> str:
@@ -140,107 +223,189 @@ def save_files(basepath: str, title: str, body: str, meta: Dict[str, Any]) -> No
         json.dump(meta, f, ensure_ascii=False, indent=2)
 
 # ── メイン処理 ────────────────────────────────────────────────────────────
-def main() -> None:
-    sess = make_session()
-    page = 1
-    total = 0
-    started_at = dt.datetime.now().isoformat(timespec="seconds")
+def fetch_list(sess: requests.Session, limiter: TokenBucket, page: int) -> Tuple[str, Dict[str, Any]]:
+    url = BASE_LIST.format(page=page)
+    print(f"[INFO] Fetching list: {url}")
+    resp = limited_get(sess, limiter, url)
+    resp.raise_for_status()
+    return url, (resp.json() or {}).get("data", {})
 
-    print(f"[INFO] Fetch start: user={USER_ID}, dir={SAVE_DIR}, started_at={started_at}")
 
-    while True:
-        if MAX_PAGES and page > MAX_PAGES:
-            print(f"[INFO] Reached MAX_PAGES={MAX_PAGES}, stop.")
-            break
-
-        url = BASE_LIST.format(page=page)
-        print(f"[INFO] Fetching list: {url}")
+def process_note(sess: requests.Session, limiter: TokenBucket, state: FetchState,
+                 c: Dict[str, Any], page: int, list_url: str) -> bool:
+    """
+    1 記事分の詳細取得→テキスト化→保存。保存したら True（ワーカースレッドから呼ぶ）。
+    取得状態と一覧の updated_at を詳細リクエストの「前」に照合し、変化が無ければ取りに行かない。
+    変化があれば ETag / Last-Modified 付きの条件付きリクエストで取り直す。
+    """
+    title    = c.get("name") or "no_title"
+    note_key = c.get("key")
+    slug     = c.get("slug") or str(c.get("id") or "")
+
+    if not note_key:
+        print("[WARN] Skip: note_key missing")
+        return False
+
+    published_at, updated_at = note_timestamps(c)
+    prev = state.get(note_key)
+
+    # 既知の記事は以前のファイル名を使い続ける（ページ番号がずれても上書き先が変わらない）
+    if prev.get("path") and os.path.exists(prev["path"] + ".txt"):
+        base = prev["path"]
+    else:
+        # ファイル名（pageとslugで安定化、slugはサニタイズ＋長さ制限）
+        safe_slug = sanitize_filename(slug, max_len=FNAME_MAXLEN)
+        base = f"{SAVE_DIR}/{page:02d}_{safe_slug}"
+        prev = {}
+    txt_path = base + ".txt"
+
+    headers: Dict[str, str] = {}
+    if SKIP_EXISTING and os.path.exists(txt_path):
+        if not prev:
+            # 取得状態が無い既存ファイル（旧バージョンで保存済み）は従来どおりスキップし、状態だけ記録
+            state.update(note_key, path=base, updated_at=updated_at)
+            print(f"[SKIP] Exists: {txt_path}")
+            return False
+        if updated_at and prev.get("updated_at") == updated_at:
+            print(f"[SKIP] Unchanged: {txt_path}")
+            return False
+        if prev.get("etag"):
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified"):
+            headers["If-Modified-Since"] = prev["last_modified"]
+
+    # 詳細API
+    try:
+        det = limited_get(sess, limiter, DETAIL_URL.format(key=note_key), headers=headers)
+        if det.status_code == 304:
+            state.update(note_key, updated_at=updated_at)
+            print(f"[SKIP] Not modified: {txt_path}")
+            return False
+        det.raise_for_status()
+        det_json = det.json() or {}
+    except Exception as e:
+        print(f"[WARN] Detail request failed (key={note_key}): {e}")
+        state.failed()
+        return False
+
+    html = (det_json.get("data") or {}).get("body", "") or ""
+    clean_body, links = clean_text_and_extract_links(html)
+
+    # 本文が前回と同一ならファイルを書き換えない（embed 側の mtime 判定でスキップさせる）
+    body_sha = hashlib.sha1(f"{title}\n{clean_body}".encode("utf-8")).hexdigest()
+    cache_fields = {
+        "path": base,
+        "updated_at": updated_at,
+        "etag": det.headers.get("ETag"),
+        "last_modified": det.headers.get("Last-Modified"),
+        "sha1": body_sha,
+    }
+    if prev.get("sha1") == body_sha and os.path.exists(txt_path):
+        state.update(note_key, **cache_fields)
+        print(f"[SKIP] Same content: {txt_path}")
+        return False
+
+    # メタデータを拡充
+    canonical_url = f"https://note.com/{USER_ID}/n/{note_key}"
+
+    meta = {
+        "user_id": USER_ID,
+        "title": title,
+        "slug": slug,
+        "key": note_key,
+        "page": page,
+        "source": {
+            "list_api": list_url,
+            "detail_api": DETAIL_URL.format(key=note_key),
+            "canonical": canonical_url,
+        },
+        "timestamps": {
+            "published_at": published_at,
+            "updated_at": updated_at,
+            "downloaded_at": dt.datetime.now().isoformat(timespec="seconds"),
+        },
+        "link_count": len(links),
+        "links": links,
+        "length": len(clean_body),
+    }
+
+    # 保存
+    save_files(base, title, clean_body, meta)
+    state.update(note_key, **cache_fields)
+    print(f"[OK] Saved: {txt_path}")
+    return True
+
+
+def _drain(futures: List[Future]) -> int:
+    saved = 0
+    for f in futures:
         try:
-            resp = sess.get(url, timeout=(5, 20))
-            resp.raise_for_status()
+            saved += 1 if f.result() else 0
         except Exception as e:
-            print(f"[WARN] List request failed (page={page}): {e}")
-            break
+            print(f"[WARN] Note processing failed: {e}")
+    return saved
+
 
-        data = (resp.json() or {}).get("data", {})
-        contents = data.get("contents", [])
-        if not contents:
-            print("[INFO] No more articles found.")
-            break
+def main() -> None:
+    sess = make_session(pool_size=FETCH_CONCURRENCY + 2)
+    limiter = TokenBucket(FETCH_RATE, burst=FETCH_BURST)
+    state = FetchState(FETCH_STATE_PATH)
+    page = 1
+    total = 0
+    completed = True
+    started_at = dt.datetime.now().astimezone().isoformat(timespec="seconds")
+    t0 = time.perf_counter()
 
-        for c in contents:
-            title    = c.get("name") or "no_title"
-            note_key = c.get("key")
-            slug     = c.get("slug") or str(c.get("id") or "")
+    print(f"[INFO] Fetch start: user={USER_ID}, dir={SAVE_DIR}, started_at={started_at}, "
+          f"concurrency={FETCH_CONCURRENCY}, rate={FETCH_RATE or 'unlimited'}/s, last_sync={state.last_sync}")
 
-            if not note_key:
-                print("[WARN] Skip: note_key missing")
-                continue
+    # 詳細取得は複数スレッドで重ね、次の一覧ページは詳細の処理中に先読みする
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="note-detail") as details, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="note-list") as lists:
+        next_list: Optional[Future] = lists.submit(fetch_list, sess, limiter, page)
+        pending: List[Future] = []
 
-            # 詳細API
+        while next_list is not None:
             try:
-                det = sess.get(DETAIL_URL.format(key=note_key), timeout=(5, 20))
-                det.raise_for_status()
-                det_json = det.json() or {}
+                url, data = next_list.result()
             except Exception as e:
-                print(f"[WARN] Detail request failed (key={note_key}): {e}")
-                continue
-
-            html = (det_json.get("data") or {}).get("body", "") or ""
-            clean_body, links = clean_text_and_extract_links(html)
-
-            # ファイル名（pageとslugで安定化、slugはサニタイズ＋長さ制限）
-            safe_slug = sanitize_filename(slug, max_len=FNAME_MAXLEN)
-            base = f"{SAVE_DIR}/{page:02d}_{safe_slug}"
-            txt_path = base + ".txt"
-            json_path = base + ".json"
-
-            if SKIP_EXISTING and os.path.exists(txt_path):
-                print(f"[SKIP] Exists: {txt_path}")
-                continue
-
-            # メタデータを拡充
-            # Note API 側の日時キーは揺れる可能性があるため候補を横断的に拾う
-            published_at = pick_first(c, ["publishedAt", "publishAt", "published_at", "publish_at", "createdAt", "created_at"])
-            updated_at   = pick_first(c, ["updatedAt", "updated_at"])
-            canonical_url = f"https://note.com/{USER_ID}/n/{note_key}"
-
-            meta = {
-                "user_id": USER_ID,
-                "title": title,
-                "slug": slug,
-                "key": note_key,
-                "page": page,
-                "source": {
-                    "list_api": url,
-                    "detail_api": DETAIL_URL.format(key=note_key),
-                    "canonical": canonical_url,
-                },
-                "timestamps": {
-                    "published_at": published_at,
-                    "updated_at": updated_at,
-                    "downloaded_at": dt.datetime.now().isoformat(timespec="seconds"),
-                },
-                "link_count": len(links),
-                "links": links,
-                "length": len(clean_body),
-            }
-
-            # 保存
-            save_files(base, title, clean_body, meta)
-            print(f"[OK] Saved: {txt_path}")
-            total += 1
-
-            time.sleep(SLEEP_SECS)  # レート制御（detail）
-
-        if data.get("isLastPage"):
-            print("[INFO] Last page reached.")
-            break
-
-        page += 1
-        time.sleep(SLEEP_SECS)  # レート制御（list）
-
-    print(f"[DONE] {total} articles saved. (user={USER_ID})")
+                print(f"[WARN] List request failed (page={page}): {e}")
+                completed = False
+                break
+            next_list = None
+
+            contents = data.get("contents", [])
+            if not contents:
+                print("[INFO] No more articles found.")
+                break
+
+            is_last = bool(data.get("isLastPage"))
+            if STOP_AT_LAST_SYNC and SKIP_EXISTING and page_older_than(contents, state.last_sync):
+                # 一覧は新しい順。このページが丸ごと前回同期より古ければ以降も変化なし
+                print(f"[INFO] Page {page} is older than last sync ({state.last_sync}), stop.")
+                break
+            if is_last:
+                print("[INFO] Last page reached.")
+            elif MAX_PAGES and page + 1 > MAX_PAGES:
+                print(f"[INFO] Reached MAX_PAGES={MAX_PAGES}, stop.")
+                completed = False
+            else:
+                next_list = lists.submit(fetch_list, sess, limiter, page + 1)
+
+            # 前ページの残りを回収してから今ページ分を投入（同時に抱えるのは最大 2 ページ分）
+            current = [details.submit(process_note, sess, limiter, state, c, page, url) for c in contents]
+            total += _drain(pending)
+            pending = current
+            page += 1
+            state.save()
+
+        total += _drain(pending)
+
+    # 一覧を最後まで（または早期終了まで）辿れて、詳細の失敗も無いときだけ同期時刻を進める
+    state.save(last_sync=started_at if completed and not state.failures else None)
+
+    elapsed = time.perf_counter() - t0
+    print(f"[DONE] {total} articles saved in {elapsed:.1f}s. (user={USER_ID})")
 
 
 if __name__ == "__main__":
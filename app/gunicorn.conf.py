@@ -0,0 +1,54 @@
+# gunicorn.conf.py
+"""
+マルチワーカー運用の設定。
+
+  VECTOR_SNAPSHOT=1 python embed_articles.py          # 取り込みは別プロセスで（スナップショットも書き出す）
+  gunicorn -c gunicorn.conf.py main:app
+
+- preload_app: master が main を import し、埋め込みモデル等の重みを読んでから fork する。
+  重みのページは copy-on-write で全ワーカー共有になる（ワーカー数に比例して RAM が増えない）
+- RETRIEVAL_BACKEND=matrix: 検索は memmap のスナップショットを行列検索（retrieval_backend.py）。ページキャッシュを共有し、
+  各ワーカーが Chroma(SQLite) を開いて競合することもない
+- 推論スレッド数はワーカー数で割って、コア数を超えて取り合わないようにする
+"""
+import gc
+import os
+import sys
+import multiprocessing
+
+# main を import する前に設定する（preload_app なので master で読まれる）
+os.environ.setdefault("PRELOAD_MODELS", "1")
+os.environ.setdefault("RETRIEVAL_BACKEND", "matrix")
+os.environ["INGEST_ON_STARTUP"] = "0"  # 全ワーカーで取り込みが走らないように
+
+_cores = multiprocessing.cpu_count()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", str(max(1, _cores // 2))))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# 1 ワーカーあたりの torch スレッド数
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", str(max(1, _cores // max(1, workers)))))
+
+
+def pre_fork(server, worker):
+    # 読み込み済みオブジェクトを GC の走査対象から外し、fork 後の参照カウント以外の書き込みでページが複製されるのを防ぐ
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    try:
+        import torch
+
+        torch.set_num_threads(TORCH_THREADS)
+    except ImportError:
+        pass
+    # EMBED_BACKEND=onnx のセッションは fork 後に作るので、スレッド数もここで合わせる
+    main = sys.modules.get("main")
+    if main is not None and not main.EMBED_THREADS:
+        main.EMBED_THREADS = TORCH_THREADS
+    server.log.info(f"worker {worker.pid}: torch threads={TORCH_THREADS}")
@@ -0,0 +1,97 @@
+# highlight.py
+"""
+/search のスニペットとハイライト。
+
+クエリを lexical_index.ngrams と同じ単位（英数字は単語、それ以外は文字 2-gram）に分け、
+チャンク本文のうちそれが一番多く当たる width 文字を切り出す。ハイライトは切り出した文字列の中の
+[開始, 終了) の位置（Python の文字単位）で返し、装飾はクライアントに任せる。
+照合は NFKC・小文字化した本文で行い、位置は元の本文に戻してから返す（全角英数字などもそのまま当たる）。
+"""
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from lexical_index import ngrams
+
+ELLIPSIS = "…"
+
+Span = Tuple[int, int]
+
+
+def _normalized(text: str) -> Tuple[str, List[int]]:
+    """1 文字ずつ正規化した文字列と、その各文字が元の何文字目から来たか"""
+    out: List[str] = []
+    origin: List[int] = []
+    for i, c in enumerate(text):
+        n = unicodedata.normalize("NFKC", c).lower()
+        out.append(n)
+        origin.extend([i] * len(n))
+    return "".join(out), origin
+
+
+def match_spans(text: str, query: str) -> List[Span]:
+    """本文中でクエリの n-gram に当たる区間（元の本文の位置。重なり・隣接はまとめる）"""
+    terms = {t for t in ngrams(query) if t.strip()}
+    if not text or not terms:
+        return []
+    norm, origin = _normalized(text)
+    hit = bytearray(len(text))
+    for term in terms:
+        pos = norm.find(term)
+        while pos >= 0:
+            for j in range(pos, pos + len(term)):
+                hit[origin[j]] = 1
+            pos = norm.find(term, pos + 1)
+    spans: List[Span] = []
+    start: Optional[int] = None
+    for i, h in enumerate(hit):
+        if h and start is None:
+            start = i
+        elif not h and start is not None:
+            spans.append((start, i))
+            start = None
+    if start is not None:
+        spans.append((start, len(text)))
+    return spans
+
+
+def _best_window(n: int, spans: List[Span], width: int) -> int:
+    """当たった文字が一番多く入る width 文字の開始位置（同点なら前の方。当たりの少し前から始める）"""
+    if n <= width or not spans:
+        return 0
+    covered = [0] * (n + 1)
+    for s, e in spans:
+        for i in range(s, e):
+            covered[i + 1] = 1
+    for i in range(n):
+        covered[i + 1] += covered[i]
+    best, best_at = -1, 0
+    for s, _ in spans:
+        # 当たりの直前に少し文脈を残す
+        at = max(0, min(s - width // 8, n - width))
+        score = covered[at + width] - covered[at]
+        if score > best:
+            best, best_at = score, at
+    return best_at
+
+
+def make_snippet(text: str, query: str, width: int = 200, highlight: bool = True) -> Dict[str, object]:
+    """
+    {"text": スニペット, "highlights": [[開始, 終了], ...]}。width<=0 なら本文全体。
+    切り詰めた側には … を付け、ハイライトの位置はそれも含めた text の中の位置
+    """
+    text = text or ""
+    spans = match_spans(text, query)
+    if width <= 0 or len(text) <= width:
+        start, end = 0, len(text)
+    else:
+        start = _best_window(len(text), spans, width)
+        end = start + width
+    head = ELLIPSIS if start > 0 else ""
+    tail = ELLIPSIS if end < len(text) else ""
+    out: Dict[str, object] = {"text": head + text[start:end] + tail}
+    if highlight:
+        shift = len(head) - start
+        out["highlights"] = [
+            [max(s, start) + shift, min(e, end) + shift] for s, e in spans if e > start and s < end
+        ]
+    return out
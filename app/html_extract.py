@@ -0,0 +1,251 @@
+# html_extract.py
+"""
+note 記事 HTML → (本文テキスト, リンク配列) の抽出エンジン。
+
+- "bs4"    : 従来実装。BeautifulSoup(html.parser) で木を作り、複数回走査する
+- "stream" : html.parser のイベントを 1 パスで処理するストリーミング版（既定）
+
+stream は BeautifulSoup(html.parser) と同じトークナイザ（標準ライブラリの HTMLParser）を使い、
+文字参照の解決・文字列の区切り・get_text() が拾う文字列の種類まで合わせているので、
+両者は同じテキストとリンクを返す（bench/bench_html_extract.py で突き合わせ可能）。
+"""
+import re
+from html.parser import HTMLParser
+from html.entities import html5
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+ABS_HTTP = re.compile(r"^https?://", re.IGNORECASE)
+
+Extractor = Callable[[str], Tuple[str, List[str]]]
+
+
+def normalize_text(text: str) -> str:
+    """空行・空白を正規化（両エンジン共通）"""
+    text = re.sub(r"\r\n?", "\n", text)          # CRLF→LF
+    text = re.sub(r"\n{2,}", "\n\n", text)       # 2連以上の改行は2つに
+    lines = [line.strip() for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+# ── bs4（従来実装） ───────────────────────────────────────────────────────
+def extract_bs4(html: str) -> Tuple[str, List[str]]:
+    """
+    HTMLをざっくりテキスト化し、<figure> と 通常の <a> のリンクを抽出。
+    - <figure> は本文から除去（data-src を優先、無ければ内部の <a href>）
+    - 通常の <a> は href を収集し、aタグ自体は unwrap（テキストは残す）
+    - <script>/<style> は除去
+    - 連続改行や空白を正規化
+    戻り値: (テキスト本文, 抽出リンク配列[絶対HTTPのみ])
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html or "", "html.parser")
+
+    # 余計な属性を削除（必要なければ削ってOK）
+    for tag in soup.find_all(True):
+        tag.attrs.pop("name", None)
+        tag.attrs.pop("id",   None)
+
+    links: List[str] = []
+    seen: Set[str] = set()
+
+    # 1) figure の抽出（data-src 優先、なければ中の a[href]）
+    for fig in soup.find_all("figure"):
+        url = fig.get("data-src")
+        if not url:
+            a = fig.find("a", href=True)
+            url = a["href"] if a else None
+        if url and ABS_HTTP.match(url) and url not in seen:
+            links.append(url)
+            seen.add(url)
+        fig.decompose()  # 本文からは除去
+
+    # 2) script/style の除去
+    for tag in soup(["script", "style"]):
+        tag.decompose()
+
+    # 3) 通常の a[href] を抽出しつつ a タグだけ除去（テキストは残す）
+    for a in soup.find_all("a", href=True):
+        href = a["href"]
+        if ABS_HTTP.match(href) and href not in seen:
+            links.append(href)
+            seen.add(href)
+        a.unwrap()
+
+    # 4) テキスト化
+    text = soup.get_text(separator="\n")
+
+    # 5) 空行・空白を正規化
+    return normalize_text(text), links
+
+
+# ── stream（1 パス） ──────────────────────────────────────────────────────
+# 開始タグだけで閉じる要素（BeautifulSoup の HTML ビルダーと同じ集合）
+VOID_TAGS = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem",
+    "meta", "param", "source", "track", "wbr",
+    "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer",
+])
+# 本文から除去する要素
+DROP_TAGS = frozenset(["figure", "script", "style"])
+# get_text() が拾わない文字列の入れ物（bs4 の DEFAULT_STRING_CONTAINERS）
+HIDDEN_TEXT_TAGS = frozenset(["rt", "rp", "template", "script", "style"])
+
+_DEC_REF = re.compile(r"^([0-9]+)(.*)")
+_HEX_REF = re.compile(r"^([0-9a-f]+)(.*)")
+
+
+def _numeric_ref(name: str) -> str:
+    """数値文字参照の解決（bs4 と同じく不正値は U+FFFD、0x80–0x9F は Windows-1252 とみなす）"""
+    base, reg = 10, _DEC_REF
+    if name[:1] in ("x", "X"):
+        name, base, reg = name[1:], 16, _HEX_REF
+    extra = ""
+    try:
+        n = int(name, base)
+    except ValueError:
+        m = reg.search(name)
+        if m is None:
+            return name
+        n, extra = int(m.group(1), base), m.group(2)
+    if n == 0 or n > 0x10FFFF or 0xD800 <= n <= 0xDFFF:
+        return "\ufffd" + extra
+    if 0x80 <= n <= 0x9F:
+        try:
+            return bytes([n]).decode("cp1252") + extra
+        except UnicodeDecodeError:
+            pass
+    return chr(n) + extra
+
+
+class _StreamExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack: List[str] = []
+        self.drop_depth = 0      # stack 内の figure/script/style の数
+        self.hidden_depth = 0    # stack 内の rt/rp/template/script/style の数
+        self.pieces: List[str] = []
+        self.buf: List[str] = []
+        self.fig_links: List[Optional[str]] = []
+        self.a_links: List[str] = []
+        self.fig_index: Optional[int] = None  # 一番外側の figure の stack 位置
+        self.closed_void: List[str] = []      # 開始タグで閉じ済みの空要素（後続の </br> 等は無視）
+
+    # 連続するテキスト（文字参照を含む）は 1 つの文字列にまとめる＝bs4 の endData 相当
+    def _end_data(self) -> None:
+        if not self.buf:
+            return
+        data = "".join(self.buf)
+        self.buf = []
+        if not self.drop_depth and not self.hidden_depth:
+            self.pieces.append(data)
+
+    def _push(self, tag: str) -> None:
+        self.stack.append(tag)
+        if tag in DROP_TAGS:
+            self.drop_depth += 1
+        if tag in HIDDEN_TEXT_TAGS:
+            self.hidden_depth += 1
+
+    def _pop(self) -> None:
+        tag = self.stack.pop()
+        if tag in DROP_TAGS:
+            self.drop_depth -= 1
+        if tag in HIDDEN_TEXT_TAGS:
+            self.hidden_depth -= 1
+        if self.fig_index is not None and len(self.stack) == self.fig_index:
+            self.fig_index = None
+
+    def handle_starttag(self, tag, attrs, self_closing: bool = False):
+        self._end_data()
+        if tag in VOID_TAGS:
+            if not self_closing:
+                self.closed_void.append(tag)
+            return
+        attr: Dict[str, str] = {}
+        for k, v in attrs:
+            attr[k] = "" if v is None else v
+        if self.fig_index is not None:
+            # figure 内: data-src が無ければ最初の a[href] を採用
+            if tag == "a" and "href" in attr and self.fig_links[-1] is None:
+                self.fig_links[-1] = attr["href"]
+        elif tag == "figure":
+            self.fig_index = len(self.stack)
+            self.fig_links.append(attr.get("data-src") or None)
+        elif tag == "a" and "href" in attr:
+            self.a_links.append(attr["href"])
+        self._push(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, self_closing=True)
+        self._close(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void:
+            # 既に閉じた空要素の終了タグ: 文字列の区切りにもならない（bs4 と同じ）
+            self.closed_void.remove(tag)
+            return
+        self._close(tag)
+
+    def _close(self, tag: str) -> None:
+        self._end_data()
+        if tag not in self.stack:
+            return
+        while self.stack:
+            top = self.stack[-1]
+            self._pop()
+            if top == tag:
+                break
+
+    def handle_data(self, data):
+        self.buf.append(data)
+
+    def handle_charref(self, name):
+        self.buf.append(_numeric_ref(name))
+
+    def handle_entityref(self, name):
+        ch = html5.get(name + ";")
+        self.buf.append(ch if ch is not None else "&" + name)
+
+    def handle_comment(self, data):
+        self._end_data()
+
+    def handle_decl(self, decl):
+        self._end_data()
+
+    def handle_pi(self, data):
+        self._end_data()
+
+    def unknown_decl(self, data):
+        # CDATA セクションは get_text() に含まれる（rt 等の中でも）、それ以外の宣言は含まれない
+        self._end_data()
+        if data.upper().startswith("CDATA[") and not self.drop_depth:
+            self.pieces.append(data[len("CDATA["):])
+
+    def result(self) -> Tuple[str, List[str]]:
+        self._end_data()
+        links: List[str] = []
+        seen: Set[str] = set()
+        for url in self.fig_links + self.a_links:
+            if url and ABS_HTTP.match(url) and url not in seen:
+                links.append(url)
+                seen.add(url)
+        return normalize_text("\n".join(self.pieces)), links
+
+
+def extract_stream(html: str) -> Tuple[str, List[str]]:
+    """extract_bs4 と同じ結果を、木を作らず 1 パスで返す"""
+    p = _StreamExtractor()
+    p.feed(html or "")
+    p.close()
+    return p.result()
+
+
+ENGINES: Dict[str, Extractor] = {
+    "stream": extract_stream,
+    "bs4": extract_bs4,
+}
+
+
+def get_engine(name: str) -> Extractor:
+    return ENGINES.get((name or "").lower(), extract_stream)
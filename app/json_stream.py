@@ -0,0 +1,91 @@
+# json_stream.py
+from typing import List
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringFieldStream:
+    """
+    ストリーミングで届く JSON テキストを少しずつ受け取り、指定したトップレベルの
+    文字列フィールド（例: "answer"）の中身だけを、デコードしながら順次返す。
+
+    strict な json_schema 出力ではキーがスキーマ順に並ぶため、先頭フィールドの
+    文字列はトークン到着と同時にクライアントへ流せる。エスケープが途中で
+    切れている場合は次のチャンクが来るまで保留する。
+    """
+
+    def __init__(self, field: str):
+        self._key = f'"{field}"'
+        self._buf = ""
+        self._pos = 0
+        self._state = "seek"  # seek → value → done
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def feed(self, chunk: str) -> str:
+        if not chunk or self._state == "done":
+            return ""
+        self._buf += chunk
+        if self._state == "seek" and not self._seek_value():
+            return ""
+        return self._decode()
+
+    def _seek_value(self) -> bool:
+        idx = self._buf.find(self._key, self._pos)
+        if idx < 0:
+            # キーが 2 チャンクにまたがる場合に備えて末尾だけ残す
+            self._pos = max(self._pos, len(self._buf) - len(self._key))
+            return False
+        i = idx + len(self._key)
+        for expect in (":", '"'):
+            while i < len(self._buf) and self._buf[i] in " \t\r\n":
+                i += 1
+            if i >= len(self._buf):
+                return False
+            if self._buf[i] != expect:
+                # 文字列値ではなかった（想定外）。以降は何も流さない
+                self._state = "done"
+                return False
+            i += 1
+        self._pos = i
+        self._state = "value"
+        return True
+
+    def _decode(self) -> str:
+        buf, i, n = self._buf, self._pos, len(self._buf)
+        out: List[str] = []
+        while i < n:
+            c = buf[i]
+            if c == '"':
+                self._state = "done"
+                i += 1
+                break
+            if c != "\\":
+                out.append(c)
+                i += 1
+                continue
+            if i + 1 >= n:
+                break
+            esc = buf[i + 1]
+            if esc != "u":
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > n:
+                break
+            code = int(buf[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # サロゲートペアは後半が揃うまで待つ
+                if i + 12 > n:
+                    break
+                if buf[i + 6:i + 8] == "\\u":
+                    low = int(buf[i + 8:i + 12], 16)
+                    out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                    i += 12
+                    continue
+            out.append(chr(code))
+            i += 6
+        self._pos = i
+        return "".join(out)
@@ -0,0 +1,248 @@
+# lexical_index.py
+"""
+チャンク本文の文字 n-gram 転置インデックス（BM25）。
+
+日本語は形態素解析器を使わず、文字種ごとの連続区間を 2-gram に分割する
+（1 文字だけの区間はそのまま 1-gram）。英数字は単語単位。地名・店名など
+埋め込みでは取りこぼしやすい固有名詞の完全一致を拾うためのもの。
+
+embed_articles.py がチャンクの追加/削除に合わせて差分更新し、
+<CHROMA_PERSIST_DIR>/<collection>.lexical.npz に保存する。main.py は読み込み専用で使う。
+"""
+import os
+import re
+import time
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORD = re.compile(r"[a-z0-9]+")
+# 区切り（空白・記号・句読点）。これを跨ぐ n-gram は作らない
+_SPLIT = re.compile(r"[\s\u3000-\u303f!-/:-@\[-`{-~・…―「」『』]+")
+
+
+def lexical_path(persist_dir: str, collection: str) -> str:
+    return os.path.join(persist_dir, f"{collection}.lexical.npz")
+
+
+def ngrams(text: str) -> List[str]:
+    """正規化（NFKC・小文字化）した上で、英数字は単語、それ以外は文字 2-gram に分ける"""
+    s = unicodedata.normalize("NFKC", text or "").lower()
+    out: List[str] = []
+    for run in _SPLIT.split(s):
+        if not run:
+            continue
+        pos = 0
+        for m in _WORD.finditer(run):
+            out.extend(_cjk_grams(run[pos:m.start()]))
+            out.append(m.group())
+            pos = m.end()
+        out.extend(_cjk_grams(run[pos:]))
+    return out
+
+
+def _cjk_grams(run: str) -> List[str]:
+    if len(run) <= 1:
+        return [run] if run else []
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+class LexicalIndex:
+    """
+    追加/削除可能な編集用の表現（doc_id → (term_ids, tfs)）と、
+    検索用の転置リスト（語 → 文書番号の配列）を持つ。
+
+    保存形式（npz）:
+      vocab, doc_ids, doc_hash, doc_len, post_ptr, post_doc, post_tf
+    """
+
+    def __init__(self):
+        self.vocab: Dict[str, int] = {}
+        self.docs: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.hashes: Dict[str, str] = {}
+        self.dirty = False
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    # ── 編集（embed_articles.py 用） ─────────────────────────────────
+    def add(self, ids: Sequence[str], texts: Sequence[str], hashes: Optional[Sequence[str]] = None) -> None:
+        """同じ doc_id があれば置き換える"""
+        for j, (doc_id, text) in enumerate(zip(ids, texts)):
+            counts = Counter(ngrams(text))
+            terms = np.fromiter((self.vocab.setdefault(g, len(self.vocab)) for g in counts),
+                                dtype=np.int32, count=len(counts))
+            tfs = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            self.docs[doc_id] = (terms, tfs)
+            self.hashes[doc_id] = hashes[j] if hashes is not None else ""
+        self.dirty = self.dirty or bool(ids)
+
+    def remove(self, ids: Iterable[str]) -> None:
+        for doc_id in ids:
+            if self.docs.pop(doc_id, None) is not None:
+                self.hashes.pop(doc_id, None)
+                self.dirty = True
+
+    def save(self, path: str) -> None:
+        doc_ids = sorted(self.docs)
+        vocab = np.empty(len(self.vocab), dtype=object)
+        for g, t in self.vocab.items():
+            vocab[t] = g
+        if doc_ids:
+            terms = np.concatenate([self.docs[d][0] for d in doc_ids])
+            tfs = np.concatenate([self.docs[d][1] for d in doc_ids])
+            rows = np.repeat(np.arange(len(doc_ids), dtype=np.int32),
+                             [len(self.docs[d][0]) for d in doc_ids])
+            doc_len = np.array([float(self.docs[d][1].sum()) for d in doc_ids], dtype=np.float32)
+        else:
+            terms = np.zeros(0, dtype=np.int32)
+            tfs = np.zeros(0, dtype=np.float32)
+            rows = np.zeros(0, dtype=np.int32)
+            doc_len = np.zeros(0, dtype=np.float32)
+        # 削除で使われなくなった語を詰めてから、語ごとにまとめ直して転置リストにする
+        used = np.unique(terms)
+        remap = np.full(len(vocab), -1, dtype=np.int32)
+        remap[used] = np.arange(len(used), dtype=np.int32)
+        terms, vocab = remap[terms], vocab[used]
+        order = np.argsort(terms, kind="stable")
+        post_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocab)), out=post_ptr[1:])
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp.npz"
+        np.savez(
+            tmp,
+            vocab=vocab.astype(str) if len(vocab) else np.zeros(0, dtype="<U1"),
+            doc_ids=np.array(doc_ids, dtype=str) if doc_ids else np.zeros(0, dtype="<U1"),
+            doc_hash=np.array([self.hashes.get(d, "") for d in doc_ids], dtype=str)
+            if doc_ids else np.zeros(0, dtype="<U1"),
+            doc_len=doc_len,
+            post_ptr=post_ptr,
+            post_doc=rows[order],
+            post_tf=tfs[order],
+        )
+        os.replace(tmp, path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        """保存済みインデックスを編集用に読み込む。無ければ空"""
+        idx = cls()
+        if not os.path.exists(path):
+            return idx
+        with np.load(path, allow_pickle=False) as z:
+            vocab = z["vocab"].tolist()
+            doc_ids = z["doc_ids"].tolist()
+            doc_hash = z["doc_hash"].tolist()
+            post_ptr, post_doc, post_tf = z["post_ptr"], z["post_doc"], z["post_tf"]
+        idx.vocab = {g: t for t, g in enumerate(vocab)}
+        if not doc_ids:
+            return idx
+        post_term = np.repeat(np.arange(len(vocab), dtype=np.int32), np.diff(post_ptr))
+        order = np.argsort(post_doc, kind="stable")
+        bounds = np.searchsorted(post_doc[order], np.arange(len(doc_ids) + 1))
+        terms_by_doc, tfs_by_doc = post_term[order], post_tf[order]
+        for i, doc_id in enumerate(doc_ids):
+            s, e = bounds[i], bounds[i + 1]
+            idx.docs[doc_id] = (terms_by_doc[s:e].copy(), tfs_by_doc[s:e].copy())
+            idx.hashes[doc_id] = doc_hash[i]
+        return idx
+
+
+class LexicalSearcher:
+    """
+    main.py 用の読み込み専用 BM25 検索。reload() で差し替え（検索中のスレッドは古い配列のまま終わる）。
+    スコア計算は語ごとの転置リストを連結して np.bincount で文書ごとに足し込む。
+    """
+
+    def __init__(self, path: str, min_interval: float = 1.0):
+        self.path = path
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._snap: Optional[dict] = None
+        self._mtime: Optional[float] = None
+        self._checked = float("-inf")
+
+    def reload(self) -> bool:
+        """ファイルが更新されていれば読み直す（確認は min_interval 秒に 1 回）。読み込んだら True"""
+        now = time.monotonic()
+        if now - self._checked < self.min_interval:
+            return False
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                self._snap, self._mtime = None, None
+                return False
+            if mtime == self._mtime:
+                return False
+            self._snap, self._mtime = self._load(), mtime
+        return True
+
+    def _load(self) -> dict:
+        with np.load(self.path, allow_pickle=False) as z:
+            vocab = z["vocab"].tolist()
+            doc_ids = z["doc_ids"].tolist()
+            doc_len = z["doc_len"].astype(np.float32)
+            post_ptr, post_doc, post_tf = z["post_ptr"], z["post_doc"], z["post_tf"]
+        n = len(doc_ids)
+        df = np.diff(post_ptr).astype(np.float32)
+        avgdl = float(doc_len.mean()) if n else 1.0
+        return {
+            "term_of": {g: t for t, g in enumerate(vocab)},
+            "doc_ids": doc_ids,
+            "post_ptr": post_ptr,
+            "post_doc": post_doc,
+            "post_tf": post_tf,
+            "idf": np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32),
+            # BM25 の分母のうち文書長に依存する部分を前計算
+            "norm": (BM25_K1 * (1.0 - BM25_B + BM25_B * doc_len / max(avgdl, 1e-9))).astype(np.float32),
+        }
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[str, float]]:
+        snap = self._snap
+        if snap is None or not snap["doc_ids"] or k <= 0:
+            return []
+        q_terms = Counter(t for t in (snap["term_of"].get(g) for g in ngrams(query)) if t is not None)
+        if not q_terms:
+            return []
+        ptr, post_doc, post_tf = snap["post_ptr"], snap["post_doc"], snap["post_tf"]
+        docs_parts, w_parts = [], []
+        for t, qtf in q_terms.items():
+            s, e = ptr[t], ptr[t + 1]
+            docs = post_doc[s:e]
+            tf = post_tf[s:e]
+            docs_parts.append(docs)
+            w_parts.append(qtf * snap["idf"][t] * tf * (BM25_K1 + 1.0) / (tf + snap["norm"][docs]))
+        scores = np.bincount(np.concatenate(docs_parts), weights=np.concatenate(w_parts),
+                             minlength=len(snap["doc_ids"]))
+        hit = np.flatnonzero(scores)
+        if hit.size > k:
+            hit = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        hit = hit[np.argsort(-scores[hit], kind="stable")]
+        return [(snap["doc_ids"][i], float(scores[i])) for i in hit]
+
+    def stats(self) -> dict:
+        snap = self._snap
+        if snap is None:
+            return {"loaded": False, "path": self.path}
+        return {"loaded": True, "docs": len(snap["doc_ids"]), "terms": len(snap["term_of"]), "path": self.path}
+
+
+def rrf_fuse(rankings: Sequence[Sequence[str]], k: int = 60, limit: Optional[int] = None) -> List[str]:
+    """Reciprocal Rank Fusion: 各ランキングでの順位 r に 1/(k + r) を足して並べ替える"""
+    score: Dict[str, float] = {}
+    first_seen: Dict[str, int] = {}
+    for ranking in rankings:
+        for r, doc_id in enumerate(ranking, start=1):
+            score[doc_id] = score.get(doc_id, 0.0) + 1.0 / (k + r)
+            first_seen.setdefault(doc_id, len(first_seen))
+    fused = sorted(score, key=lambda d: (-score[d], first_seen[d]))
+    return fused[:limit] if limit is not None else fused
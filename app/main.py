@@ -1,21 +1,52 @@
 # main.py
 
+import time
+_T_IMPORT = time.perf_counter()  # 起動時間の計測起点
+
 import os
 import json
+import asyncio
 import logging
-from typing import List, Tuple, Dict, Any
+import functools
+import contextvars
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Tuple, Dict, Any, AsyncIterator, Awaitable, Callable, Optional, Sequence, TypeVar
 
+import httpx
 from fastapi import FastAPI, HTTPException, Request
-from chromadb import PersistentClient
-from chromadb.errors import NotFoundError
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
+# chromadb / sentence_transformers / openai / tiktoken は重いので初回利用時（ウォームアップ）に import する
+
+from query_embedder import MicroBatchEmbedder
+from answer_cache import AnswerCache
+from collection_state import AliasWatcher, VersionWatcher
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+from embedder import describe, export_onnx, load_embedder, model_key
+from json_stream import JsonStringFieldStream
+from lexical_index import LexicalSearcher, lexical_path, rrf_fuse
+from reranker import Reranker
+from context_builder import ContextBuilder, load_encoding
+from startup import Lazy, StartupTracker
+from bulk_qa import parse_items
+from retrieval_backend import RetrievalBackend, make_backend
+from search_filter import SearchFilter, recency_order
+from highlight import make_snippet
+from sessions import SessionStore, Turn, carry_over, cosine, parse_session_id, same_question
+from metrics import CONTENT_TYPE, REGISTRY, RequestMetricsMiddleware, process_collector
+from tracing import dropped_logs, setup_logging
 
 load_dotenv()  # .env 読み込み
 
-# ログ設定
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+# ログ設定（書き出しは別スレッド。トレース ID 付き。tracing.py 参照）
+LOG_LEVEL       = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT      = os.environ.get("LOG_FORMAT", "text")                 # text / json
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1.0"))      # INFO 以下を残すリクエストの割合
+LOG_QUEUE_SIZE  = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))       # 溢れた分は捨てる（/metrics の rag_log_dropped_total）
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE, LOG_QUEUE_SIZE)
 log = logging.getLogger(__name__)
 
 # ── 環境変数 ────────────────────────────────────────────────────────────────
@@ -24,39 +55,387 @@ PERSIST_DIR  = os.environ.get("CHROMA_PERSIST_DIR", "./chroma_db")
 EMBED_MODEL  = os.environ.get("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
 COLLECTION   = os.environ.get("CHROMA_COLLECTION", "note_articles")
 
-# コンテキスト制御
-MAX_DOCS      = int(os.environ.get("MAX_DOCS", "5"))
-MAX_DOC_CHARS = int(os.environ.get("MAX_DOC_CHARS", "1200"))
+# コンテキスト制御（参考記事抜粋はトークン数で予算管理）
+MAX_DOCS               = int(os.environ.get("MAX_DOCS", "5"))
+CONTEXT_TOKEN_BUDGET   = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))   # 0 で無制限
+CONTEXT_DOC_MAX_TOKENS = int(os.environ.get("CONTEXT_DOC_MAX_TOKENS", "0"))   # 1 記事あたりの上限。0 で無制限
+
+# 並行処理・バックプレッシャ
+CPU_WORKERS      = int(os.environ.get("CPU_WORKERS", "4"))         # 埋め込み/Chroma 用スレッド数
+LLM_CONCURRENCY  = int(os.environ.get("LLM_CONCURRENCY", "16"))    # 同時に投げる OpenAI 呼び出し数
+LLM_TIMEOUT_SECS = float(os.environ.get("LLM_TIMEOUT_SECS", "60"))
+MAX_INFLIGHT     = int(os.environ.get("MAX_INFLIGHT", "64"))       # これを超えた /query は 503
+
+# バッチ QA（/query/batch と bulk_qa.py）
+BATCH_MAX_QUESTIONS   = int(os.environ.get("BATCH_MAX_QUESTIONS", "1000"))  # /query/batch 1 回あたりの上限
+BATCH_RETRIEVE_SIZE   = int(os.environ.get("BATCH_RETRIEVE_SIZE", "64"))    # まとめて埋め込み・検索する質問数
+BATCH_LLM_CONCURRENCY = int(os.environ.get("BATCH_LLM_CONCURRENCY", str(max(1, LLM_CONCURRENCY // 2))))  # 対話の /query に枠を残す
+
+# 埋め込みの推論バックエンド（torch / onnx。embedder.py 参照）
+EMBED_BACKEND       = os.environ.get("EMBED_BACKEND", "torch")
+EMBED_ONNX_QUANTIZE = os.environ.get("EMBED_ONNX_QUANTIZE", "")   # 空で fp32。avx2 / avx512 / avx512_vnni / arm64 で int8
+EMBED_ONNX_DIR      = os.environ.get("EMBED_ONNX_DIR") or os.path.join(PERSIST_DIR, "onnx")
+EMBED_THREADS       = int(os.environ.get("EMBED_THREADS", "0"))   # ONNX Runtime のスレッド数。0 で既定（gunicorn はワーカー数で割る）
+
+# クエリ埋め込みのマイクロバッチ
+EMBED_BATCH_MAX     = int(os.environ.get("EMBED_BATCH_MAX", "32"))
+EMBED_BATCH_WAIT_MS = float(os.environ.get("EMBED_BATCH_WAIT_MS", "5"))
+
+# クエリ埋め込みも永続埋め込みキャッシュ（embed_articles.py と共有）を引くか
+QUERY_EMBED_CACHE = os.environ.get("QUERY_EMBED_CACHE", "0") == "1"
+QUERY_EMBED_CACHE_ENTRIES = int(os.environ.get("QUERY_EMBED_CACHE_ENTRIES", "10000"))  # 新しい質問の埋め込みはプロセス内 LRU のみ
+EMBED_CACHE_DIR   = os.environ.get("EMBED_CACHE_DIR", os.path.join(PERSIST_DIR, "embed_cache"))
+
+# 回答キャッシュ
+ANSWER_CACHE               = os.environ.get("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_MAX_ENTRIES   = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_MAX_MB        = float(os.environ.get("ANSWER_CACHE_MAX_MB", "64"))
+ANSWER_CACHE_TTL_SECS      = float(os.environ.get("ANSWER_CACHE_TTL_SECS", "3600"))
+ANSWER_CACHE_SEMANTIC_DIST = float(os.environ.get("ANSWER_CACHE_SEMANTIC_DIST", "0.08"))  # コサイン距離。0 で無効
+
+# 会話セッション（リクエストの session_id。sessions.py 参照）
+SESSIONS              = os.environ.get("SESSIONS", "1") == "1"
+SESSION_MAX           = int(os.environ.get("SESSION_MAX", "1000"))
+SESSION_TTL_SECS      = float(os.environ.get("SESSION_TTL_SECS", "1800"))
+SESSION_HISTORY_TURNS = int(os.environ.get("SESSION_HISTORY_TURNS", "2"))     # プロンプトに入れる過去のやりとりの数
+SESSION_CARRY_DOCS    = int(os.environ.get("SESSION_CARRY_DOCS", "3"))        # 追質問で引き継ぐ直前のチャンク数
+SESSION_CARRY_MIN_SIM = float(os.environ.get("SESSION_CARRY_MIN_SIM", "0.5"))  # 直前の質問とのコサイン類似度がこれ未満なら話題が変わったとみなす
+SESSION_REUSE_SIM     = float(os.environ.get("SESSION_REUSE_SIM", "0.95"))    # これ以上なら検索を省いて直前の結果を使う
+
+# ハイブリッド検索（文字 n-gram BM25 ＋ ベクトル、Reciprocal Rank Fusion で統合）
+HYBRID_SEARCH      = os.environ.get("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES  = int(os.environ.get("HYBRID_CANDIDATES", "20"))   # 各検索から統合前に取る件数
+RRF_K              = int(os.environ.get("RRF_K", "60"))
+LEXICAL_INDEX_PATH = os.environ.get("LEXICAL_INDEX_PATH") or lexical_path(PERSIST_DIR, COLLECTION)
+
+# 再ランキング（候補を多めに取り、クロスエンコーダで採点し直して MAX_DOCS 件に絞る）
+RERANK               = os.environ.get("RERANK", "0") == "1"
+RERANK_MODEL         = os.environ.get("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_CANDIDATES    = int(os.environ.get("RERANK_CANDIDATES", "20"))
+RERANK_BATCH_SIZE    = int(os.environ.get("RERANK_BATCH_SIZE", "16"))
+RERANK_BUDGET_MS     = float(os.environ.get("RERANK_BUDGET_MS", "150"))   # これを超えそうなら残りは元の順位
+RERANK_MAX_LENGTH    = int(os.environ.get("RERANK_MAX_LENGTH", "256"))
+RERANK_CACHE_ENTRIES = int(os.environ.get("RERANK_CACHE_ENTRIES", "20000"))
+
+# 絞り込み・新しさの重み付け（リクエストの filters / recency_half_life_days。search_filter.py 参照）
+RECENCY_HALF_LIFE_DAYS = float(os.environ.get("RECENCY_HALF_LIFE_DAYS", "0"))  # リクエストで省略したときの半減期。0 で無効
+RECENCY_CANDIDATES     = int(os.environ.get("RECENCY_CANDIDATES", "30"))       # 新しさで並べ直す前に取る候補数
+
+# 検索のみの /search（LLM を呼ばない。UI の記事検索用）
+SEARCH_MAX_RESULTS   = int(os.environ.get("SEARCH_MAX_RESULTS", "100"))   # ページをめくって辿れる件数の上限
+SEARCH_PAGE_SIZE     = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))      # page_size を省略したとき
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get("SEARCH_MAX_PAGE_SIZE", "50"))
+SEARCH_SNIPPET_CHARS = int(os.environ.get("SEARCH_SNIPPET_CHARS", "200"))  # 0 でチャンク全文
+
+# 起動（ウォームアップと取り込み）
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"  # モデル読み込み＋ダミー推論を裏で先に済ませる
+INGEST_ON_STARTUP = os.environ.get("INGEST_ON_STARTUP", "0") == "1"  # ウォームアップ後に embed_articles を裏で実行
+
+# マルチワーカー運用（gunicorn.conf.py 参照）
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "chroma")  # chroma / matrix（memmap のスナップショットを行列検索。旧名 snapshot）
+MATRIX_RESCORE    = int(os.environ.get("MATRIX_RESCORE", "4"))     # 量子化・近似索引の候補を k の何倍取って再計算するか
+IVF_NPROBE        = int(os.environ.get("IVF_NPROBE", "16"))        # IVF で調べるリスト数
+HNSW_EF           = int(os.environ.get("HNSW_EF", "128"))          # HNSW の探索幅
+PRELOAD_MODELS    = os.environ.get("PRELOAD_MODELS", "0") == "1"   # import 時にモデルを読む（fork 前に読んで共有するため）
+
+T = TypeVar("T")
+
+# ── 起動状態 ──────────────────────────────────────────────────────────────
+# 重いリソースは Lazy で包み、ウォームアップスレッドか最初のリクエストのどちらか早い方で 1 回だけ作る
+startup = StartupTracker(_T_IMPORT)
+
+
+def _load_chroma():
+    from chromadb import PersistentClient
+
+    c = PersistentClient(path=PERSIST_DIR)
+    log.info(f"ChromaDB ready. collection={COLLECTION}, dir={os.path.abspath(PERSIST_DIR)}")
+    return c
+
+
+def _load_embedder():
+    log.info(f"Use SentenceTransformer: {EMBED_MODEL} [{describe(EMBED_BACKEND, EMBED_ONNX_QUANTIZE)}]")
+    return load_embedder(EMBED_MODEL, EMBED_BACKEND, EMBED_ONNX_QUANTIZE, EMBED_ONNX_DIR, threads=EMBED_THREADS)
+
+
+chroma = Lazy("chroma", _load_chroma, startup)
+embedder = Lazy("embedder", _load_embedder, startup)
 
 # ── Chroma ────────────────────────────────────────────────────────────────
-client = PersistentClient(path=PERSIST_DIR)
+# embed_articles.py の作り直しは新しい版を作ってエイリアスを切り替えるので、ここで読み直すだけで移れる
+collection_alias = AliasWatcher(PERSIST_DIR, COLLECTION)
+
 
 def _get_collection():
-    """embed による drop/recreate 後でも常に最新のコレクションを掴む"""
-    return client.get_or_create_collection(COLLECTION)
+    """エイリアスが指すコレクションを掴む（エイリアスが無ければ論理名のコレクション）"""
+    name = collection_alias.current()
+    if name == COLLECTION:
+        return chroma.get().get_or_create_collection(COLLECTION)
+    return chroma.get().get_collection(name)
+
+# ── 実行プール ─────────────────────────────────────────────────────────────
+# encode / coll.query は同期・CPU バウンドなのでイベントループ外で動かす
+cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="rag-cpu")
 
-try:
-    _cnt = _get_collection().count()
-    log.info(f"ChromaDB ready. collection={COLLECTION}, count={_cnt}, dir={os.path.abspath(PERSIST_DIR)}")
-except Exception as e:
-    log.warning(f"Chroma 初期化時に count 取得で例外: {e}")
 
-# ── Embedding ─────────────────────────────────────────────────────────────
-log.info(f"Use SentenceTransformer: {EMBED_MODEL}")
-embedder = SentenceTransformer(EMBED_MODEL)
+async def run_blocking(fn: Callable[..., T], *args, **kwargs) -> T:
+    """同期関数を cpu_pool で実行して待つ（トレース ID などの contextvars も引き継ぐ）"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(cpu_pool, functools.partial(ctx.run, fn, *args, **kwargs))
+
+# ── メトリクス ────────────────────────────────────────────────────────────
+# GET /metrics（Prometheus 形式）。処理段ごとの所要時間で、遅いのが検索か OpenAI かを切り分ける
+request_seconds = REGISTRY.histogram("rag_request_seconds", "HTTP request duration in seconds (until the last body chunk).",
+                                     ["route", "method", "status"])
+stage_seconds = REGISTRY.histogram("rag_stage_seconds", "Duration of each query stage in seconds.", ["stage"])
+llm_tokens = REGISTRY.counter("rag_llm_tokens_total", "OpenAI tokens consumed.", ["kind"])
+errors_total = REGISTRY.counter("rag_errors_total", "Errors by stage.", ["stage"])
+
+
+async def timed(stage: str, aw: Awaitable[T]) -> T:
+    """aw を待つ時間を stage として記録する"""
+    with stage_seconds.time(stage=stage):
+        return await aw
+
+
+def record_usage(usage: Any) -> int:
+    """OpenAI の usage をトークン数のカウンタに足し、合計トークン数を返す"""
+    if usage is None:
+        return 0
+    llm_tokens.inc(int(getattr(usage, "prompt_tokens", 0) or 0), kind="prompt")
+    llm_tokens.inc(int(getattr(usage, "completion_tokens", 0) or 0), kind="completion")
+    return int(getattr(usage, "total_tokens", 0) or 0)
 
 # ── OpenAI ────────────────────────────────────────────────────────────────
-oai = OpenAI()
-log.info(f"使用モデル: {OPENAI_MODEL}")
+# 非同期クライアント＋専用コネクションプール。同時実行数はセマフォで制限する
+def _load_openai():
+    from openai import AsyncOpenAI
 
-# ── FastAPI ───────────────────────────────────────────────────────────────
-app = FastAPI()
+    return AsyncOpenAI(
+        timeout=LLM_TIMEOUT_SECS,
+        http_client=httpx.AsyncClient(
+            timeout=LLM_TIMEOUT_SECS,
+            limits=httpx.Limits(max_connections=LLM_CONCURRENCY, max_keepalive_connections=LLM_CONCURRENCY),
+        ),
+    )
+
+
+oai = Lazy("openai", _load_openai, startup)
+llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+log.info(f"使用モデル: {OPENAI_MODEL} (concurrency={LLM_CONCURRENCY}, max_inflight={MAX_INFLIGHT})")
+
+
+class InflightGate:
+    """
+    同時処理中リクエスト数の上限。上限を超えた分は待たせずに 503 を返す
+    （キューを無制限に伸ばしてレイテンシを悪化させないためのバックプレッシャ）。
+    イベントループ上でのみ操作するのでロックは不要。
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.current = 0
+
+    def acquire(self) -> None:
+        if self.limit > 0 and self.current >= self.limit:
+            raise HTTPException(
+                status_code=503,
+                detail="混雑しています。しばらくしてから再試行してください。",
+                headers={"Retry-After": "1"},
+            )
+        self.current += 1
+
+    def release(self) -> None:
+        self.current -= 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class GatedStreamingResponse(StreamingResponse):
+    """
+    ストリーミング応答の間 gate の枠を持ち、送信が終わったとき（失敗・切断を含む）に 1 回だけ返す。
+    本文のジェネレータの finally で返すと、最初の __anext__ の前に切断されたときに一度も回らず枠が漏れる
+    """
+
+    def __init__(self, content: Any, gate: InflightGate, **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self._gate = gate
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._gate.release()
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+inflight = InflightGate(MAX_INFLIGHT)
+
+
+# 永続キャッシュは読むだけ（新しい質問はプロセス内の LRU に置き、ディスクには追記しない）
+embed_cache = QueryEmbeddingCache(
+    EmbeddingCache(EMBED_CACHE_DIR, model_key(EMBED_MODEL, EMBED_BACKEND, EMBED_ONNX_QUANTIZE)),
+    QUERY_EMBED_CACHE_ENTRIES,
+) if QUERY_EMBED_CACHE else None
+
+
+def _encode_queries(texts: List[str]) -> List[List[float]]:
+    if embed_cache is not None:
+        return embed_cache.encode(embedder.get(), texts, batch_size=len(texts), show_progress_bar=False).tolist()
+    return embedder.get().encode(texts, batch_size=len(texts), show_progress_bar=False).tolist()
+
+
+# 同時リクエストのクエリをまとめて 1 回の forward で埋め込む共有サービス
+query_embedder = MicroBatchEmbedder(
+    _encode_queries, cpu_pool, max_batch=EMBED_BATCH_MAX, max_wait_ms=EMBED_BATCH_WAIT_MS,
+)
+
+# ── 回答キャッシュ ─────────────────────────────────────────────────────────
+# embed_articles.py がコレクションを更新すると世代ファイルが変わり、自動で全消去される
+collection_version = VersionWatcher(PERSIST_DIR, COLLECTION)
+answer_cache = AnswerCache(
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    max_bytes=int(ANSWER_CACHE_MAX_MB * 1024 * 1024),
+    ttl_secs=ANSWER_CACHE_TTL_SECS,
+    semantic_max_dist=ANSWER_CACHE_SEMANTIC_DIST,
+    version_fn=collection_version.current,
+) if ANSWER_CACHE else None
+
+# ── 会話セッション ─────────────────────────────────────────────────────────
+sessions = SessionStore(
+    max_sessions=SESSION_MAX,
+    ttl_secs=SESSION_TTL_SECS,
+    max_turns=max(1, SESSION_HISTORY_TURNS + 1),
+    version_fn=collection_version.current,
+) if SESSIONS else None
+
+# ── 再ランキング ───────────────────────────────────────────────────────────
+def _load_cross_encoder():
+    from sentence_transformers import CrossEncoder
+
+    log.info(f"Use CrossEncoder: {RERANK_MODEL} (candidates={RERANK_CANDIDATES}, budget={RERANK_BUDGET_MS}ms)")
+    return CrossEncoder(RERANK_MODEL, max_length=RERANK_MAX_LENGTH, device="cpu")
+
+
+reranker: Optional[Reranker] = None
+if RERANK:
+    reranker = Reranker(
+        Lazy("cross_encoder", _load_cross_encoder, startup).get,
+        batch_size=RERANK_BATCH_SIZE,
+        budget_ms=RERANK_BUDGET_MS,
+        cache_entries=RERANK_CACHE_ENTRIES,
+        version_fn=collection_version.current,
+    )
+
+# ── コンテキスト組み立て ───────────────────────────────────────────────────
+context_builder = Lazy("tokenizer", lambda: ContextBuilder(
+    load_encoding(OPENAI_MODEL), budget_tokens=CONTEXT_TOKEN_BUDGET, doc_max_tokens=CONTEXT_DOC_MAX_TOKENS,
+), startup)
+context_stats = {"requests": 0, "tokens_total": 0, "truncated": 0, "chunks_dropped": 0}
+context_stats_lock = threading.Lock()  # build_context は cpu_pool のスレッドで数える
 
+# ── 語彙検索（BM25） ───────────────────────────────────────────────────────
+# embed_articles.py が保存したインデックスを読む。ファイルが更新されたら次の検索で読み直す
+lexical = LexicalSearcher(LEXICAL_INDEX_PATH) if HYBRID_SEARCH else None
 
-def _clip(text: str, limit: int) -> str:
-    if not text or limit <= 0:
-        return text or ""
-    return text[:limit]
+# ── ベクトル検索バックエンド ───────────────────────────────────────────────
+# matrix: 複数ワーカーで Chroma(SQLite) を開かず、memmap のスナップショットを共有して検索する。
+# スナップショットがまだ無ければ Chroma に戻る
+chroma_backend, matrix = make_backend(
+    RETRIEVAL_BACKEND, lambda: _get_collection(), PERSIST_DIR, COLLECTION, refresh=collection_alias.refresh,
+    version_fn=collection_version.current, rescore=MATRIX_RESCORE, nprobe=IVF_NPROBE, ef=HNSW_EF,
+)
+
+# ── ウォームアップ / 取り込み ──────────────────────────────────────────────
+ingest_state: Dict[str, Any] = {"status": "off" if not INGEST_ON_STARTUP else "pending"}
+
+
+def warm_up() -> None:
+    """モデル等を読み込み、ダミー推論でカーネルを温めてから ready にする（バックグラウンドスレッド）"""
+    try:
+        if matrix is not None:
+            startup.run("vector_matrix", lambda: (matrix.reload(), log.info(f"Vector matrix: {matrix.stats()}")))
+        if active_backend() is chroma_backend:
+            startup.run("chroma_count", lambda: log.info(f"collection count={_get_collection().count()}"))
+        startup.run("embed_warmup", lambda: _encode_queries(["ウォームアップ"]))
+        if lexical is not None:
+            startup.run("lexical_index", lambda: (lexical.reload(), log.info(f"Lexical index: {lexical.stats()}")))
+        startup.run("context_builder", lambda: context_builder.get().count("ウォームアップ"))
+        if reranker is not None:
+            startup.run("rerank_warmup", lambda: reranker.warm_up())
+        oai.get()
+        startup.mark_ready()
+    except Exception as e:
+        startup.error = f"{type(e).__name__}: {e}"
+        log.exception(f"[startup] ウォームアップ失敗: {e}")
+        return
+    if INGEST_ON_STARTUP:
+        ingest_in_background()
+
+
+def ingest_in_background() -> None:
+    """embed_articles を同じプロセスで実行する（読み込み済みのモデルと Chroma クライアントを使い回す）"""
+    def run():
+        import embed_articles
+
+        ingest_state.update(status="running", started_at=time.time())
+        t = time.perf_counter()
+        try:
+            embed_articles.main(model=embedder.get(), client=chroma.get())
+            ingest_state.update(status="done")
+        except BaseException as e:
+            ingest_state.update(status="failed", error=f"{type(e).__name__}: {e}")
+            log.exception(f"[ingest] 失敗: {e}")
+        finally:
+            ingest_state["secs"] = round(time.perf_counter() - t, 3)
+            log.info(f"[ingest] {ingest_state['status']} in {ingest_state['secs']:.1f}s")
+
+    threading.Thread(target=run, name="rag-ingest", daemon=True).start()
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    log.info(f"[startup] import main: {startup.elapsed():.2f}s")
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=warm_up, name="rag-warmup", daemon=True).start()
+    else:
+        startup.mark_ready()  # 初回リクエストで遅延初期化される
+        if INGEST_ON_STARTUP:
+            ingest_in_background()
+    yield
+
+
+# ── FastAPI ───────────────────────────────────────────────────────────────
+app = FastAPI(lifespan=lifespan)
+# トレース ID（X-Request-ID）の付与と、リクエスト全体の所要時間
+app.add_middleware(RequestMetricsMiddleware, histogram=request_seconds)
+
+if PRELOAD_MODELS:
+    # gunicorn の preload_app で master が import したときに重みを読み込み、fork 後の各ワーカーと
+    # copy-on-write で共有する。推論（スレッドプール生成）は fork 後のウォームアップで行う
+    if EMBED_BACKEND == "onnx":
+        # ONNX Runtime のセッションはスレッドプールを持つので fork 前に作らない。書き出しだけ master で済ませる
+        export_onnx(EMBED_MODEL, EMBED_ONNX_DIR, EMBED_ONNX_QUANTIZE)
+    else:
+        embedder.get()
+    context_builder.get()
+    if reranker is not None:
+        reranker.load()
+    if matrix is not None:
+        matrix.reload()
+    log.info(f"[startup] preloaded models: {startup.elapsed():.2f}s")
 
 
 def _collect_sources(metas: List[Dict[str, Any]], dists: List[float], ids: List[str]) -> List[Dict[str, Any]]:
@@ -74,48 +453,232 @@ def _collect_sources(metas: List[Dict[str, Any]], dists: List[float], ids: List[
     return sources
 
 
-def vector_search(q: str, k: int = 5) -> Tuple[List[str], List[str], List[dict], List[float]]:
-    """クエリ文字列 q に対してベクトル検索を行い、候補を返す。"""
-    q_emb = embedder.encode([q])[0].tolist()
-    coll = _get_collection()
-    try:
-        # ※ include に 'ids' は入れない（現行 Chroma は非対応）
-        res = coll.query(
-            query_embeddings=[q_emb],
-            n_results=k,
-            include=["documents", "metadatas", "distances"],
-        )
-    except NotFoundError:
-        # embed 側でコレクションが再作成された直後など
-        coll = _get_collection()
-        res = coll.query(
-            query_embeddings=[q_emb],
-            n_results=k,
-            include=["documents", "metadatas", "distances"],
-        )
+def active_backend() -> RetrievalBackend:
+    """行列バックエンドが読めていればそれ、無ければ Chroma"""
+    if matrix is not None and matrix.available():
+        return matrix
+    return chroma_backend
+
 
-    docs  = (res.get("documents")  or [[]])[0] or []
-    metas = (res.get("metadatas")  or [[]])[0] or []
-    dists = (res.get("distances")  or [[]])[0] or []
-    ids   = (res.get("ids")        or [[]])[0] or []  # ids はレスポンスに含まれる
-    log.info(f"[vector] hits={len(docs)} dists={dists[:3]}")
+def query_collection(q_emb: List[float], k: int = 5,
+                     flt: Optional[SearchFilter] = None) -> Tuple[List[str], List[str], List[dict], List[float]]:
+    """埋め込み済みクエリで検索する（同期。cpu_pool から呼ぶ）。flt があれば条件に合うチャンクだけを検索する"""
+    backend = active_backend()
+    with stage_seconds.time(stage="vector"):
+        ids, docs, metas, dists = backend.query(q_emb, k, flt)
+    log.info(f"[vector:{backend.name}] hits={len(docs)} dists={dists[:3]}" + (f" filter=({flt.key()})" if flt else ""))
     return ids, docs, metas, dists
 
 
+def resolve_filter(flt: Optional[SearchFilter]) -> Optional[SearchFilter]:
+    """タイトルの部分一致を filename の一覧にする（同期。タイトル一覧はコレクションが変わるまで使い回す）"""
+    if flt is None or not flt.needs_titles:
+        return flt
+    flt = flt.resolve_titles(active_backend().titles())
+    log.info(f"[filter] title={flt.title!r} -> {len(flt.filenames)} articles")
+    return flt
+
+
+def lexical_search(q: str, k: int) -> List[str]:
+    """BM25 で上位 k 件のチャンク ID を返す（同期。cpu_pool から呼ぶ）"""
+    if lexical is None:
+        return []
+    lexical.reload()
+    return [doc_id for doc_id, _ in lexical.search(q, k)]
+
+
+def _n_fetch() -> int:
+    """プロンプトに入れる前の候補数（再ランキングするなら多めに取る）"""
+    return max(MAX_DOCS, RERANK_CANDIDATES) if reranker is not None else MAX_DOCS
+
+
+def _n_candidates(n_fetch: int, flt: Optional[SearchFilter]) -> int:
+    """新しさで並べ直すなら、並べ直す前の候補を多めに取る"""
+    if flt is not None and flt.recency_half_life_days > 0:
+        return max(n_fetch, RECENCY_CANDIDATES)
+    return n_fetch
+
+
+def _vector_k(n_fetch: int) -> int:
+    """ベクトル検索で取る件数（語彙検索と統合するなら HYBRID_CANDIDATES 件まで広げる）"""
+    return max(n_fetch, HYBRID_CANDIDATES) if lexical is not None else n_fetch
+
+
+def hybrid_query(q_emb: List[float], hits: Tuple[List[str], List[str], List[dict], List[float]],
+                 lex_ids: List[str], k: int,
+                 flt: Optional[SearchFilter] = None) -> Tuple[List[str], List[str], List[dict], List[float]]:
+    """
+    ベクトル検索の候補 hits と語彙検索の候補を RRF で統合し、上位 k 件を返す（同期。cpu_pool から呼ぶ）。
+    語彙検索でしか出てこなかったチャンクは本文・メタ・埋め込みを get で取り、距離を計算して揃える。
+    絞り込み中は語彙検索の候補も get の where で条件に合うものだけにしてから統合する。
+    """
+    ids, docs, metas, dists = hits
+    if not lex_ids:
+        return ids[:k], docs[:k], metas[:k], dists[:k]
+
+    rows = {doc_id: (docs[i], metas[i], dists[i]) for i, doc_id in enumerate(ids)}
+    if flt is not None and flt.filtering:
+        extra = [doc_id for doc_id in lex_ids if doc_id not in rows]
+        if extra:
+            for doc_id, doc, meta, dist in zip(*active_backend().get(extra, q_emb, flt)):
+                rows[doc_id] = (doc, meta, dist)
+        lex_ids = [doc_id for doc_id in lex_ids if doc_id in rows]
+        fused = rrf_fuse([ids, lex_ids], k=RRF_K, limit=k)
+    else:
+        fused = rrf_fuse([ids, lex_ids], k=RRF_K, limit=k)
+        extra = [doc_id for doc_id in fused if doc_id not in rows]
+        if extra:
+            for doc_id, doc, meta, dist in zip(*active_backend().get(extra, q_emb)):
+                rows[doc_id] = (doc, meta, dist)
+
+    out_ids = [doc_id for doc_id in fused if doc_id in rows]
+    log.info(f"[hybrid] vector={len(ids)} lexical={len(lex_ids)} fused={len(out_ids)} lexical_only={len(extra)}")
+    return (
+        out_ids,
+        [rows[d][0] for d in out_ids],
+        [rows[d][1] for d in out_ids],
+        [float(rows[d][2]) for d in out_ids],
+    )
+
+
+async def vector_search(q: str, k: int = 5) -> Tuple[List[str], List[str], List[dict], List[float]]:
+    """クエリ文字列 q に対してベクトル検索を行い、候補を返す。"""
+    q_emb = await query_embedder.embed(q)
+    return await run_blocking(query_collection, q_emb, k)
+
+
+@app.get("/health/live")
+async def health_live():
+    """プロセスが応答できるか（モデル読み込み中でも 200）"""
+    return {"status": "ok", "uptime_secs": round(startup.elapsed(), 3)}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """ウォームアップが終わってリクエストを即処理できるか。未完了・失敗は 503"""
+    body = {**startup.snapshot(), "ingest": dict(ingest_state)}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
 @app.get("/health")
 async def health():
-    coll = _get_collection()
-    return {"status": "ok", "chroma_count": coll.count(), "embed_model": EMBED_MODEL}
+    backend = active_backend()
+    count = await run_blocking(backend.count)
+    return {
+        "status": "ok",
+        "chroma_count": count,
+        "collection": collection_alias.current(),
+        "embed_model": EMBED_MODEL,
+        "embed_backend": describe(EMBED_BACKEND, EMBED_ONNX_QUANTIZE),
+        "inflight": inflight.current,
+        "embed_batching": query_embedder.stats(),
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "sessions": sessions.stats() if sessions else None,
+        "embed_cache": embed_cache.stats() if embed_cache else None,
+        "lexical": lexical.stats() if lexical else None,
+        "retrieval": backend.stats(),
+        "pid": os.getpid(),
+        "rerank": reranker.stats() if reranker else None,
+        "context": {
+            **context_stats,
+            "avg_tokens": round(context_stats["tokens_total"] / context_stats["requests"], 1)
+            if context_stats["requests"] else 0.0,
+            "budget": CONTEXT_TOKEN_BUDGET,
+        },
+    }
 
 
-@app.post("/query")
-async def query(request: Request):
+def _app_collector():
+    """既にどこかで数えている値を /metrics に出す"""
+    yield ("rag_inflight_requests", "gauge", "Requests being processed.", {}, inflight.current)
+    yield ("rag_log_dropped_total", "counter", "Log records dropped because the log queue was full.", {},
+           dropped_logs())
+    b = query_embedder.stats()
+    yield ("rag_embed_batches_total", "counter", "Query embedding forward passes.", {}, b["batches"])
+    yield ("rag_embed_batch_items_total", "counter", "Queries embedded in micro-batches.", {}, b["items"])
+    if answer_cache is not None:
+        for kind in ("hits_exact", "hits_semantic", "misses"):
+            yield ("rag_answer_cache_requests_total", "counter", "Answer cache lookups by result.",
+                   {"result": kind}, answer_cache.counters[kind])
+        yield ("rag_answer_cache_tokens_saved_total", "counter", "OpenAI tokens saved by the answer cache.", {},
+               answer_cache.counters["tokens_saved"])
+    yield ("rag_context_tokens_total", "counter", "Tokens put into prompts as context.", {},
+           context_stats["tokens_total"])
+    if sessions is not None:
+        yield ("rag_sessions", "gauge", "Conversation sessions held by this worker.", {},
+               sessions.stats()["sessions"])
+        for mode in ("regenerated", "reused", "carried", "fresh"):
+            yield ("rag_session_followups_total", "counter", "Follow-up retrievals by mode.", {"mode": mode},
+                   sessions.counters[mode])
+
+
+REGISTRY.collector(_app_collector)
+REGISTRY.collector(process_collector)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 形式のメトリクス（このワーカーの値）"""
+    return Response(REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """回答キャッシュのヒット/ミス（ヒット数＝節約できた LLM 呼び出し数）"""
+    if answer_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **answer_cache.stats()}
+
+
+# LLMに要求するスキーマ：answer（必須）、suggestions（必須だが空配列可）
+ANSWER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "answer": {
+            "type": "string",
+            "description": (
+                "ユーザーの質問に対する最終回答（日本語・Markdown可）。"
+                "ブログの文脈から、どこで何をしたか等の具体性を優先し、"
+                "単語羅列ではなく、読み物として滑らかな文にする。"
+                "必要なら見出しや短い箇条書きを使ってもよい。"
+                "事実が不明な点は推測せず『記事からは断定できません』と明記する。"
+            )
+        },
+        "suggestions": {
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 0,
+            "description": "ユーザーが次に掘り下げられる観点（例：場所の詳細、費用、持ち物、季節の注意）。空配列でも可。"
+        }
+    },
+    # ← strict:true では required に properties の全キーを含める必要がある
+    "required": ["answer", "suggestions"],
+    "additionalProperties": False
+}
+
+SYSTEM_PROMPT = (
+    "あなたはブログ要約・検索のアシスタントです。"
+    "以下の参考記事抜粋『のみ』を根拠に、日本語で自然で読みやすい回答を作成してください。"
+    "単語の羅列やパワーワードの寄せ集めは避け、具体的な場所・行動・流れを優先してまとめます。"
+    "必要に応じて短い見出しや箇条書きを使って構いません。"
+    "最後に、ユーザーが次に深掘りできる観点を 2–4 個ほど提案（suggestions）してください。"
+    "不明点は推測せず『記事からは断定できません』と記してください。"
+)
+
+
+@dataclass
+class QueryRequest:
+    question: str
+    flt: Optional[SearchFilter] = None
+    session_id: Optional[str] = None
+    regenerate: bool = False
+
+
+async def parse_question(request: Request) -> QueryRequest:
     """
-    参考記事抜粋だけを根拠に、ChatGPTらしい自然な「回答（Markdown）」と
-    追加で役立つ「suggestions（任意だが、スキーマ上は空配列でも必ず含める）」を返す。
+    /query・/query/stream の本文。filters / recency_half_life_days が無ければ flt は None。
+    session_id を付けると同じ会話の追質問として扱い、regenerate: true なら直前の回答を作り直す
     """
-    body_bytes = await request.body()
-    log.info(f"Incoming request body: {body_bytes.decode('utf-8', errors='ignore')}")
     try:
         payload  = await request.json()
         question = (payload.get("question") or "").strip()
@@ -124,93 +687,625 @@ async def query(request: Request):
             raise ValueError("質問が空です。")
     except Exception:
         raise HTTPException(status_code=400, detail="不正なリクエストです。JSONに 'question' を含めてください。")
+    try:
+        flt = SearchFilter.from_payload(payload, default_half_life=RECENCY_HALF_LIFE_DAYS)
+        session_id = parse_session_id(payload.get("session_id"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"不正なリクエストです: {e}")
+    return QueryRequest(question, flt, session_id, bool(payload.get("regenerate")))
 
-    # ベクトル検索して文脈を整形（長すぎるスニペットはクリップ）
-    ids, docs, metas, dists = vector_search(question, k=MAX_DOCS)
-    if not docs:
-        raise HTTPException(status_code=404, detail="関連記事が見つかりませんでした")
 
-    snippets = []
-    for i, doc in enumerate(docs):
-        fn   = (metas[i] or {}).get("filename") if i < len(metas) else None
-        dist = f"(dist={dists[i]:.3f})" if i < len(dists) else ""
-        header = f"[{i+1}] {fn or (ids[i] if i < len(ids) else 'doc')} {dist}"
-        snippet = _clip(doc, MAX_DOC_CHARS)
-        snippets.append(f"{header}\n{snippet}")
-    context = "\n\n---\n\n".join(snippets)
-
-    # LLMに要求するスキーマ：answer（必須）、suggestions（必須だが空配列可）
-    schema = {
-        "type": "object",
-        "properties": {
-            "answer": {
-                "type": "string",
-                "description": (
-                    "ユーザーの質問に対する最終回答（日本語・Markdown可）。"
-                    "ブログの文脈から、どこで何をしたか等の具体性を優先し、"
-                    "単語羅列ではなく、読み物として滑らかな文にする。"
-                    "必要なら見出しや短い箇条書きを使ってもよい。"
-                    "事実が不明な点は推測せず『記事からは断定できません』と明記する。"
-                )
-            },
-            "suggestions": {
-                "type": "array",
-                "items": {"type": "string"},
-                "minItems": 0,
-                "description": "ユーザーが次に掘り下げられる観点（例：場所の詳細、費用、持ち物、季節の注意）。空配列でも可。"
-            }
-        },
-        # ← strict:true では required に properties の全キーを含める必要がある
-        "required": ["answer", "suggestions"],
-        "additionalProperties": False
-    }
+def build_context(ids: List[str], docs: List[str], metas: List[dict], dists: List[float]) -> str:
+    """
+    検索結果を文脈に整形する。同じ記事の隣接・重複チャンクはまとめ、
+    順位の高いものから CONTEXT_TOKEN_BUDGET トークンに収まるだけ詰める。
+    候補ごとに tiktoken で数えるので同期（cpu_pool から呼ぶ）。
+    """
+    with stage_seconds.time(stage="context"):
+        built = context_builder.get().build(ids, docs, metas, dists)
+    with context_stats_lock:
+        context_stats["requests"] += 1
+        context_stats["tokens_total"] += built.tokens
+        context_stats["truncated"] += int(built.truncated)
+        context_stats["chunks_dropped"] += built.dropped
+    log.info(f"[context] {built.stats()}")
+    return built.text
 
-    system_prompt = (
-        "あなたはブログ要約・検索のアシスタントです。"
-        "以下の参考記事抜粋『のみ』を根拠に、日本語で自然で読みやすい回答を作成してください。"
-        "単語の羅列やパワーワードの寄せ集めは避け、具体的な場所・行動・流れを優先してまとめます。"
-        "必要に応じて短い見出しや箇条書きを使って構いません。"
-        "最後に、ユーザーが次に深掘りできる観点を 2–4 個ほど提案（suggestions）してください。"
-        "不明点は推測せず『記事からは断定できません』と記してください。"
-    )
 
-    user_prompt = (
-        f"質問: {question}\n\n"
-        f"参考記事の抜粋（最大{MAX_DOCS}件）:\n"
+def build_messages(question: str, context: str,
+                   history: Sequence[Tuple[str, str]] = ()) -> List[Dict[str, str]]:
+    """
+    変わりにくいものから順に並べる（システム → 抜粋 → これまでのやりとり → 今回の質問）。
+    OpenAI のプロンプトキャッシュは先頭一致で効くので、抜粋を引き継ぐ追質問や再生成で前回の分が再利用される
+    """
+    context_prompt = (
+        "参考記事の抜粋:\n"
         f"{context}\n\n"
         "注意:\n"
         "- 上の抜粋に含まれない情報は出さない。\n"
         "- 解答は日本語。マークダウン（見出し/箇条書き）可。\n"
         "- 具体的な場所や行動、出来事を優先して説明する。\n"
     )
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user",   "content": context_prompt},
+    ]
+    for q, a in history:
+        messages.append({"role": "user", "content": f"質問: {q}"})
+        messages.append({"role": "assistant", "content": a})
+    messages.append({"role": "user", "content": f"質問: {question}"})
+    return messages
+
 
+LLM_PARAMS: Dict[str, Any] = {
+    "model": OPENAI_MODEL,
+    "temperature": 0.3,
+    "max_tokens": 900,
+    "response_format": {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "note_chatty_answer",
+            "schema": ANSWER_SCHEMA,
+            "strict": True
+        }
+    },
+}
+
+
+async def complete_answer(messages: List[Dict[str, str]]) -> Tuple[Dict[str, Any], int]:
+    """OpenAI 呼び出し（同時実行数は llm_slots で制限）。(回答JSON, 消費トークン数) を返す"""
     try:
-        resp = oai.chat.completions.create(
-            model=OPENAI_MODEL,
-            temperature=0.3,
-            max_tokens=900,
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "note_chatty_answer",
-                    "schema": schema,
-                    "strict": True
-                }
-            },
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user",   "content": user_prompt},
-            ],
-        )
-        data = json.loads(resp.choices[0].message.content)
+        async with llm_slots:
+            resp = await timed("llm", oai.get().chat.completions.create(messages=messages, **LLM_PARAMS))
+        tokens = record_usage(getattr(resp, "usage", None))
+        return json.loads(resp.choices[0].message.content), tokens
     except Exception as e:
+        errors_total.inc(stage="llm")
         log.error(f"OpenAI API エラー: {e}")
         raise HTTPException(status_code=500, detail=f"OpenAI API エラー: {e}")
 
-    sources = _collect_sources(metas, dists, ids)
 
-    return {
+async def stream_completion(messages: List[Dict[str, str]], usage_out: Dict[str, int]) -> AsyncIterator[str]:
+    """OpenAI をストリーミングで呼び、本文の差分を順に返す。消費トークン数は usage_out に入れる"""
+    async with llm_slots:
+        t = time.perf_counter()
+        first = True
+        stream = await oai.get().chat.completions.create(
+            messages=messages, stream=True, stream_options={"include_usage": True}, **LLM_PARAMS,
+        )
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage_out["total_tokens"] = record_usage(chunk.usage)
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first:
+                        stage_seconds.observe(time.perf_counter() - t, stage="llm_first_token")
+                        first = False
+                    yield delta
+        stage_seconds.observe(time.perf_counter() - t, stage="llm")
+
+
+@dataclass
+class Retrieval:
+    question: str
+    q_emb: List[float]
+    ids: List[str]
+    docs: List[str]
+    metas: List[dict]
+    dists: List[float]
+    flt: Optional[SearchFilter] = None
+    session_id: Optional[str] = None
+    history: List[Tuple[str, str]] = field(default_factory=list)  # プロンプトに入れる過去の (質問, 回答)
+    replace_turn: bool = False                                     # 再生成（セッションの最後のターンを置き換える）
+
+    @property
+    def cacheable(self) -> bool:
+        """過去のやりとりに依存する回答は回答キャッシュに入れない"""
+        return not self.history
+
+    def sources(self) -> List[Dict[str, Any]]:
+        return _collect_sources(self.metas, self.dists, self.ids)
+
+    def messages(self, context: str) -> List[Dict[str, str]]:
+        return build_messages(self.question, context, self.history)
+
+
+def _cache_key(question: str, flt: Optional[SearchFilter]) -> str:
+    """同じ質問でも絞り込み条件が違えば別の回答としてキャッシュする"""
+    return f"{question}\n[{flt.key()}]" if flt is not None else question
+
+
+def _filter_key(flt: Optional[SearchFilter]) -> str:
+    return flt.key() if flt is not None else ""
+
+
+async def retrieve(question: str, flt: Optional[SearchFilter] = None, session_id: Optional[str] = None,
+                   regenerate: bool = False) -> Tuple[Optional[Dict[str, Any]], Optional[Retrieval]]:
+    """
+    キャッシュ確認→埋め込み→検索。キャッシュに当たれば (回答, None)、
+    外れれば (None, 検索結果) を返す。該当記事なしは 404。
+    session_id に前のターンがあれば retrieve_followup で前回の検索結果を使い回す
+    """
+    turns = sessions.turns(session_id) if sessions is not None and session_id else []
+    if turns:
+        return await retrieve_followup(question, flt, session_id, turns, regenerate)
+
+    # 1 段目: 正規化した質問文の完全一致（埋め込みも検索もしない）
+    if answer_cache is not None:
+        cached = answer_cache.get_exact(_cache_key(question, flt))
+        if cached is not None:
+            remember_cached(session_id, question, flt, cached)
+            return cached, None
+
+    flt = await timed("filter", run_blocking(resolve_filter, flt))
+    if flt is not None and flt.filenames == ():
+        raise HTTPException(status_code=404, detail="条件に合う記事が見つかりませんでした")
+
+    # 埋め込み（マイクロバッチ）と語彙検索を並行で。Chroma 検索もスレッドプールで（イベントループを塞がない）
+    q_emb, lex_ids = await asyncio.gather(
+        timed("embed", query_embedder.embed(question)),
+        timed("lexical", run_blocking(lexical_search, question, HYBRID_CANDIDATES)),
+    )
+    n_fetch = _n_fetch()
+    hits = await run_blocking(query_collection, q_emb, _vector_k(_n_candidates(n_fetch, flt)), flt)
+    cached, r = await _finish_retrieval(question, q_emb, hits, lex_ids, n_fetch, flt)
+    if cached is not None:
+        remember_cached(session_id, question, flt, cached)
+    else:
+        r.session_id = session_id
+    return cached, r
+
+
+async def _turn_hits(turn: Turn, q_emb: List[float]) -> Tuple[List[str], List[str], List[dict], List[float]]:
+    """前のターンの検索結果。回答キャッシュから返したターンは ID しか無いので取り直す（並びは前のまま）"""
+    hits = turn.hits()
+    if hits is not None:
+        return hits
+    got = await run_blocking(active_backend().get, turn.ids, q_emb)
+    pos = {doc_id: i for i, doc_id in enumerate(got[0])}
+    order = [pos[doc_id] for doc_id in turn.ids if doc_id in pos]
+    return tuple([xs[i] for i in order] for xs in got)  # type: ignore[return-value]
+
+
+def _history(turns: List[Turn]) -> List[Tuple[str, str]]:
+    """プロンプトに入れる直近 SESSION_HISTORY_TURNS 回の (質問, 回答)"""
+    if SESSION_HISTORY_TURNS <= 0:
+        return []
+    return [(t.question, t.answer) for t in turns[-SESSION_HISTORY_TURNS:]]
+
+
+async def retrieve_followup(question: str, flt: Optional[SearchFilter], session_id: str,
+                            turns: List[Turn], regenerate: bool = False) -> Tuple[None, Retrieval]:
+    """
+    セッションの 2 ターン目以降。回答はそれまでのやりとりにも依存するので、回答キャッシュは引かない。
+    - regenerate（直前と同じ質問）: 検索せず、直前と同じ抜粋・履歴で作り直す（プロンプトも同じ）
+    - 直前の質問と埋め込みが SESSION_REUSE_SIM 以上: 検索せず直前の検索結果を使う
+    - SESSION_CARRY_MIN_SIM 以上（話題が続いている）: 検索し、直前のチャンクを抜粋の先頭に引き継ぐ
+    - それ以外: 通常どおり検索する（やりとりの履歴だけ渡す）
+    """
+    last = turns[-1]
+    same_filter = last.filter_key == _filter_key(flt)
+    if regenerate and same_filter and same_question(last.question, question):
+        sessions.counters["regenerated"] += 1
+        q_emb = last.q_emb if last.q_emb is not None else await timed("embed", query_embedder.embed(question))
+        ids, docs, metas, dists = await _turn_hits(last, q_emb)
+        if ids:
+            return None, Retrieval(last.question, q_emb, ids, docs, metas, dists, flt, session_id=session_id,
+                                   history=_history(turns[:-1]), replace_turn=True)
+
+    history = _history(turns)
+    flt = await timed("filter", run_blocking(resolve_filter, flt))
+    if flt is not None and flt.filenames == ():
+        raise HTTPException(status_code=404, detail="条件に合う記事が見つかりませんでした")
+    q_emb, lex_ids = await asyncio.gather(
+        timed("embed", query_embedder.embed(question)),
+        timed("lexical", run_blocking(lexical_search, question, HYBRID_CANDIDATES)),
+    )
+    sim = cosine(q_emb, last.q_emb) if last.q_emb is not None else None
+    if sim is not None and sim >= SESSION_REUSE_SIM and same_filter:
+        ids, docs, metas, dists = await _turn_hits(last, q_emb)
+        if ids:
+            sessions.counters["reused"] += 1
+            return None, Retrieval(question, q_emb, ids, docs, metas, dists, flt, session_id=session_id,
+                                   history=history)
+
+    carry = SESSION_CARRY_DOCS > 0 and (sim is None or sim >= SESSION_CARRY_MIN_SIM)
+    prev = await _turn_hits(last, q_emb) if carry else ([], [], [], [])
+    if flt is not None and flt.filtering:
+        keep = [i for i, meta in enumerate(prev[2]) if flt.matches(meta)]
+        prev = tuple([xs[i] for i in keep] for xs in prev)
+    n_fetch = _n_fetch()
+    hits = await run_blocking(query_collection, q_emb, _vector_k(_n_candidates(n_fetch, flt)), flt)
+    try:
+        _, r = await _finish_retrieval(question, q_emb, hits, lex_ids, n_fetch, flt, use_cache=False)
+        new = (r.ids, r.docs, r.metas, r.dists)
+    except HTTPException as e:
+        if e.status_code != 404 or not prev[0]:
+            raise
+        new = ([], [], [], [])  # 新しい候補が無くても、引き継いだ分で答える
+    sessions.counters["carried" if prev[0] else "fresh"] += 1
+    ids, docs, metas, dists = carry_over(prev, new, SESSION_CARRY_DOCS)
+    return None, Retrieval(question, q_emb, ids, docs, metas, dists, flt, session_id=session_id, history=history)
+
+
+async def _finish_retrieval(question: str, q_emb: List[float],
+                            hits: Tuple[List[str], List[str], List[dict], List[float]],
+                            lex_ids: List[str], n_fetch: int,
+                            flt: Optional[SearchFilter] = None,
+                            use_cache: bool = True) -> Tuple[Optional[Dict[str, Any]], Optional[Retrieval]]:
+    """ベクトル検索の結果から先（語彙検索との統合→新しさ→再ランキング→意味的キャッシュ）。retrieve / retrieve_many 共通"""
+    ids, docs, metas, dists = await timed("hybrid", run_blocking(hybrid_query, q_emb, hits, lex_ids,
+                                                                 _n_candidates(n_fetch, flt), flt))
+    if not docs:
+        raise HTTPException(status_code=404, detail="関連記事が見つかりませんでした")
+
+    # 新しさの重み付け: 候補を順位×経過日数の減衰で並べ直し、n_fetch 件に絞る
+    if flt is not None and flt.recency_half_life_days > 0:
+        order = recency_order(metas, flt.recency_half_life_days, rank_k=RRF_K)[:n_fetch]
+        ids, docs, metas, dists = ([xs[i] for i in order] for xs in (ids, docs, metas, dists))
+
+    # 多めに取った候補をクロスエンコーダで採点し直し、プロンプトに入れる MAX_DOCS 件に絞る
+    if reranker is not None and len(ids) > 1:
+        order = await timed("rerank", run_blocking(reranker.rerank, question, ids, docs, MAX_DOCS))
+        ids, docs, metas, dists = ([xs[i] for i in order] for xs in (ids, docs, metas, dists))
+
+    # 2 段目: 意味的に近い質問で、参照チャンクも同じなら回答を再利用
+    if answer_cache is not None and use_cache:
+        cached = answer_cache.get_semantic(q_emb, ids)
+        if cached is not None:
+            return cached, None
+
+    return None, Retrieval(question, q_emb, ids, docs, metas, dists, flt)
+
+
+def remember(r: Retrieval, result: Dict[str, Any], tokens: int) -> None:
+    if answer_cache is not None and r.cacheable:
+        answer_cache.put(_cache_key(r.question, r.flt), result, emb=r.q_emb, source_ids=r.ids, tokens=tokens)
+    if sessions is not None and r.session_id:
+        sessions.add(r.session_id, Turn(r.question, result.get("answer", ""), list(r.ids), r.q_emb, list(r.docs),
+                                        list(r.metas), list(r.dists), _filter_key(r.flt)),
+                     replace_last=r.replace_turn)
+
+
+def remember_cached(session_id: Optional[str], question: str, flt: Optional[SearchFilter],
+                    cached: Dict[str, Any]) -> None:
+    """回答キャッシュから返したターンもセッションに残す（チャンクは ID だけ）"""
+    if sessions is None or not session_id:
+        return
+    ids = [s["id"] for s in cached.get("sources") or [] if s.get("id")]
+    sessions.add(session_id, Turn(question, cached.get("answer", ""), ids, filter_key=_filter_key(flt)))
+
+
+async def generate_answer(r: Retrieval) -> Dict[str, Any]:
+    """検索結果から回答を作り、キャッシュに入れて返す（/query とバッチ共通）"""
+    context = await run_blocking(build_context, r.ids, r.docs, r.metas, r.dists)
+    data, tokens = await complete_answer(r.messages(context))
+    result = {
         "answer": data.get("answer", ""),
         "suggestions": data.get("suggestions", []),
-        "sources": sources,
+        "sources": r.sources(),
+    }
+    remember(r, result, tokens)
+    return result
+
+
+@app.post("/query")
+async def query(request: Request):
+    """
+    参考記事抜粋だけを根拠に、ChatGPTらしい自然な「回答（Markdown）」と
+    追加で役立つ「suggestions（任意だが、スキーマ上は空配列でも必ず含める）」を返す。
+    任意で filters（published_after / published_before / updated_after / updated_before / user_id / title）と
+    recency_half_life_days（新しい記事を優先する半減期）を指定できる。
+    session_id を付けると同じ会話の追質問として前回の検索結果・やりとりを使い、
+    regenerate: true で直前の質問の回答を検索し直さずに作り直す。
+    """
+    with inflight:
+        req = await parse_question(request)
+        cached, r = await retrieve(req.question, req.flt, req.session_id, req.regenerate)
+        if cached is not None:
+            return cached
+        return await generate_answer(r)
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/query/stream")
+async def query_stream(request: Request):
+    """
+    /query のストリーミング版（Server-Sent Events）。
+      event: sources     … 検索直後に参照ソース一覧
+      event: token       … 回答本文の差分 {"text": "..."}
+      event: suggestions … 生成完了後に深掘り候補
+      event: done        … 完了（{"answer": 全文}）
+      event: error       … 生成途中のエラー
+    検索までのエラー（400/404/503）は通常の HTTP ステータスで返す。
+    """
+    inflight.acquire()
+    try:
+        req = await parse_question(request)
+        cached, r = await retrieve(req.question, req.flt, req.session_id, req.regenerate)
+    except BaseException:
+        inflight.release()
+        raise
+
+    async def events() -> AsyncIterator[str]:
+        if cached is not None:
+            yield _sse("sources", cached.get("sources", []))
+            yield _sse("token", {"text": cached.get("answer", "")})
+            yield _sse("suggestions", cached.get("suggestions", []))
+            yield _sse("done", {"answer": cached.get("answer", "")})
+            return
+
+        yield _sse("sources", r.sources())
+        context = await run_blocking(build_context, r.ids, r.docs, r.metas, r.dists)
+        answer_field = JsonStringFieldStream("answer")
+        raw: List[str] = []
+        usage: Dict[str, int] = {}
+        try:
+            async for delta in stream_completion(r.messages(context), usage):
+                raw.append(delta)
+                text = answer_field.feed(delta)
+                if text:
+                    yield _sse("token", {"text": text})
+            data = json.loads("".join(raw))
+        except Exception as e:
+            errors_total.inc(stage="llm_stream")
+            log.error(f"OpenAI API エラー(stream): {e}")
+            yield _sse("error", {"detail": f"OpenAI API エラー: {e}"})
+            return
+
+        result = {
+            "answer": data.get("answer", ""),
+            "suggestions": data.get("suggestions", []),
+            "sources": r.sources(),
+        }
+        yield _sse("suggestions", result["suggestions"])
+        yield _sse("done", {"answer": result["answer"]})
+        remember(r, result, usage.get("total_tokens", 0))
+
+    return GatedStreamingResponse(
+        events(),
+        inflight,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ── 検索のみ ───────────────────────────────────────────────────────────────
+@dataclass
+class SearchRequest:
+    query: str
+    flt: Optional[SearchFilter] = None
+    page: int = 1
+    page_size: int = SEARCH_PAGE_SIZE
+    highlight: bool = False
+    snippet_chars: int = SEARCH_SNIPPET_CHARS
+
+
+def _int_field(payload: Dict[str, Any], key: str, default: int, lo: int, hi: int) -> int:
+    v = payload.get(key)
+    if v is None:
+        return default
+    if isinstance(v, bool) or not isinstance(v, (int, str)):
+        raise ValueError(f"{key} は整数で指定してください: {v!r}")
+    try:
+        n = int(v)
+    except ValueError:
+        raise ValueError(f"{key} は整数で指定してください: {v!r}")
+    if not lo <= n <= hi:
+        raise ValueError(f"{key} は {lo}〜{hi} で指定してください")
+    return n
+
+
+async def parse_search(request: Request) -> SearchRequest:
+    """/search の本文。filters / recency_half_life_days は /query と同じ形"""
+    try:
+        payload = await request.json()
+        query = (payload.get("query") or "").strip()
+        if not query:
+            raise ValueError("検索語が空です。")
+    except Exception:
+        raise HTTPException(status_code=400, detail="不正なリクエストです。JSONに 'query' を含めてください。")
+    try:
+        flt = SearchFilter.from_payload(payload, default_half_life=RECENCY_HALF_LIFE_DAYS)
+        page_size = _int_field(payload, "page_size", SEARCH_PAGE_SIZE, 1, SEARCH_MAX_PAGE_SIZE)
+        page = _int_field(payload, "page", 1, 1, max(1, -(-SEARCH_MAX_RESULTS // page_size)))
+        snippet_chars = _int_field(payload, "snippet_chars", SEARCH_SNIPPET_CHARS, 0, 10000)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"不正なリクエストです: {e}")
+    return SearchRequest(query, flt, page, page_size, bool(payload.get("highlight")), snippet_chars)
+
+
+async def search_chunks(query: str, k: int,
+                        flt: Optional[SearchFilter] = None) -> Tuple[List[str], List[str], List[dict], List[float]]:
+    """
+    /query と同じ検索（絞り込み→埋め込みと語彙検索→ベクトル検索→RRF→新しさ）で上位 k 件。
+    再ランキングと回答キャッシュは通さない。該当なしは空（404 にしない）
+    """
+    flt = await timed("filter", run_blocking(resolve_filter, flt))
+    if flt is not None and flt.filenames == ():
+        return [], [], [], []
+    n_candidates = _n_candidates(k, flt)
+    q_emb, lex_ids = await asyncio.gather(
+        timed("embed", query_embedder.embed(query)),
+        timed("lexical", run_blocking(lexical_search, query, max(HYBRID_CANDIDATES, n_candidates))),
+    )
+    hits = await run_blocking(query_collection, q_emb, _vector_k(n_candidates), flt)
+    ids, docs, metas, dists = await timed("hybrid", run_blocking(hybrid_query, q_emb, hits, lex_ids,
+                                                                 n_candidates, flt))
+    if flt is not None and flt.recency_half_life_days > 0:
+        order = recency_order(metas, flt.recency_half_life_days, rank_k=RRF_K)[:k]
+        ids, docs, metas, dists = ([xs[i] for i in order] for xs in (ids, docs, metas, dists))
+    return ids[:k], docs[:k], metas[:k], dists[:k]
+
+
+@app.post("/search")
+async def search(request: Request):
+    """
+    記事チャンクの検索だけを行う（LLM は呼ばない）。モデルや Chroma を持たない UI・CLI 用。
+      {"query": "...", "page": 1, "page_size": 10, "filters": {...}, "recency_half_life_days": 0,
+       "highlight": true, "snippet_chars": 200}
+    snippet はクエリの n-gram が一番多く当たる snippet_chars 文字。highlight: true なら
+    その中の一致位置 [[開始, 終了], ...] も返す。辿れるのは上位 SEARCH_MAX_RESULTS 件まで。
+    """
+    with inflight:
+        req = await parse_search(request)
+        offset = (req.page - 1) * req.page_size
+        # 次のページがあるかを知るために 1 件多く取る
+        k = min(offset + req.page_size + 1, SEARCH_MAX_RESULTS)
+        ids, docs, metas, dists = await search_chunks(req.query, k, req.flt)
+
+    results = []
+    for i in range(offset, min(offset + req.page_size, len(ids))):
+        m = metas[i] or {}
+        results.append({
+            "rank": i + 1,
+            "id": ids[i],
+            "filename": m.get("filename") or ids[i],
+            "title": m.get("title"),
+            "chunk": m.get("chunk"),
+            "distance": float(dists[i]),
+            "url": m.get("source_canonical"),
+            "published_at": m.get("published_at"),
+            "updated_at": m.get("updated_at"),
+            **make_snippet(docs[i], req.query, req.snippet_chars, req.highlight),
+        })
+    return {
+        "query": req.query,
+        "page": req.page,
+        "page_size": req.page_size,
+        "has_more": len(ids) > offset + req.page_size,
+        "results": results,
     }
+
+
+# ── バッチ QA ─────────────────────────────────────────────────────────────
+# 評価セットや FAQ の事前生成用。対話の /query と LLM の枠を取り合わないよう同時数を別に絞る
+batch_llm_slots = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+
+async def retrieve_many(questions: List[str]) -> List[Any]:
+    """
+    retrieve の複数質問版。埋め込みは 1 回の encode、ベクトル検索は 1 回の query_many にまとめる。
+    要素は retrieve と同じ (回答, None) / (None, 検索結果)。失敗した質問はその例外
+    """
+    out: List[Any] = [None] * len(questions)
+    todo: List[int] = []
+    for i, q in enumerate(questions):
+        cached = answer_cache.get_exact(q) if answer_cache is not None else None
+        if cached is not None:
+            out[i] = (cached, None)
+        else:
+            todo.append(i)
+    if not todo:
+        return out
+
+    texts = [questions[i] for i in todo]
+    embs, lex = await asyncio.gather(
+        timed("batch_embed", run_blocking(_encode_queries, texts)),
+        timed("batch_lexical", run_blocking(lambda: [lexical_search(t, HYBRID_CANDIDATES) for t in texts])),
+    )
+    n_fetch = _n_fetch()
+    backend = active_backend()
+    hits = await timed("batch_vector", run_blocking(backend.query_many, embs, _vector_k(n_fetch)))
+    total = sum(len(h[0]) for h in hits)
+    unique = len({doc_id for h in hits for doc_id in h[0]})
+    log.info(f"[batch:{backend.name}] questions={len(texts)} hits={total} unique_chunks={unique}")
+
+    results = await asyncio.gather(
+        *(_finish_retrieval(t, e, h, l, n_fetch) for t, e, h, l in zip(texts, embs, hits, lex)),
+        return_exceptions=True,
+    )
+    for i, res in zip(todo, results):
+        out[i] = res
+    return out
+
+
+def _batch_row(item_id: str, question: str, t0: float, **fields: Any) -> Dict[str, Any]:
+    return {"id": item_id, "question": question, **fields, "secs": round(time.perf_counter() - t0, 3)}
+
+
+def _error_detail(e: BaseException) -> str:
+    return str(e.detail) if isinstance(e, HTTPException) else f"{type(e).__name__}: {e}"
+
+
+async def answer_batch(items: List[Tuple[str, str]]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    (id, 質問) の列に回答し、終わった順に 1 件ずつ返す。
+    BATCH_RETRIEVE_SIZE 件ずつまとめて検索し、LLM 呼び出しは batch_llm_slots の数だけ並行させる。
+    LLM 待ちが溜まりすぎたら次の検索は待たせる（検索だけ先に進んでメモリを食わないように）
+    """
+    pending: set = set()
+    max_pending = max(BATCH_RETRIEVE_SIZE, 2 * BATCH_LLM_CONCURRENCY)
+
+    async def run(item_id: str, question: str, r: Retrieval, t0: float) -> Dict[str, Any]:
+        try:
+            async with batch_llm_slots:
+                result = await generate_answer(r)
+            return _batch_row(item_id, question, t0, **result, cached=False)
+        except Exception as e:
+            errors_total.inc(stage="batch_answer")
+            return _batch_row(item_id, question, t0, error=_error_detail(e))
+
+    try:
+        for start in range(0, len(items), BATCH_RETRIEVE_SIZE):
+            chunk = items[start:start + BATCH_RETRIEVE_SIZE]
+            t0 = time.perf_counter()
+            for (item_id, question), res in zip(chunk, await retrieve_many([q for _, q in chunk])):
+                if isinstance(res, BaseException):
+                    errors_total.inc(stage="batch_retrieve")
+                    yield _batch_row(item_id, question, t0, error=_error_detail(res))
+                elif res[0] is not None:
+                    yield _batch_row(item_id, question, t0, **res[0], cached=True)
+                else:
+                    pending.add(asyncio.create_task(run(item_id, question, res[1], t0)))
+            # 終わった分を返す。待ちが多すぎれば減るまでここで待つ
+            while pending:
+                busy = len(pending) > max_pending
+                done, pending = await asyncio.wait(pending, timeout=None if busy else 0,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+                if len(pending) <= max_pending:
+                    break
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+@app.post("/query/batch")
+async def query_batch(request: Request):
+    """
+    複数の質問にまとめて回答し、終わった順に NDJSON（1 行 1 件）で返す。
+      {"questions": ["...", {"id": "q1", "question": "..."}]}  または NDJSON 本文（1 行 1 質問）
+    各行: {"id", "question", "answer", "suggestions", "sources", "cached", "secs"}。
+    失敗した質問は {"id", "question", "error", "secs"}。順番は入力順ではないので id で対応づける。
+    """
+    try:
+        items = parse_items(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"不正なリクエストです: {e}")
+    if not items:
+        raise HTTPException(status_code=400, detail="質問がありません。")
+    if len(items) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"質問は {BATCH_MAX_QUESTIONS} 件までです。")
+    inflight.acquire()  # バッチ全体で 1 件と数える（LLM の同時数は batch_llm_slots で別に絞る）。返すのは応答の送信後
+
+    async def lines() -> AsyncIterator[str]:
+        t0 = time.perf_counter()
+        n = 0
+        try:
+            async for row in answer_batch(items):
+                n += 1
+                yield json.dumps(row, ensure_ascii=False) + "\n"
+        finally:
+            log.info(f"[batch] {n}/{len(items)} answered in {time.perf_counter() - t0:.1f}s")
+
+    return GatedStreamingResponse(lines(), inflight, media_type="application/x-ndjson")
@@ -0,0 +1,233 @@
+# metrics.py
+"""
+Prometheus 形式（text exposition 0.0.4）のメトリクス。依存ライブラリ無しの最小実装。
+
+  stage_seconds = REGISTRY.histogram("rag_stage_seconds", "処理段ごとの所要時間", ["stage"])
+  with stage_seconds.time(stage="embed"):
+      ...
+  REGISTRY.render()   # GET /metrics の本文
+
+値はプロセス内に持つ。gunicorn の複数ワーカーでは、スクレイプに応答したワーカーの値になる
+（process_resident_memory_bytes の pid でどのワーカーか分かる）。
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from tracing import new_trace_id, trace_id_var
+
+# 秒。埋め込み・検索（数 ms）から LLM（数十秒）まで
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: labels must be {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def lines(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def lines(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Labels, List[float]] = {}  # [各バケットの個数..., +Inf, sum]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            s[i] += 1
+            s[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, **labels)
+
+    def count(self, **labels: str) -> int:
+        s = self._series.get(self._key(labels))
+        return int(sum(s[:-1])) if s else 0
+
+    def lines(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        out: List[str] = []
+        for key, s in items:
+            acc = 0.0
+            for le, n in zip((*self.buckets, float("inf")), s[:-1]):
+                acc += n
+                le_label = f'le="{_num(le)}"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le_label)} {_num(acc)}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(s[-1])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {_num(acc)}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        # 呼ばれた時点の値を返す関数（キャッシュのヒット数など、既にどこかで数えている値を出す用）
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]] = []
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, fn: Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]) -> None:
+        """fn は (名前, 型 counter/gauge, 説明, ラベル, 値) を返す"""
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            body = m.lines()
+            if body:
+                lines.extend(m.header())
+                lines.extend(body)
+        seen: Dict[str, bool] = {}
+        for fn in self._collectors:
+            for name, kind, help, labels, value in fn():
+                if name not in seen:
+                    seen[name] = True
+                    lines.extend([f"# HELP {name} {help}", f"# TYPE {name} {kind}"])
+                lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_num(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI ミドルウェア: リクエストごとにトレース ID を決め（X-Request-ID があればそれ）、応答ヘッダに返す。
+    所要時間はレスポンス本文を送り終えるまで（ストリーミングも最後のチャンクまで）を route ごとに記録する
+    """
+
+    def __init__(self, app, histogram: Histogram, header: str = "x-request-id"):
+        self.app = app
+        self.histogram = histogram
+        self.header = header.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope.get("headers") or []).get(self.header, b"").decode("latin-1")
+        trace_id = incoming[:64] if incoming else new_trace_id()
+        token = trace_id_var.set(trace_id)
+        state = {"status": 500, "done": False}
+        t = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                message["headers"] = list(message.get("headers") or []) + [(self.header, trace_id.encode("latin-1"))]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                self._observe(scope, state, t)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException:
+            state["status"] = 500
+            self._observe(scope, state, t)
+            raise
+        finally:
+            trace_id_var.reset(token)
+
+    def _observe(self, scope, state: Dict, t: float) -> None:
+        if state["done"]:
+            return
+        state["done"] = True
+        # 実際のパスではなくルートのテンプレートでまとめる（未定義のパスでラベルが増えないように）
+        route = scope.get("route")
+        endpoint = scope.get("endpoint")
+        path = getattr(route, "path", None) or getattr(endpoint, "__name__", None) or "other"
+        self.histogram.observe(time.perf_counter() - t, route=path, method=scope.get("method", ""),
+                               status=str(state["status"]))
+
+
+def process_collector() -> Iterable[Tuple[str, str, str, Dict[str, str], float]]:
+    """プロセスの RSS（Linux のみ）"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            rss_pages = int(f.read().split()[1])
+        yield ("process_resident_memory_bytes", "gauge", "Resident memory size in bytes.",
+               {"pid": str(os.getpid())}, rss_pages * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError, IndexError):
+        return
@@ -0,0 +1,167 @@
+# note_api_stub.py
+"""
+note.com の v2 一覧 API / v3 詳細 API を模したローカル用スタブサーバ。
+fetch_notes.py を本番に負荷をかけずに試す・計測するためのもの。
+
+  python note_api_stub.py --notes 120 --per-page 6 --latency-ms 150 --port 8765
+  NOTE_API_BASE=http://127.0.0.1:8765 NOTE_USER_ID=stub ARTICLES_DIR=/tmp/articles python fetch_notes.py
+
+--fail-first N で詳細 API が記事ごとに最初の N 回 503 を返す（再試行の確認用）。
+server.state には受けたリクエスト数・到着時刻・詳細の同時処理数の最大値が残る。
+"""
+import re
+import json
+import hashlib
+import time
+import argparse
+import threading
+import datetime as dt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+LIST_PATH = re.compile(r"^/api/v2/creators/(?P<user>[^/]+)/contents$")
+DETAIL_PATH = re.compile(r"^/api/v3/notes/(?P<key>[^/]+)$")
+
+_PLACES = ["鎌倉", "箱根", "小樽", "金沢", "那覇", "松本", "函館", "尾道"]
+
+
+def make_notes(n: int, base_time: Optional[dt.datetime] = None) -> List[Dict[str, Any]]:
+    """新しい順に並んだ合成記事（一覧 API と同じく新着が先頭）"""
+    base_time = base_time or dt.datetime(2024, 1, 1, 9, 0, 0)
+    notes = []
+    for i in range(n):
+        place = _PLACES[i % len(_PLACES)]
+        ts = (base_time - dt.timedelta(days=i)).isoformat() + "+09:00"
+        body = "".join(
+            f"<p>{place}を歩いた記録 その{j}。<a href=\"https://example.com/{i}/{j}\">地図</a>を見ながら散策した。</p>"
+            for j in range(8)
+        )
+        body += f"<figure data-src=\"https://example.com/img/{i}.jpg\"><img src=\"x\"></figure>"
+        notes.append({
+            "id": 1000 + i,
+            "key": f"n{i:06x}",
+            "slug": f"slug-{i}",
+            "name": f"{place}旅行記 {i}",
+            "publishAt": ts,
+            "updatedAt": ts,
+            "body": body,
+        })
+    return notes
+
+
+class StubState:
+    def __init__(self, notes: List[Dict[str, Any]], per_page: int, latency: float, fail_first: int = 0):
+        self.notes = notes
+        self.by_key = {n["key"]: n for n in notes}
+        self.per_page = per_page
+        self.latency = latency
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+        self.requests = {"list": 0, "detail": 0}
+        self.arrivals: List[float] = []         # 全リクエストの到着時刻（time.monotonic）
+        self.failed: Dict[str, int] = {}        # 記事キー → 返した 503 の回数
+        self.inflight = 0                       # 処理中の詳細リクエスト数
+        self.max_inflight = 0
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):  # 静かに
+            pass
+
+        def _json(self, status: int, payload: Any, etag: Optional[str] = None) -> None:
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            if etag:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            with state.lock:
+                state.arrivals.append(time.monotonic())
+            u = urlparse(self.path)
+            if not DETAIL_PATH.match(u.path):
+                return self._get(u)
+            with state.lock:
+                state.inflight += 1
+                state.max_inflight = max(state.max_inflight, state.inflight)
+            try:
+                return self._get(u)
+            finally:
+                with state.lock:
+                    state.inflight -= 1
+
+        def _get(self, u):
+            if state.latency > 0:
+                time.sleep(state.latency)
+            m = LIST_PATH.match(u.path)
+            if m:
+                with state.lock:
+                    state.requests["list"] += 1
+                page = int((parse_qs(u.query).get("page") or ["1"])[0])
+                start = (page - 1) * state.per_page
+                items = state.notes[start:start + state.per_page]
+                contents = [{k: v for k, v in n.items() if k != "body"} for n in items]
+                is_last = start + state.per_page >= len(state.notes)
+                return self._json(200, {"data": {"contents": contents, "isLastPage": is_last}})
+            m = DETAIL_PATH.match(u.path)
+            if m:
+                with state.lock:
+                    state.requests["detail"] += 1
+                note = state.by_key.get(m.group("key"))
+                if not note:
+                    return self._json(404, {"error": "not found"})
+                with state.lock:
+                    fail = state.failed.get(note["key"], 0) < state.fail_first
+                    if fail:
+                        state.failed[note["key"]] = state.failed.get(note["key"], 0) + 1
+                if fail:
+                    return self._json(503, {"error": "temporarily unavailable"})
+                # 条件付きリクエスト（If-None-Match）に 304 で応える
+                etag = '"' + hashlib.sha1((note["updatedAt"] + note["body"]).encode("utf-8")).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                return self._json(200, {"data": {"key": note["key"], "body": note["body"]}}, etag=etag)
+            return self._json(404, {"error": "unknown path"})
+
+    return Handler
+
+
+def serve(notes: int = 60, per_page: int = 6, latency_ms: float = 100.0,
+          host: str = "127.0.0.1", port: int = 8765, fail_first: int = 0) -> ThreadingHTTPServer:
+    """バックグラウンドスレッドで起動したサーバを返す（server.shutdown() で停止。port=0 なら空きポート）"""
+    state = StubState(make_notes(notes), per_page, latency_ms / 1000.0, fail_first)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.state = state
+    threading.Thread(target=server.serve_forever, name="note-stub", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="note.com API stub server")
+    ap.add_argument("--notes", type=int, default=60)
+    ap.add_argument("--per-page", type=int, default=6)
+    ap.add_argument("--latency-ms", type=float, default=100.0)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--fail-first", type=int, default=0, help="詳細 API が記事ごとに最初の N 回 503 を返す")
+    args = ap.parse_args()
+    server = serve(args.notes, args.per_page, args.latency_ms, args.host, args.port, args.fail_first)
+    print(f"[stub] listening on http://{args.host}:{args.port} (notes={args.notes}, per_page={args.per_page})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"[stub] requests={server.state.requests}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# query_embedder.py
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+EncodeFn = Callable[[List[str]], Sequence[Sequence[float]]]
+
+
+class MicroBatchEmbedder:
+    """
+    同時に届いたクエリ文字列を短い時間窓（max_wait_ms）でまとめ、
+    1 回の encode で埋め込んでから各呼び出し元の future を解決する。
+
+    CPU 推論では 1 件でも 16〜32 件でも 1 回の forward のコストはほぼ変わらないため、
+    同時リクエストが多いほどスループットが伸びる。待ち時間は最大 max_wait_ms。
+    """
+
+    def __init__(self, encode_fn: EncodeFn, executor: Executor,
+                 max_batch: int = 32, max_wait_ms: float = 5.0):
+        self._encode = encode_fn
+        self._executor = executor
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # 統計（/health 用）
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_worker(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def embed(self, text: str) -> List[float]:
+        """1 件のクエリを埋め込む（内部で他リクエストとまとめて encode される）"""
+        self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, fut))
+        return await fut
+
+    def stats(self) -> dict:
+        avg = (self.items / self.batches) if self.batches else 0.0
+        return {"batches": self.batches, "items": self.items, "avg_batch": round(avg, 2)}
+
+    async def _collect(self) -> List[Tuple[str, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            # 既に積まれている分は待たずに取り込む
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # 呼び出し元が既にキャンセルしたものは encode しない
+        return [(t, f) for t, f in batch if not f.done()]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            texts = [t for t, _ in batch]
+            try:
+                vecs = await loop.run_in_executor(self._executor, self._encode, texts)
+            except Exception as e:
+                log.error(f"[embed-batch] encode failed (n={len(texts)}): {e}")
+                for _, f in batch:
+                    if not f.done():
+                        f.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(texts)
+            for (_, f), v in zip(batch, vecs):
+                if not f.done():
+                    f.set_result(list(v))
@@ -0,0 +1,181 @@
+# reranker.py
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from answer_cache import normalize_question
+
+log = logging.getLogger(__name__)
+
+
+class Reranker:
+    """
+    検索候補をクロスエンコーダ（CPU）で採点し直して上位 k 件に絞る。
+
+    - 採点は候補の上から batch_size 件ずつ。1 件あたりの所要時間（直近の移動平均）から
+      残り予算に収まる件数だけ採点し、収まらない分は元の順位のまま後ろに並べる（予算は超えない）
+    - 見積もりが予算を超えて 1 件も採点できなかったときは、リクエストとは別のスレッドで
+      候補 1 件だけ採点し直して見積もりを更新する（probe_secs に 1 回まで）。
+      一度遅いバッチがあっただけで以後ずっと採点しなくなるのを防ぐ
+    - 予算があるとき、まだ推論していない（読み込み・初回推論が遅い）モデルはリクエストでは使わず、
+      裏で warm_up してから使い始める。それまでは元の順位のまま返す
+    - スコアは (正規化した質問の sha1, チャンク ID) 単位で LRU キャッシュ。
+      version_fn の値が変わったら（コレクション更新）全消去する
+    cpu_pool のスレッドから呼ばれるのでキャッシュはロックで守る。
+    モデルは load_model() で取得する（初回呼び出しまで読み込みを遅らせられる）。
+    """
+
+    def __init__(self, load_model: Callable[[], Any], batch_size: int = 16, budget_ms: float = 150.0,
+                 cache_entries: int = 20000, version_fn: Optional[Callable[[], str]] = None,
+                 probe_secs: float = 5.0):
+        self._load_model = load_model
+        self.batch_size = max(1, batch_size)
+        self.budget_ms = budget_ms
+        self.cache_entries = cache_entries
+        self._version_fn = version_fn
+        self._version = version_fn() if version_fn else ""
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._item_ms = 0.0  # 1 件あたりの採点時間（EWMA）
+        self._cold = True    # まだ warm_up していない
+        self.probe_secs = probe_secs
+        self._probing = False
+        self._next_probe = 0.0
+        self.counters = {"calls": 0, "scored": 0, "cache_hits": 0, "over_budget": 0, "probes": 0,
+                         "ms_total": 0.0}
+
+    # ── キャッシュ ────────────────────────────────────────────────────
+    def _cached(self, keys: Sequence[Tuple[str, str]]) -> Dict[Tuple[str, str], float]:
+        with self._lock:
+            if self._version_fn:
+                v = self._version_fn()
+                if v != self._version:
+                    self._version = v
+                    self._cache.clear()
+            out = {}
+            for key in keys:
+                s = self._cache.get(key)
+                if s is not None:
+                    self._cache.move_to_end(key)
+                    out[key] = s
+            return out
+
+    def _store(self, scored: Dict[Tuple[str, str], float]) -> None:
+        with self._lock:
+            for key, s in scored.items():
+                self._cache[key] = s
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+
+    # ── 公開 API ─────────────────────────────────────────────────────
+    def rerank(self, question: str, ids: Sequence[str], docs: Sequence[str], k: int) -> List[int]:
+        """並べ替え後の上位 k 件を、入力リストでの添字で返す（同期。cpu_pool から呼ぶ）"""
+        t0 = time.perf_counter()
+        qh = hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+        keys = [(qh, doc_id) for doc_id in ids]
+        cached = self._cached(keys)
+        scores = {i: cached[key] for i, key in enumerate(keys) if key in cached}
+        hits = len(scores)
+
+        todo = [i for i in range(len(ids)) if i not in scores]
+        fresh: Dict[Tuple[str, str], float] = {}
+        over_budget = False
+        budgeted = self.budget_ms > 0
+        if todo and budgeted and self._cold:
+            # 読み込み・初回推論は予算に収まらないので裏で済ませる
+            over_budget = True
+            self._in_background(self.warm_up)
+            todo = []
+        while todo:
+            batch = todo[:self.batch_size]
+            if budgeted and self._item_ms > 0:
+                remaining_ms = self.budget_ms - (time.perf_counter() - t0) * 1000
+                batch = batch[:max(0, int(remaining_ms / self._item_ms))]
+                if not batch:
+                    over_budget = True
+                    if not fresh:
+                        # 見積もりが予算を超えている。戻ってこられるよう裏で 1 件だけ測り直す
+                        i = todo[0]
+                        self._in_background(lambda: self._probe(question, docs[i]))
+                    break
+            todo = todo[len(batch):]
+            tb = time.perf_counter()
+            out = self._load_model().predict([(question, docs[i]) for i in batch],
+                                             batch_size=len(batch), show_progress_bar=False)
+            self._observe((time.perf_counter() - tb) * 1000 / len(batch))
+            for i, s in zip(batch, out):
+                scores[i] = float(s)
+                fresh[keys[i]] = float(s)
+        if fresh:
+            self._store(fresh)
+
+        # 採点済みはスコア順、打ち切りで未採点のものは元の順位のまま後ろへ
+        ranked = sorted(scores, key=lambda i: -scores[i])
+        ranked += [i for i in range(len(ids)) if i not in scores]
+
+        with self._lock:
+            c = self.counters
+            c["calls"] += 1
+            c["scored"] += len(fresh)
+            c["cache_hits"] += hits
+            c["over_budget"] += int(over_budget)
+            c["ms_total"] += (time.perf_counter() - t0) * 1000
+        return ranked[:k]
+
+    def load(self) -> None:
+        self._load_model()
+
+    # ── 見積もり ─────────────────────────────────────────────────────
+    def _observe(self, item_ms: float) -> None:
+        self._item_ms = item_ms if self._item_ms == 0 else 0.8 * self._item_ms + 0.2 * item_ms
+
+    def _probe(self, question: str, doc: str) -> None:
+        t = time.perf_counter()
+        self._load_model().predict([(question, doc)], batch_size=1, show_progress_bar=False)
+        self._observe((time.perf_counter() - t) * 1000)
+        with self._lock:
+            self.counters["probes"] += 1
+
+    def _in_background(self, fn: Callable[[], None]) -> None:
+        """fn をリクエストとは別のスレッドで実行する（同時に 1 つ、probe_secs に 1 回まで）"""
+        with self._lock:
+            now = time.monotonic()
+            if self._probing or now < self._next_probe:
+                return
+            self._probing = True
+            self._next_probe = now + self.probe_secs
+
+        def run() -> None:
+            try:
+                fn()
+            except Exception as e:
+                log.warning(f"[rerank] background probe failed: {e}")
+            finally:
+                with self._lock:
+                    self._probing = False
+
+        threading.Thread(target=run, name="rerank-probe", daemon=True).start()
+
+    def warm_up(self) -> None:
+        """モデルを読み込み、ダミー 1 バッチで推論を温める（1 件あたりの所要時間の初期値にもなる）"""
+        model = self._load_model()
+        pairs = [("ウォームアップ", "ウォームアップ用の文章です。")] * self.batch_size
+        model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)  # 初回は遅いので計測しない
+        t = time.perf_counter()
+        model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        self._item_ms = (time.perf_counter() - t) * 1000 / len(pairs)
+        self._cold = False
+
+    def stats(self) -> dict:
+        c = self.counters
+        return {
+            **{k: v for k, v in c.items() if k != "ms_total"},
+            "avg_ms": round(c["ms_total"] / c["calls"], 2) if c["calls"] else 0.0,
+            "cache_entries": len(self._cache),
+            "budget_ms": self.budget_ms,
+            "item_ms": round(self._item_ms, 3),
+        }
@@ -0,0 +1,353 @@
+# retrieval_backend.py
+"""
+ベクトル検索の差し替え可能なバックエンド。
+
+- ChromaBackend : 従来どおり coll.query / coll.get
+- MatrixBackend : embed_articles.py が書き出したスナップショット（vector_snapshot.py）を memmap で開いて
+                  numpy の行列積で検索する。float16/int8 の行列や、件数が多いときの IVF / HNSW で候補を絞り、
+                  元の埋め込みで Chroma と同じ距離を計算し直して並べる
+
+どちらも (ids, docs, metas, dists) を返し、query_many で複数クエリをまとめて検索できる。
+flt（search_filter.SearchFilter）を渡すと、Chroma は where、行列はスナップショットの絞り込み列で
+条件に合うチャンクだけを対象に検索する。
+"""
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from search_filter import SearchFilter
+from vector_snapshot import Snapshot, normalize_rows, read_pointer
+
+log = logging.getLogger(__name__)
+
+Hits = Tuple[List[str], List[str], List[dict], List[float]]
+EMPTY: Hits = ([], [], [], [])
+
+
+class RetrievalBackend:
+    name = "base"
+
+    def available(self) -> bool:
+        return True
+
+    def query(self, q_emb: Sequence[float], k: int, flt: Optional[SearchFilter] = None) -> Hits:
+        return self.query_many([q_emb], k, flt)[0]
+
+    def query_many(self, q_embs: Sequence[Sequence[float]], k: int,
+                   flt: Optional[SearchFilter] = None) -> List[Hits]:
+        raise NotImplementedError
+
+    def get(self, ids: Sequence[str], q_emb: Sequence[float], flt: Optional[SearchFilter] = None) -> Hits:
+        """ID 指定で取り出し、クエリとの距離も付けて返す（無い ID・条件に合わない ID は飛ばす）"""
+        raise NotImplementedError
+
+    def titles(self) -> Dict[str, str]:
+        """{filename: title}（タイトルの部分一致を filename に解決するため）"""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+def _distances(q_emb: Sequence[float], embs: Sequence[Sequence[float]], space: str) -> List[float]:
+    if not len(embs):
+        return []
+    q = np.asarray(q_emb, dtype=np.float32)
+    m = np.asarray(embs, dtype=np.float32)
+    if space == "cosine":
+        denom = np.linalg.norm(m, axis=1) * max(float(np.linalg.norm(q)), 1e-12)
+        return (1.0 - (m @ q) / np.maximum(denom, 1e-12)).tolist()
+    if space == "ip":
+        return (1.0 - m @ q).tolist()
+    return ((m - q) ** 2).sum(axis=1).tolist()  # l2（Chroma の既定。二乗距離）
+
+
+class ChromaBackend(RetrievalBackend):
+    name = "chroma"
+
+    def __init__(self, get_collection: Callable[[], object], refresh: Optional[Callable[[], object]] = None,
+                 version_fn: Optional[Callable[[], str]] = None):
+        self._get_collection = get_collection
+        self._refresh = refresh
+        self._version_fn = version_fn
+        self._titles: Tuple[Any, Dict[str, str]] = (None, {})
+        self.shared_chunks = 0  # query_many で重複を除いて取得を省いたチャンク数
+
+    def _call(self, fn: Callable[[object], dict]) -> dict:
+        from chromadb.errors import NotFoundError
+
+        try:
+            return fn(self._get_collection())
+        except NotFoundError:
+            # 掴んでいた版が消えた直後など。エイリアスを読み直してもう一度
+            if self._refresh is not None:
+                self._refresh()
+            return fn(self._get_collection())
+
+    def query_many(self, q_embs: Sequence[Sequence[float]], k: int,
+                   flt: Optional[SearchFilter] = None) -> List[Hits]:
+        if not len(q_embs):
+            return []
+        where = flt.where() if flt is not None else None
+        filt = {"where": where} if where else {}
+        # ※ include に 'ids' は入れない（現行 Chroma は非対応。ids はレスポンスに含まれる）
+        if len(q_embs) == 1:
+            res = self._call(lambda coll: coll.query(
+                query_embeddings=[list(q_embs[0])],
+                n_results=k,
+                include=["documents", "metadatas", "distances"],
+                **filt,
+            ))
+            return [(
+                (res.get("ids") or [[]])[0] or [],
+                (res.get("documents") or [[]])[0] or [],
+                (res.get("metadatas") or [[]])[0] or [],
+                (res.get("distances") or [[]])[0] or [],
+            )]
+
+        # 複数クエリは同じチャンクが何度も出るので、検索では ID と距離だけ取り、本文・メタは重複を除いて 1 回で引く
+        res = self._call(lambda coll: coll.query(
+            query_embeddings=[list(q) for q in q_embs],
+            n_results=k,
+            include=["distances"],
+            **filt,
+        ))
+        id_lists = [list(x or []) for x in (res.get("ids") or [])]
+        dist_lists = [list(x or []) for x in (res.get("distances") or [])]
+        unique = list(dict.fromkeys(doc_id for ids in id_lists for doc_id in ids))
+        rows: Dict[str, Tuple[str, dict]] = {}
+        if unique:
+            got = self._call(lambda coll: coll.get(ids=unique, include=["documents", "metadatas"]))
+            for doc_id, doc, meta in zip(got.get("ids") or [], got.get("documents") or [], got.get("metadatas") or []):
+                rows[doc_id] = (doc, meta)
+        self.shared_chunks += sum(len(ids) for ids in id_lists) - len(unique)
+        out: List[Hits] = []
+        for j in range(len(q_embs)):
+            ids = id_lists[j] if j < len(id_lists) else []
+            dists = dist_lists[j] if j < len(dist_lists) else []
+            keep = [i for i, doc_id in enumerate(ids) if doc_id in rows]
+            out.append((
+                [ids[i] for i in keep],
+                [rows[ids[i]][0] for i in keep],
+                [rows[ids[i]][1] for i in keep],
+                [dists[i] for i in keep],
+            ))
+        return out
+
+    def get(self, ids: Sequence[str], q_emb: Sequence[float], flt: Optional[SearchFilter] = None) -> Hits:
+        if not ids:
+            return EMPTY
+        where = flt.where() if flt is not None else None
+        filt = {"where": where} if where else {}
+        answered: List[object] = []
+
+        def fetch(coll) -> dict:
+            answered[:] = [coll]
+            return coll.get(ids=list(ids), include=["documents", "metadatas", "embeddings"], **filt)
+
+        res = self._call(fetch)
+        # 距離の種類は実際に答えた版のもの（読み直しで版が変わっていることがある）
+        space = (answered[0].metadata or {}).get("hnsw:space", "l2")
+        embs = res.get("embeddings")
+        got_ids = list(res.get("ids") or [])
+        return (
+            got_ids,
+            list(res.get("documents") or []),
+            list(res.get("metadatas") or []),
+            _distances(q_emb, [] if embs is None else list(embs), space),
+        )
+
+    def count(self) -> int:
+        return self._get_collection().count()
+
+    def titles(self, page_size: int = 2000) -> Dict[str, str]:
+        """全チャンクのメタを読んで作る。コレクション（名前・世代）が変わるまで使い回す"""
+        coll = self._get_collection()
+        key = (coll.name, self._version_fn() if self._version_fn else None)
+        if self._titles[0] == key:
+            return self._titles[1]
+        titles: Dict[str, str] = {}
+        offset = 0
+        while True:
+            res = coll.get(include=["metadatas"], limit=page_size, offset=offset)
+            metas = res.get("metadatas") or []
+            for m in metas:
+                if m and m.get("filename") and m["filename"] not in titles:
+                    titles[m["filename"]] = m.get("title") or ""
+            if len(metas) < page_size:
+                break
+            offset += page_size
+        self._titles = (key, titles)
+        return titles
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "shared_chunks": self.shared_chunks}
+
+
+class MatrixBackend(RetrievalBackend):
+    """
+    スナップショットの総当たり / 近似検索。ポインタファイルの確認は min_interval 秒に 1 回で、
+    新しい世代は参照の差し替えだけで切り替わる（検索中のスレッドは古い世代のまま終わる）。
+
+    float32 で近似索引が無ければ元の埋め込みで総当たり（Chroma と同じ結果）。float16/int8・IVF・HNSW では
+    候補を rescore 倍多めに取り、元の float32 埋め込みで距離を計算し直して上位 k 件にする
+    （量子化・近似索引の誤差をここで吸収する）。
+    """
+    name = "matrix"
+
+    def __init__(self, persist_dir: str, collection: str, min_interval: float = 1.0,
+                 rescore: int = 4, nprobe: int = 16, ef: int = 128):
+        self.persist_dir = persist_dir
+        self.collection = collection
+        self.min_interval = min_interval
+        self.rescore = max(1, rescore)
+        self.nprobe = nprobe
+        self.ef = ef
+        self._lock = threading.Lock()
+        self._snap: Optional[Snapshot] = None
+        self._name: Optional[str] = None
+        self._checked = float("-inf")
+        self.swaps = 0
+
+    def reload(self) -> bool:
+        now = time.monotonic()
+        if now - self._checked < self.min_interval:
+            return False
+        with self._lock:
+            self._checked = now
+            name = read_pointer(self.persist_dir, self.collection)
+            if not name or name == self._name:
+                return False
+            t = time.perf_counter()
+            snap = Snapshot(f"{self.persist_dir}/{name}")
+            self._snap, self._name = snap, name
+            self.swaps += 1
+        log.info(f"[matrix] loaded {name} ({len(snap)} rows, unit={snap.unit.dtype}, ann={snap.ann}) "
+                 f"in {time.perf_counter() - t:.2f}s")
+        return True
+
+    def available(self) -> bool:
+        self.reload()
+        return self._snap is not None
+
+    def count(self) -> int:
+        snap = self._snap
+        return len(snap) if snap else 0
+
+    def _candidates(self, snap: Snapshot, q: np.ndarray, n_cand: int) -> List[np.ndarray]:
+        """クエリごとの候補行（Snapshot.approx_scores の上位 n_cand、近似索引があればその結果）"""
+        qn = normalize_rows(q)
+        if snap.hnsw is not None:
+            snap.hnsw.set_ef(max(self.ef, n_cand))
+            labels, _ = snap.hnsw.knn_query(qn if snap.space == "cosine" else q, k=n_cand)
+            return [np.asarray(row, dtype=np.int64) for row in labels]
+        if snap.ivf is not None:
+            cent, order, ptr = snap.ivf
+            probes = np.argsort(-(qn @ np.asarray(cent).T), axis=1)[:, :self.nprobe]
+            out = []
+            for j, lists in enumerate(probes):
+                rows = np.concatenate([order[ptr[c]:ptr[c + 1]] for c in lists]).astype(np.int64)
+                if len(rows) > n_cand:
+                    s = snap.approx_scores(q[j:j + 1], rows)[:, 0]
+                    rows = rows[np.argpartition(-s, n_cand - 1)[:n_cand]]
+                out.append(rows)
+            return out
+        if n_cand >= len(snap):
+            return [np.arange(len(snap)) for _ in range(len(q))]
+        scores = snap.approx_scores(q)  # (n, m)
+        top = np.argpartition(-scores, n_cand - 1, axis=0)[:n_cand]
+        return [top[:, j] for j in range(len(q))]
+
+    @staticmethod
+    def _exact(snap: Snapshot, q: np.ndarray, k: int) -> List[np.ndarray]:
+        """float32 の総当たり: 全行の距離を 1 回の行列積で出して上位 k 行を選ぶ"""
+        d = snap.distances(q)  # (n, m)
+        if k >= len(snap):
+            return [np.arange(len(snap)) for _ in range(len(q))]
+        top = np.argpartition(d, k - 1, axis=0)[:k]
+        return [top[:, j] for j in range(len(q))]
+
+    def query_many(self, q_embs: Sequence[Sequence[float]], k: int,
+                   flt: Optional[SearchFilter] = None) -> List[Hits]:
+        self.reload()
+        snap = self._snap
+        if snap is None or not len(snap) or k <= 0:
+            return [EMPTY for _ in q_embs]
+        q = np.asarray(q_embs, dtype=np.float32).reshape(len(q_embs), -1)
+        k = min(k, len(snap))
+        if flt is not None and flt.filtering:
+            # 絞り込みは条件に合う行だけを元の埋め込みで総当たり（近似索引は使わない）
+            cands = [snap.select(flt)] * len(q)
+        elif snap.ann == "none" and snap.unit.dtype == np.float32:
+            cands = self._exact(snap, q, k)
+        else:
+            cands = self._candidates(snap, q, min(len(snap), k * self.rescore))
+        out: List[Hits] = []
+        for j, rows in enumerate(cands):
+            if not len(rows):
+                out.append(EMPTY)
+                continue
+            d = snap.distances(q[j], rows)
+            if len(d) > k:  # 絞り込みの行は多いことがあるので全体は並べない
+                part = np.argpartition(d, k - 1)[:k]
+                best = part[np.argsort(d[part], kind="stable")]
+            else:
+                best = np.argsort(d, kind="stable")
+            top = rows[best]
+            out.append((
+                [snap.ids[i] for i in top],
+                [snap.doc(i) for i in top],
+                [snap.metadata(i) for i in top],
+                [float(x) for x in d[best]],
+            ))
+        return out
+
+    def get(self, ids: Sequence[str], q_emb: Sequence[float], flt: Optional[SearchFilter] = None) -> Hits:
+        self.reload()
+        snap = self._snap
+        if snap is None:
+            return EMPTY
+        rows = [snap.row_of[d] for d in ids if d in snap.row_of]
+        if rows and flt is not None and flt.filtering:
+            allowed = set(snap.select(flt).tolist())
+            rows = [i for i in rows if i in allowed]
+        if not rows:
+            return EMPTY
+        d = snap.distances(np.asarray(q_emb, dtype=np.float32), np.asarray(rows))
+        return (
+            [snap.ids[i] for i in rows],
+            [snap.doc(i) for i in rows],
+            [snap.metadata(i) for i in rows],
+            [float(x) for x in d],
+        )
+
+    def titles(self) -> Dict[str, str]:
+        self.reload()
+        snap = self._snap
+        return snap.titles() if snap is not None else {}
+
+    def stats(self) -> dict:
+        snap = self._snap
+        if snap is None:
+            return {"backend": self.name, "loaded": False}
+        return {"backend": self.name, "loaded": True, "name": self._name, "count": len(snap),
+                "dim": snap.meta.get("dim"), "space": snap.space, "unit_dtype": str(snap.unit.dtype),
+                "ann": snap.ann, "model": snap.meta.get("model"), "swaps": self.swaps}
+
+
+def make_backend(kind: str, get_collection: Callable[[], object], persist_dir: str, collection: str,
+                 refresh: Optional[Callable[[], object]] = None, version_fn: Optional[Callable[[], str]] = None,
+                 **options) -> Tuple[ChromaBackend, Optional[MatrixBackend]]:
+    """(Chroma, 行列) の組を返す。行列側は kind が matrix（旧名 snapshot）のときだけ作る"""
+    chroma = ChromaBackend(get_collection, refresh, version_fn)
+    if kind in ("matrix", "snapshot"):
+        return chroma, MatrixBackend(persist_dir, collection, **options)
+    if kind != "chroma":
+        raise ValueError(f"RETRIEVAL_BACKEND must be chroma / matrix: {kind}")
+    return chroma, None
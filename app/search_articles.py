@@ -1,27 +1,34 @@
 # search_articles.py
+# API の /search で記事を検索する（モデル・Chroma は API 側で持つ。先に main.py を起動しておく）
+#   python search_articles.py "京都 カフェ" --page 2
 
-import os
-import chromadb
-from sentence_transformers import SentenceTransformer
-from bs4 import BeautifulSoup
+import argparse
 
-PERSIST_DIR = os.environ.get("CHROMA_PERSIST_DIR", "chroma_db")
-COLLECTION  = os.environ.get("CHROMA_COLLECTION", "note_articles")
-EMBED_MODEL = os.environ.get("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+from api_client import ApiClient, ApiError
 
-client = chromadb.PersistentClient(path=PERSIST_DIR)
-collection = client.get_collection(COLLECTION)
-model = SentenceTransformer(EMBED_MODEL)
+ap = argparse.ArgumentParser(description="記事を検索する（POST /search）")
+ap.add_argument("query", nargs="?", help="検索語（省略すると入力を促す）")
+ap.add_argument("-n", "--page-size", type=int, default=3)
+ap.add_argument("--page", type=int, default=1)
+ap.add_argument("--snippet-chars", type=int, default=600)
+args = ap.parse_args()
 
-query = input("検索したい内容を入力してください: ").strip()
+query = (args.query or input("検索したい内容を入力してください: ")).strip()
 if not query:
     print("空のクエリです。終了します。")
     raise SystemExit(0)
 
-query_emb = model.encode([query])[0]
-results = collection.query(query_embeddings=[query_emb.tolist()], n_results=3)
+api = ApiClient.from_env()
+try:
+    data = api.search(query, page=args.page, page_size=args.page_size, highlight=False,
+                      snippet_chars=args.snippet_chars)
+except ApiError as e:
+    print(f"検索に失敗しました: {e}")
+    raise SystemExit(1)
 
-for doc, meta in zip(results["documents"][0], results["metadatas"][0]):
-    soup = BeautifulSoup(doc, "html.parser")
-    text = soup.get_text(separator="\n")
-    print(f"\n--- {meta.get('filename','(no name)')} ---\n{text[:600]} ...")
+for r in data.get("results") or []:
+    print(f"\n--- [{r['rank']}] {r.get('filename', '(no name)')} ({r.get('distance', 0):.3f}) ---\n{r.get('text', '')}")
+if not data.get("results"):
+    print("該当する記事が見つかりませんでした。")
+elif data.get("has_more"):
+    print(f"\n（続きは --page {args.page + 1}）")
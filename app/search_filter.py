@@ -0,0 +1,183 @@
+# search_filter.py
+"""
+/query の絞り込み条件（公開日・更新日の範囲、user_id、タイトルの部分一致）と新しさの重み付け。
+
+日時は embed_articles.py が取り込み時に epoch 秒（published_ts / updated_ts）にしてメタに入れておき、
+検索時は Chroma の where（行列バックエンドはスナップショットの列）で候補そのものを絞る。
+タイトルの部分一致は Chroma の where では書けないので、タイトル一覧から該当する filename を先に集め、
+filename の $in にする。
+
+  {"question": "...", "filters": {"published_after": "2024-01-01", "published_before": "2024-06-30",
+                                  "user_id": "xxx", "title": "京都"},
+   "recency_half_life_days": 180}
+"""
+import math
+import time
+import unicodedata
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+JST = timezone(timedelta(hours=9))  # note の日時は JST。日付だけ・タイムゾーン無しの指定もこれで解釈する
+DAY_SECS = 86400
+
+# filters のキー → (メタのフィールド, 下限か)
+_RANGE_KEYS = {
+    "published_after": ("published_ts", True),
+    "published_before": ("published_ts", False),
+    "updated_after": ("updated_ts", True),
+    "updated_before": ("updated_ts", False),
+}
+
+
+def to_epoch(v: Any, end_of_day: bool = False) -> Optional[int]:
+    """ISO 8601 の日時・日付、または epoch 秒を epoch 秒にする。解釈できなければ None"""
+    if v is None or isinstance(v, bool):
+        return None
+    if isinstance(v, (int, float)):
+        return int(v) if math.isfinite(v) else None
+    s = str(v).strip()
+    if not s:
+        return None
+    try:
+        if len(s) == 10:
+            d = date.fromisoformat(s)
+            dt = datetime(d.year, d.month, d.day, tzinfo=JST)
+            # 「〜以前」の日付はその日の終わりまで含める
+            return int(dt.timestamp()) + (DAY_SECS - 1 if end_of_day else 0)
+        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=JST)
+    return int(dt.timestamp())
+
+
+def _norm(s: str) -> str:
+    return unicodedata.normalize("NFKC", s or "").lower()
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    ranges: Tuple[Tuple[str, Optional[int], Optional[int]], ...] = ()  # (フィールド, 下限, 上限)。両端含む
+    user_ids: Tuple[str, ...] = ()
+    title: str = ""
+    filenames: Optional[Tuple[str, ...]] = None   # title を解決した結果（resolve_titles 後）
+    recency_half_life_days: float = 0.0           # >0 で新しい記事ほど上に並べる
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any], default_half_life: float = 0.0) -> Optional["SearchFilter"]:
+        """リクエスト JSON から作る。条件が無ければ None、解釈できない値は ValueError"""
+        raw = payload.get("filters") or {}
+        if not isinstance(raw, dict):
+            raise ValueError("filters はオブジェクトで指定してください")
+        unknown = set(raw) - set(_RANGE_KEYS) - {"user_id", "title"}
+        if unknown:
+            raise ValueError(f"未対応の filters: {', '.join(sorted(unknown))}")
+
+        bounds: Dict[str, List[Optional[int]]] = {}
+        for key, (field, lower) in _RANGE_KEYS.items():
+            if raw.get(key) in (None, ""):
+                continue
+            ts = to_epoch(raw[key], end_of_day=not lower)
+            if ts is None:
+                raise ValueError(f"{key} は ISO 8601 の日付・日時か epoch 秒で指定してください: {raw[key]!r}")
+            bounds.setdefault(field, [None, None])[0 if lower else 1] = ts
+        ranges = tuple((field, lo, hi) for field, (lo, hi) in sorted(bounds.items()))
+
+        users = raw.get("user_id")
+        user_ids = tuple(str(u) for u in (users if isinstance(users, list) else [users]) if u not in (None, ""))
+        title = str(raw.get("title") or "").strip()
+
+        half_life = payload.get("recency_half_life_days", default_half_life)
+        try:
+            half_life = float(half_life or 0.0)
+        except (TypeError, ValueError):
+            raise ValueError(f"recency_half_life_days は数値で指定してください: {half_life!r}")
+        if half_life < 0 or not math.isfinite(half_life):
+            raise ValueError("recency_half_life_days は 0 以上で指定してください")
+
+        flt = cls(ranges=ranges, user_ids=user_ids, title=title, recency_half_life_days=half_life)
+        return flt if flt.filtering or flt.recency_half_life_days > 0 else None
+
+    @property
+    def filtering(self) -> bool:
+        """候補を絞る条件があるか（新しさの重み付けだけなら False）"""
+        return bool(self.ranges or self.user_ids or self.title)
+
+    @property
+    def needs_titles(self) -> bool:
+        return bool(self.title) and self.filenames is None
+
+    def resolve_titles(self, titles: Dict[str, str]) -> "SearchFilter":
+        """{filename: title} からタイトルに title を含む記事を集める（NFKC・大文字小文字を無視）"""
+        if not self.title:
+            return self
+        needle = _norm(self.title)
+        hits = tuple(sorted(fn for fn, t in titles.items() if needle in _norm(t or fn)))
+        return replace(self, filenames=hits)
+
+    def where(self) -> Optional[Dict[str, Any]]:
+        """Chroma の where 句（条件が無ければ None）"""
+        conds: List[Dict[str, Any]] = []
+        for field, lo, hi in self.ranges:
+            if lo is not None:
+                conds.append({field: {"$gte": lo}})
+            if hi is not None:
+                conds.append({field: {"$lte": hi}})
+        if self.user_ids:
+            conds.append({"user_id": {"$in": list(self.user_ids)}})
+        if self.filenames is not None:
+            conds.append({"filename": {"$in": list(self.filenames)}})
+        if not conds:
+            return None
+        return conds[0] if len(conds) == 1 else {"$and": conds}
+
+    def matches(self, meta: Dict[str, Any]) -> bool:
+        """where と同じ条件をメタ 1 件に当てる"""
+        meta = meta or {}
+        for field, lo, hi in self.ranges:
+            v = meta.get(field)
+            if not isinstance(v, (int, float)) or (lo is not None and v < lo) or (hi is not None and v > hi):
+                return False
+        if self.user_ids and meta.get("user_id") not in self.user_ids:
+            return False
+        if self.filenames is not None and meta.get("filename") not in self.filenames:
+            return False
+        return True
+
+    def key(self) -> str:
+        """回答キャッシュのキーに足す文字列（同じ質問でも条件が違えば別の回答）"""
+        parts = [f"{f}:{lo}-{hi}" for f, lo, hi in self.ranges]
+        if self.user_ids:
+            parts.append("user:" + ",".join(sorted(self.user_ids)))
+        if self.title:
+            parts.append("title:" + _norm(self.title))
+        if self.recency_half_life_days > 0:
+            parts.append(f"recency:{self.recency_half_life_days:g}")
+        return " ".join(parts)
+
+
+def published_ts(meta: Dict[str, Any]) -> Optional[float]:
+    for field in ("published_ts", "updated_ts"):
+        v = (meta or {}).get(field)
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            return float(v)
+    return None
+
+
+def recency_order(metas: Iterable[Dict[str, Any]], half_life_days: float, rank_k: int = 60,
+                  now: Optional[float] = None) -> List[int]:
+    """
+    検索順位と記事の新しさを掛け合わせた並び順（元の位置の列）を返す。
+    score = 1 / (rank_k + 順位) × 0.5 ** (経過日数 / half_life_days)。
+    rank_k は RRF と同じ定数で、順位の差を緩める（rank_k=60 なら 20 位下がる ≒ 半減期の 0.4 倍古い）。
+    日時が無い記事は半減期 1 つ分古いものとして扱う
+    """
+    now = time.time() if now is None else now
+    scores = []
+    for i, meta in enumerate(metas):
+        ts = published_ts(meta)
+        age_days = max(0.0, (now - ts) / DAY_SECS) if ts is not None else half_life_days
+        scores.append((1.0 / (rank_k + i)) * 0.5 ** (age_days / half_life_days))
+    return sorted(range(len(scores)), key=lambda i: -scores[i])
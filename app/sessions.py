@@ -0,0 +1,156 @@
+# sessions.py
+"""
+会話セッション（/query・/query/stream の session_id）。
+
+直前のターンの質問埋め込み・検索結果（チャンク ID / 本文 / メタ / 距離）と回答を覚えておき、
+- regenerate: 直前と同じ質問の再生成は、検索せずに直前の検索結果でそのまま LLM を呼び直す
+- 追質問: 直前の質問と埋め込みがほぼ同じなら検索を省く。そうでなくても話題が続いていれば、
+  直前のチャンクを引き継いで新しい検索結果と合わせる（直前に話していた記事を見失わない）
+引き継いだチャンクはプロンプトの抜粋の先頭に直前と同じ並び・同じ距離表示で置く。
+OpenAI のプロンプトキャッシュは先頭一致で効くので、ターンをまたいで先頭が変わらないようにするため。
+
+プロセス内の LRU + TTL。gunicorn の複数ワーカーでは、別のワーカーに来たリクエストからはセッションが
+見えない（その場合は通常の検索になるだけ）。version_fn の値が変わったら（コレクション更新）全消去する。
+イベントループ上から呼ぶ前提でロックは持たない。
+"""
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from answer_cache import normalize_question
+
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+MAX_ANSWER_CHARS = 1500  # 会話履歴としてプロンプトに入れる回答の長さの上限
+
+Hits = Tuple[List[str], List[str], List[dict], List[float]]
+
+
+def parse_session_id(v: Any) -> Optional[str]:
+    """リクエストの session_id。無ければ None、形式が違えば ValueError"""
+    if v in (None, ""):
+        return None
+    if not isinstance(v, str) or not _SESSION_ID.match(v):
+        raise ValueError("session_id は英数字・'-'・'_' の 64 文字以内で指定してください")
+    return v
+
+
+@dataclass
+class Turn:
+    question: str
+    answer: str
+    ids: List[str]
+    q_emb: Optional[List[float]] = None
+    # 回答キャッシュに当たったターンは ID だけ（引き継ぐときに get で取り直す）
+    docs: Optional[List[str]] = None
+    metas: Optional[List[dict]] = None
+    dists: Optional[List[float]] = None
+    filter_key: str = ""
+
+    def __post_init__(self):
+        self.answer = (self.answer or "")[:MAX_ANSWER_CHARS]
+
+    def hits(self) -> Optional[Hits]:
+        if self.docs is None or self.metas is None or self.dists is None:
+            return None
+        return list(self.ids), list(self.docs), list(self.metas), list(self.dists)
+
+
+@dataclass
+class _Session:
+    turns: Deque[Turn]
+    expires_at: float
+
+
+def same_question(a: str, b: str) -> bool:
+    return normalize_question(a) == normalize_question(b)
+
+
+def cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    va = np.asarray(a, dtype=np.float32)
+    vb = np.asarray(b, dtype=np.float32)
+    n = float(np.linalg.norm(va) * np.linalg.norm(vb))
+    return float(np.dot(va, vb) / n) if n > 0 else 0.0
+
+
+def carry_over(prev: Hits, new: Hits, carry: int) -> Hits:
+    """引き継ぐチャンク（直前の並び順のまま最大 carry 件）を先に、新しい検索結果のうちまだ無いものを後ろに"""
+    keep = list(range(min(carry, len(prev[0]))))
+    seen = {prev[0][i] for i in keep}
+    added = [i for i, doc_id in enumerate(new[0]) if doc_id not in seen]
+    return tuple(  # type: ignore[return-value]
+        [p[i] for i in keep] + [n[i] for i in added] for p, n in zip(prev, new)
+    )
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = 1000, ttl_secs: float = 1800.0, max_turns: int = 4,
+                 version_fn: Optional[Callable[[], str]] = None):
+        self.max_sessions = max_sessions
+        self.ttl_secs = ttl_secs
+        self.max_turns = max(1, max_turns)
+        self._version_fn = version_fn
+        self._version = version_fn() if version_fn else ""
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self.counters = {
+            "created": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            # 2 ターン目以降の検索のしかた（main.retrieve_followup が数える）
+            "regenerated": 0,
+            "reused": 0,
+            "carried": 0,
+            "fresh": 0,
+        }
+
+    def _check_version(self) -> None:
+        if not self._version_fn:
+            return
+        v = self._version_fn()
+        if v != self._version:
+            self._version = v
+            if self._sessions:
+                self.clear()
+                self.counters["invalidations"] += 1
+
+    def turns(self, session_id: str) -> List[Turn]:
+        """古い順のターン（無い・期限切れなら空）"""
+        self._check_version()
+        s = self._sessions.get(session_id)
+        if s is None:
+            return []
+        if s.expires_at < time.time():
+            del self._sessions[session_id]
+            self.counters["expired"] += 1
+            return []
+        self._sessions.move_to_end(session_id)
+        return list(s.turns)
+
+    def add(self, session_id: str, turn: Turn, replace_last: bool = False) -> None:
+        """ターンを足す。replace_last なら最後のターンを置き換える（再生成）"""
+        self._check_version()
+        s = self._sessions.get(session_id)
+        if s is None:
+            s = self._sessions[session_id] = _Session(deque(maxlen=self.max_turns), 0.0)
+            self.counters["created"] += 1
+        elif replace_last and s.turns:
+            s.turns.pop()
+        s.turns.append(turn)
+        s.expires_at = time.time() + self.ttl_secs
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def drop(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def clear(self) -> None:
+        self._sessions.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "sessions": len(self._sessions)}
@@ -0,0 +1,96 @@
+# startup.py
+"""
+API の起動まわり: 重いリソースの遅延初期化と、ウォームアップ進捗（readiness）の記録。
+
+  chroma = Lazy("chroma", lambda: PersistentClient(path=...))
+  chroma.get()   # 初回だけ生成（スレッドセーフ）。所要時間はログと tracker に残る
+"""
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class StartupTracker:
+    """起動からの経過と、各初期化ステップの所要時間・状態を記録する"""
+
+    def __init__(self, t0: Optional[float] = None):
+        self.t0 = t0 if t0 is not None else time.perf_counter()
+        self._lock = threading.Lock()
+        self.steps: Dict[str, Dict[str, Any]] = {}
+        self.ready = threading.Event()
+        self.ready_secs: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    def record(self, name: str, status: str, secs: Optional[float] = None, detail: Optional[str] = None) -> None:
+        with self._lock:
+            step = self.steps.setdefault(name, {})
+            step["status"] = status
+            if secs is not None:
+                step["secs"] = round(secs, 3)
+            if detail:
+                step["detail"] = detail
+
+    def run(self, name: str, fn: Callable[[], T]) -> T:
+        self.record(name, "running")
+        t = time.perf_counter()
+        try:
+            out = fn()
+        except BaseException as e:
+            self.record(name, "failed", time.perf_counter() - t, f"{type(e).__name__}: {e}")
+            raise
+        secs = time.perf_counter() - t
+        self.record(name, "done", secs)
+        log.info(f"[startup] {name}: {secs:.2f}s")
+        return out
+
+    def mark_ready(self) -> None:
+        self.ready_secs = self.elapsed()
+        self.ready.set()
+        log.info(f"[startup] ready in {self.ready_secs:.2f}s")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            steps = {k: dict(v) for k, v in self.steps.items()}
+        return {
+            "ready": self.ready.is_set(),
+            "uptime_secs": round(self.elapsed(), 3),
+            "ready_secs": round(self.ready_secs, 3) if self.ready_secs is not None else None,
+            "error": self.error,
+            "steps": steps,
+        }
+
+
+class Lazy(Generic[T]):
+    """初回 get() で factory を呼んで保持する。ウォームアップとリクエストが同時に来ても生成は 1 回"""
+
+    def __init__(self, name: str, factory: Callable[[], T], tracker: Optional[StartupTracker] = None):
+        self.name = name
+        self._factory = factory
+        self._tracker = tracker
+        self._lock = threading.Lock()
+        self._value: Optional[T] = None
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> T:
+        if self._loaded:
+            return self._value  # type: ignore[return-value]
+        with self._lock:
+            if not self._loaded:
+                if self._tracker is not None:
+                    self._value = self._tracker.run(f"load:{self.name}", self._factory)
+                else:
+                    self._value = self._factory()
+                self._loaded = True
+        return self._value  # type: ignore[return-value]
@@ -1,11 +1,13 @@
 # streamlit_app.py
 import os
-import json
-import requests
 import streamlit as st
 from uuid import uuid4
 
+from api_client import API_POOL_SIZE, API_TIMEOUT_SECS, ApiClient, ApiError, api_base
+
 API_URL = os.getenv("NOTE_RAG_API_URL", "http://localhost:8000/query")
+STREAM_URL = os.getenv("NOTE_RAG_STREAM_URL", API_URL.rstrip("/") + "/stream")
+USE_STREAM = os.getenv("NOTE_RAG_STREAM", "1") == "1"  # /query/stream で逐次表示する
 
 st.set_page_config(page_title="Note記事検索Bot", page_icon="📝", layout="centered")
 st.title("Note記事検索Bot")
@@ -16,7 +18,10 @@ if "history" not in st.session_state:
     # 各エントリに一意な "id" を持たせる
     st.session_state.history = []  # [{"id": str, "q": str, "answer": str, "suggestions": [str], "sources": [...]}]
 if "pending" not in st.session_state:
-    st.session_state.pending = None
+    st.session_state.pending = None  # {"q": str, "regenerate": bool}
+if "session_id" not in st.session_state:
+    # API 側の会話セッション。追質問で前回の検索結果とやりとりを引き継ぐ
+    st.session_state.session_id = uuid4().hex
 if "use_chat_ui" not in st.session_state:
     st.session_state.use_chat_ui = True  # chat_message があれば使う
 
@@ -26,31 +31,44 @@ with st.sidebar:
     show_sources = st.checkbox("参考ソースを表示", value=True)
     if st.button("履歴をクリア"):
         st.session_state.history = []
+        st.session_state.session_id = uuid4().hex
         st.rerun()
     st.markdown("---")
     st.write("・Enterで送信 / Shift+Enterで改行")
     st.write("・提案ボタンからワンクリックで再質問できます")
 
 # ====== API 呼び出し ======
-def call_api(question: str) -> dict:
+@st.cache_resource
+def get_api() -> ApiClient:
+    # keep-alive のコネクションプールをセッション間で共有する
+    return ApiClient(api_base(API_URL), API_TIMEOUT_SECS, API_POOL_SIZE, cache_ttl=0)
+
+def request_body(question: str, regenerate: bool = False) -> dict:
+    body = {"question": question, "session_id": st.session_state.session_id}
+    if regenerate:
+        body["regenerate"] = True
+    return body
+
+def call_api(question: str, regenerate: bool = False) -> dict:
+    # 会話セッションの回答は前のやりとりに依存するのでクライアント側ではキャッシュしない
     try:
-        r = requests.post(API_URL, json={"question": question}, timeout=60)
-    except requests.RequestException as e:
-        st.error(f"APIに接続できませんでした: {e}")
-        return {}
-    if r.status_code != 200:
-        try:
-            detail = r.json()
-        except Exception:
-            detail = r.text
-        st.error(f"APIエラー {r.status_code}: {detail}")
+        return get_api().query(**request_body(question, regenerate), cache=False)
+    except ApiError as e:
+        if e.status is None:
+            st.error(f"APIに接続できませんでした: {e.detail}")
+        else:
+            st.error(f"APIエラー {e.status}: {e.detail}")
         return {}
+
+def call_api_stream(question: str, regenerate: bool = False):
+    """/query/stream（SSE）を呼び、(event, data) を到着順に返すジェネレータ"""
     try:
-        return r.json()
-    except json.JSONDecodeError:
-        st.error("APIから不正なJSONが返ってきました。")
-        st.text(r.text)
-        return {}
+        yield from get_api().stream(STREAM_URL, request_body(question, regenerate))
+    except ApiError as e:
+        if e.status is None:
+            st.error(f"APIに接続できませんでした: {e.detail}")
+        else:
+            st.error(f"APIエラー {e.status}: {e.detail}")
 
 # ====== 表示ユーティリティ ======
 def ensure_new_format(data: dict) -> dict:
@@ -87,7 +105,7 @@ def render_suggestions(suggestions: list, msg_key: str):
     for i, s in enumerate(suggestions):
         col = cols[i % num_cols]
         if col.button(s, key=f"sugg_{msg_key}_{i}"):
-            st.session_state.pending = s
+            st.session_state.pending = {"q": s, "regenerate": False}
             st.rerun()
 
 # ====== チャット表示 ======
@@ -119,11 +137,12 @@ def render_chat():
                     col1, col2 = st.columns([1, 1])
                     with col1:
                         if st.button("送信", key=f"follow_btn_{msg_key}") and follow.strip():
-                            st.session_state.pending = follow.strip()
+                            st.session_state.pending = {"q": follow.strip(), "regenerate": False}
                             st.rerun()
                     with col2:
+                        # 最後の回答なら API 側で検索をやり直さずに作り直す
                         if st.button("再生成", key=f"regen_{msg_key}"):
-                            st.session_state.pending = q
+                            st.session_state.pending = {"q": q, "regenerate": True}
                             st.rerun()
         else:
             # フォールバック（非チャットUI）
@@ -136,12 +155,52 @@ def render_chat():
             st.markdown("---")
 
 # ====== 送信処理 ======
-def ask(question: str):
-    data = call_api(question)
+def ask_streaming(question: str, regenerate: bool = False) -> dict:
+    """ソース→回答トークン→提案の順に届くイベントを、その場で描画していく"""
+    use_chat = hasattr(st, "chat_message") and st.session_state.use_chat_ui
+    if use_chat:
+        with st.chat_message("user"):
+            st.markdown(question)
+        box = st.chat_message("assistant")
+    else:
+        st.markdown(f"**Q:** {question}")
+        box = st.container()
+
+    answer, sources, suggestions, failed = "", [], [], False
+    with box:
+        answer_ph = st.empty()
+        answer_ph.markdown("_関連記事を検索中…_")
+        for event, data in call_api_stream(question, regenerate):
+            if event == "sources":
+                sources = data or []
+                answer_ph.markdown("_回答を生成中…_")
+                if show_sources:
+                    render_sources(sources)
+            elif event == "token":
+                answer += (data or {}).get("text", "")
+                answer_ph.markdown(answer + "▌")
+            elif event == "suggestions":
+                suggestions = data or []
+            elif event == "done":
+                answer = (data or {}).get("answer") or answer
+            elif event == "error":
+                failed = True
+                st.error((data or {}).get("detail", "回答の生成に失敗しました"))
+        answer_ph.markdown(answer or "_（回答なし）_")
+
+    if failed or not (answer or sources):
+        return {}
+    return {"answer": answer, "suggestions": suggestions, "sources": sources}
+
+def ask(question: str, regenerate: bool = False):
+    data = ask_streaming(question, regenerate) if USE_STREAM else call_api(question, regenerate)
     if not data:
         return
     data = ensure_new_format(data)
-    st.session_state.history.append({
+    history = st.session_state.history
+    if regenerate and history and history[-1]["q"] == question:
+        history.pop()  # 最後の回答の作り直しは置き換える
+    history.append({
         "id": uuid4().hex,
         "q": question,
         **data
@@ -158,7 +217,7 @@ st.session_state.pending = None
 if use_chat:
     # 提案などで pending があれば先に送る
     if pending:
-        ask(pending)
+        ask(pending["q"], pending["regenerate"])
         st.rerun()
     user_q = st.chat_input("知りたいことを入力してください", key="chat_q", max_chars=2000)
     if user_q and user_q.strip():
@@ -166,7 +225,7 @@ if use_chat:
         st.rerun()
 else:
     with st.form("ask"):
-        user_q = st.text_input("知りたいことを入力してください", value=pending or "")
+        user_q = st.text_input("知りたいことを入力してください", value=(pending or {}).get("q", ""))
         submitted = st.form_submit_button("送信")
     if submitted and user_q.strip():
         ask(user_q.strip())
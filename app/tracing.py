@@ -0,0 +1,141 @@
+# tracing.py
+"""
+トレース ID とログ出力。
+
+- trace_id_var: リクエストごとのトレース ID（metrics.RequestMetricsMiddleware が設定する）。
+  contextvars なので await をまたいでも、run_blocking で cpu_pool に渡した処理でも同じ値が見える
+- setup_logging: ログはリクエスト処理のスレッドでは bounded queue に積むだけにし、書き出しは
+  QueueListener の専用スレッドで行う。キューが溢れたら待たずに捨てて数える（dropped）
+- LOG_SAMPLE_RATE < 1 なら INFO 以下はトレース ID 単位で間引く（同じリクエストのログは全部残るか全部消える）。
+  WARNING 以上は常に出す
+
+  LOG_FORMAT=json  → {"ts": ..., "level": ..., "logger": ..., "trace_id": ..., "msg": ...} を 1 行ずつ
+"""
+import os
+import json
+import uuid
+import queue
+import atexit
+import logging
+import zlib
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+trace_id_var: ContextVar[str] = ContextVar("trace_id", default="-")
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> str:
+    return trace_id_var.get()
+
+
+class TraceIdFilter(logging.Filter):
+    """レコードに trace_id を付ける（積む側のスレッドで呼ばれるのでここで取る）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = max(0.0, min(1.0, rate))
+        self._threshold = int(self.rate * 0xFFFFFFFF)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        trace_id = getattr(record, "trace_id", "-")
+        if trace_id == "-":  # リクエスト外（起動・取り込み）のログは間引かない
+            return True
+        return zlib.crc32(trace_id.encode("utf-8")) <= self._threshold
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """キューが満杯なら待たずに捨てる（ログのためにリクエストを止めない）"""
+
+    def __init__(self, q: "queue.Queue"):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # メッセージの組み立ては積む側で済ませる（引数のオブジェクトを別スレッドに渡さない）
+        record = super().prepare(record)
+        record.trace_id = getattr(record, "trace_id", "-")
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+
+def _start_listener(target: logging.Handler, queue_size: int) -> None:
+    global _listener
+    _handler.queue = queue.Queue(maxsize=max(1, queue_size))
+    _listener = QueueListener(_handler.queue, target, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener() -> None:
+    if _listener is None or _listener._thread is None:
+        return
+    try:
+        _listener.stop()  # 溜まっている分を書き出してから止まる
+    except queue.Full:
+        pass
+
+
+def setup_logging(level: str = "INFO", fmt: str = "text", sample_rate: float = 1.0,
+                  queue_size: int = 10000) -> DroppingQueueHandler:
+    """ルートロガーをキュー経由の非同期出力にする。2 回目以降の呼び出しは何もしない"""
+    global _handler
+    if _handler is not None:
+        return _handler
+
+    target = logging.StreamHandler()
+    if fmt == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] [%(trace_id)s] %(message)s"))
+
+    _handler = DroppingQueueHandler(queue.Queue())
+    _handler.addFilter(TraceIdFilter())
+    _handler.addFilter(SamplingFilter(sample_rate))
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level.upper())
+    _start_listener(target, queue_size)
+    atexit.register(_stop_listener)
+    # 書き出しスレッドは fork 後の子に引き継がれない（gunicorn の preload_app）。子ではキューごと作り直す
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=lambda: _start_listener(target, queue_size))
+    return _handler
+
+
+def dropped_logs() -> int:
+    return _handler.dropped if _handler is not None else 0
@@ -0,0 +1,369 @@
+# vector_snapshot.py
+"""
+コレクションの読み取り専用スナップショット（チャンクのベクトル・本文・メタ）。
+
+embed_articles.py が Chroma の内容を書き出し、main.py（複数ワーカー）は np.memmap で開いて
+検索する（retrieval_backend.MatrixBackend）。ページキャッシュ上の同じページを全ワーカーが共有するので、
+ワーカー数を増やしてもベクトル分のメモリは増えず、SQLite（Chroma）のロック競合も起きない。
+
+  <PERSIST_DIR>/<collection>.snapshot              … 現在のスナップショットのディレクトリ名
+  <PERSIST_DIR>/<collection>.snapshot.<世代>/
+      vectors.npy  (n, dim) float32            … 元の埋め込み（最終的な距離はこれで計算）
+      norms.npy    (n,) float32                … l2 距離の前計算
+      unit.npy     (n, dim) float32/float16/int8 … 正規化済み埋め込み（候補の絞り込み用）
+      unit_scale.npy (n,) float32              … int8 のときの行ごとの倍率
+      ivf_centroids.npy / ivf_order.npy / ivf_ptr.npy … IVF（件数が多いとき）
+      hnsw.bin                                 … HNSW（hnswlib があり、件数が多いとき）
+      docs.bin / docs_off.npy                  … 本文（UTF-8 を連結、(n+1,) のオフセット）
+      metas.bin / metas_off.npy                … メタ（JSON を連結）
+      published_ts.npy / updated_ts.npy (n,) float64 … 絞り込み用の日時（epoch 秒、無ければ NaN）
+      user_code.npy / file_code.npy (n,) int32 … user_id / filename の番号（facets.json の並び。無ければ -1）
+      facets.json                              … {"users": [...], "files": [[filename, title], ...]}
+      ids.json / meta.json
+"""
+import os
+import json
+import time
+import shutil
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from collection_state import _atomic_write
+
+KEEP_SNAPSHOTS = 2      # 切り替え直後に古い方を読んでいるワーカーがいるので 1 世代は残す
+BLOCK_ROWS = 4096       # float16/int8 を float32 に戻しながら計算するときのブロック行数
+UNIT_DTYPES = ("float32", "float16", "int8")
+_HNSW_SPACE = {"cosine": "ip", "ip": "ip", "l2": "l2"}
+TS_FIELDS = ("published_ts", "updated_ts")
+
+
+def pointer_path(persist_dir: str, collection: str) -> str:
+    return os.path.join(persist_dir, f"{collection}.snapshot")
+
+
+def read_pointer(persist_dir: str, collection: str) -> Optional[str]:
+    try:
+        with open(pointer_path(persist_dir, collection), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _blob(items: Sequence[bytes]) -> Tuple[bytes, np.ndarray]:
+    off = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in items], out=off[1:])
+    return b"".join(items), off
+
+
+def normalize_rows(m: np.ndarray) -> np.ndarray:
+    m = np.asarray(m, dtype=np.float32)
+    n = np.linalg.norm(m, axis=-1, keepdims=True)
+    return m / np.maximum(n, 1e-12)
+
+
+def quantize(unit: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """正規化済み行列を保存用の型に変換する。int8 は行ごとに max|x| を 127 に合わせる"""
+    if dtype == "float16":
+        return unit.astype(np.float16), None
+    if dtype == "int8":
+        scale = np.maximum(np.abs(unit).max(axis=1), 1e-12) / 127.0 if len(unit) else np.zeros(0, np.float32)
+        q = np.round(unit / scale[:, None]).astype(np.int8) if len(unit) else unit.astype(np.int8)
+        return q, scale.astype(np.float32)
+    return unit.astype(np.float32), None
+
+
+def build_ivf(unit: np.ndarray, nlist: int, iters: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """球面 k-means の粗い量子化器。戻り値: (centroids, リスト順に並べた行番号, 各リストの開始位置)"""
+    rng = np.random.default_rng(seed)
+    n = len(unit)
+    nlist = max(1, min(nlist, n))
+    sample = unit[rng.choice(n, size=min(n, nlist * 64), replace=False)]
+    cent = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ cent.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                cent[c] = members.sum(axis=0)
+        cent = normalize_rows(cent)
+    assign = np.concatenate([np.argmax(unit[i:i + BLOCK_ROWS] @ cent.T, axis=1)
+                             for i in range(0, n, BLOCK_ROWS)])
+    order = np.argsort(assign, kind="stable").astype(np.int32)
+    ptr = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=nlist), out=ptr[1:])
+    return cent.astype(np.float32), order, ptr
+
+
+def filter_columns(metas: Sequence[Dict[str, Any]]) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """メタから絞り込み用の列（search_filter.SearchFilter の条件をベクトル演算で当てるため）を作る"""
+    cols = {f: np.full(len(metas), np.nan, dtype=np.float64) for f in TS_FIELDS}
+    user_code = np.full(len(metas), -1, dtype=np.int32)
+    file_code = np.full(len(metas), -1, dtype=np.int32)
+    users: Dict[str, int] = {}
+    files: Dict[str, int] = {}
+    titles: List[str] = []
+    for i, m in enumerate(metas):
+        m = m or {}
+        for f in TS_FIELDS:
+            v = m.get(f)
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                cols[f][i] = v
+        if m.get("user_id") is not None:
+            user_code[i] = users.setdefault(str(m["user_id"]), len(users))
+        if m.get("filename") is not None:
+            fn = str(m["filename"])
+            if fn not in files:
+                files[fn] = len(files)
+                titles.append(str(m.get("title") or ""))
+            file_code[i] = files[fn]
+    cols["user_code"] = user_code
+    cols["file_code"] = file_code
+    return cols, {"users": list(users), "files": [[fn, t] for fn, t in zip(files, titles)]}
+
+
+def _hnswlib():
+    try:
+        import hnswlib
+        return hnswlib
+    except ImportError:
+        return None
+
+
+def write_snapshot(persist_dir: str, collection: str, ids: Sequence[str], mat: np.ndarray,
+                   docs: Sequence[str], metas: Sequence[Dict[str, Any]], model: str, space: str = "l2",
+                   unit_dtype: str = "float32", ann: str = "auto", ann_min_rows: int = 50000) -> str:
+    """スナップショットを新しい世代として書き出し、ポインタを切り替える。新しいディレクトリを返す"""
+    if unit_dtype not in UNIT_DTYPES:
+        raise ValueError(f"unit_dtype must be one of {UNIT_DTYPES}: {unit_dtype}")
+    mat = np.asarray(mat, dtype=np.float32).reshape(len(ids), -1) if len(ids) else np.zeros((0, 0), np.float32)
+    name = f"{collection}.snapshot.{time.time_ns()}"
+    out = os.path.join(persist_dir, name)
+    tmp = out + ".tmp"
+    os.makedirs(tmp, exist_ok=True)
+
+    unit = normalize_rows(mat) if len(mat) else mat
+    stored, scale = quantize(unit, unit_dtype)
+    np.save(os.path.join(tmp, "vectors.npy"), mat)
+    np.save(os.path.join(tmp, "norms.npy"), (mat * mat).sum(axis=1).astype(np.float32))
+    np.save(os.path.join(tmp, "unit.npy"), stored)
+    if scale is not None:
+        np.save(os.path.join(tmp, "unit_scale.npy"), scale)
+
+    # 件数が多いときだけ近似索引を作る（hnswlib があれば HNSW、無ければ numpy の IVF）
+    ann_kind = "none"
+    if ann != "none" and len(mat) >= ann_min_rows:
+        hnswlib = _hnswlib() if ann in ("auto", "hnsw") else None
+        if hnswlib is not None:
+            # cosine は正規化済み行列の内積、l2 / ip は元の埋め込みのまま同じ距離で組む
+            index = hnswlib.Index(space=_HNSW_SPACE.get(space, "l2"), dim=unit.shape[1])
+            index.init_index(max_elements=len(unit), ef_construction=200, M=16)
+            index.add_items(unit if space == "cosine" else mat, np.arange(len(unit)))
+            index.save_index(os.path.join(tmp, "hnsw.bin"))
+            ann_kind = "hnsw"
+        elif ann in ("auto", "ivf"):
+            cent, order, ptr = build_ivf(unit, nlist=int(np.sqrt(len(unit))))
+            np.save(os.path.join(tmp, "ivf_centroids.npy"), cent)
+            np.save(os.path.join(tmp, "ivf_order.npy"), order)
+            np.save(os.path.join(tmp, "ivf_ptr.npy"), ptr)
+            ann_kind = "ivf"
+
+    for key, items in (("docs", [(d or "").encode("utf-8") for d in docs]),
+                       ("metas", [json.dumps(m or {}, ensure_ascii=False).encode("utf-8") for m in metas])):
+        data, off = _blob(items)
+        with open(os.path.join(tmp, f"{key}.bin"), "wb") as f:
+            f.write(data)
+        np.save(os.path.join(tmp, f"{key}_off.npy"), off)
+    cols, facets = filter_columns(metas)
+    for key, arr in cols.items():
+        np.save(os.path.join(tmp, f"{key}.npy"), arr)
+    with open(os.path.join(tmp, "facets.json"), "w", encoding="utf-8") as f:
+        json.dump(facets, f, ensure_ascii=False)
+    with open(os.path.join(tmp, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(list(ids), f, ensure_ascii=False)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": model,
+            "count": len(ids),
+            "dim": int(mat.shape[1]) if len(mat) else 0,
+            "space": space,
+            "unit_dtype": unit_dtype,
+            "ann": ann_kind,
+            "created_at": time.time(),
+        }, f)
+    os.replace(tmp, out)
+    _atomic_write(pointer_path(persist_dir, collection), name)
+    _gc(persist_dir, collection, keep=name)
+    return out
+
+
+def export_snapshot(col, persist_dir: str, collection: str, model: str, page_size: int = 2000,
+                    **options) -> str:
+    """Chroma コレクションの内容をページングで読み出して write_snapshot する"""
+    ids: List[str] = []
+    vecs: List[np.ndarray] = []
+    docs: List[str] = []
+    metas: List[Dict[str, Any]] = []
+    offset = 0
+    while True:
+        res = col.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        page_ids = list(res.get("ids") or [])
+        if not page_ids:
+            break
+        ids.extend(page_ids)
+        vecs.append(np.asarray(res["embeddings"], dtype=np.float32))
+        docs.extend(res.get("documents") or [])
+        metas.extend(res.get("metadatas") or [])
+        if len(page_ids) < page_size:
+            break
+        offset += page_size
+    mat = np.concatenate(vecs) if vecs else np.zeros((0, 0), dtype=np.float32)
+    space = (getattr(col, "metadata", None) or {}).get("hnsw:space", "l2")
+    return write_snapshot(persist_dir, collection, ids, mat, docs, metas, model, space=space, **options)
+
+
+def _gc(persist_dir: str, collection: str, keep: str) -> None:
+    prefix = f"{collection}.snapshot."
+    olds = sorted(n for n in os.listdir(persist_dir)
+                  if n.startswith(prefix) and n != keep and not n.endswith(".tmp"))
+    for n in olds[:max(0, len(olds) - (KEEP_SNAPSHOTS - 1))]:
+        shutil.rmtree(os.path.join(persist_dir, n), ignore_errors=True)
+
+
+def _memmap_bytes(path: str) -> np.ndarray:
+    if os.path.getsize(path):
+        return np.memmap(path, dtype=np.uint8, mode="r")
+    return np.zeros(0, dtype=np.uint8)
+
+
+class Snapshot:
+    """1 世代分のスナップショット（読み取り専用、大きな配列は memmap）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+            self.ids: List[str] = json.load(f)
+        self.row_of = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self.space = self.meta.get("space", "l2")
+        self.ann = self.meta.get("ann", "none")
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(path, "norms.npy"), mmap_mode="r")
+        self.unit = np.load(os.path.join(path, "unit.npy"), mmap_mode="r")
+        scale_path = os.path.join(path, "unit_scale.npy")
+        self.unit_scale = np.load(scale_path, mmap_mode="r") if os.path.exists(scale_path) else None
+        self._docs = _memmap_bytes(os.path.join(path, "docs.bin"))
+        self._metas = _memmap_bytes(os.path.join(path, "metas.bin"))
+        self._docs_off = np.load(os.path.join(path, "docs_off.npy"))
+        self._metas_off = np.load(os.path.join(path, "metas_off.npy"))
+        self._cols: Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]] = None
+        self.ivf: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self.hnsw = None
+        if self.ann == "ivf":
+            self.ivf = tuple(np.load(os.path.join(path, f"ivf_{k}.npy"), mmap_mode="r")
+                             for k in ("centroids", "order", "ptr"))
+        elif self.ann == "hnsw":
+            hnswlib = _hnswlib()
+            if hnswlib is None:
+                self.ann = "none"  # 書き出し側にしか hnswlib が無い場合は総当たりに戻る
+            else:
+                self.hnsw = hnswlib.Index(space=_HNSW_SPACE.get(self.space, "l2"), dim=int(self.meta["dim"]))
+                self.hnsw.load_index(os.path.join(path, "hnsw.bin"), max_elements=len(self.ids))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def doc(self, i: int) -> str:
+        return bytes(self._docs[self._docs_off[i]:self._docs_off[i + 1]]).decode("utf-8")
+
+    def metadata(self, i: int) -> Dict[str, Any]:
+        return json.loads(bytes(self._metas[self._metas_off[i]:self._metas_off[i + 1]]).decode("utf-8"))
+
+    def _filter_columns(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """絞り込み用の列。書き出し時の列が無い古いスナップショットはメタから作る（初回だけ）"""
+        if self._cols is None:
+            facets_path = os.path.join(self.path, "facets.json")
+            if os.path.exists(facets_path):
+                with open(facets_path, "r", encoding="utf-8") as f:
+                    facets = json.load(f)
+                cols = {key: np.load(os.path.join(self.path, f"{key}.npy"), mmap_mode="r")
+                        for key in (*TS_FIELDS, "user_code", "file_code")}
+                self._cols = (cols, facets)
+            else:
+                self._cols = filter_columns([self.metadata(i) for i in range(len(self))])
+        return self._cols
+
+    def titles(self) -> Dict[str, str]:
+        """{filename: title}"""
+        return {fn: t for fn, t in self._filter_columns()[1]["files"]}
+
+    def select(self, flt) -> np.ndarray:
+        """SearchFilter（filenames は解決済み）の条件に合う行番号"""
+        cols, facets = self._filter_columns()
+        mask = np.ones(len(self), dtype=bool)
+        for field, lo, hi in flt.ranges:
+            col = cols.get(field)
+            if col is None:
+                return np.zeros(0, dtype=np.int64)
+            if lo is not None:
+                mask &= col >= lo   # NaN（日時が無い行）はどちらの比較でも False で落ちる
+            if hi is not None:
+                mask &= col <= hi
+        if flt.user_ids:
+            wanted = set(flt.user_ids)
+            mask &= np.isin(cols["user_code"], [c for c, u in enumerate(facets["users"]) if u in wanted])
+        if flt.filenames is not None:
+            wanted = set(flt.filenames)
+            mask &= np.isin(cols["file_code"], [c for c, (fn, _) in enumerate(facets["files"]) if fn in wanted])
+        return np.flatnonzero(mask)
+
+    def _unit_dots(self, q: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        if rows is not None:
+            block = self.unit[rows].astype(np.float32)
+            if self.unit_scale is not None:
+                block *= self.unit_scale[rows][:, None]
+            return block @ q.T
+        if self.unit.dtype == np.float32:
+            return self.unit @ q.T
+        out = np.empty((len(self.unit), len(q)), dtype=np.float32)
+        for i in range(0, len(self.unit), BLOCK_ROWS):
+            block = self.unit[i:i + BLOCK_ROWS].astype(np.float32)
+            if self.unit_scale is not None:
+                block *= self.unit_scale[i:i + BLOCK_ROWS][:, None]
+            out[i:i + BLOCK_ROWS] = block @ q.T
+        return out
+
+    def approx_scores(self, q: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        クエリ q (m, dim) との近さ (候補数, m)。大きいほど近い。正規化済み行列（float16/int8 のこともある）と
+        ノルムから復元するので、並びは距離関数ごとの厳密な順位に近い:
+          cosine: u·q   ip: |x| u·q   l2: 2|x| u·q - |x|²（|q|² は順位に効かないので省く）
+        float16/int8 はブロックごとに float32 に戻して計算する
+        """
+        dots = self._unit_dots(np.asarray(q, dtype=np.float32), rows)
+        if self.space == "cosine":
+            return dots
+        n = np.asarray(self.norms if rows is None else self.norms[rows], dtype=np.float32)[:, None]
+        if self.space == "ip":
+            return np.sqrt(n) * dots
+        return 2.0 * np.sqrt(n) * dots - n
+
+    def distances(self, q: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Chroma と同じ距離（l2 は二乗距離、cosine / ip は 1 - 類似度）を元の埋め込みで計算する。
+        q が (dim,) なら (候補数,)、(m, dim) なら (候補数, m)
+        """
+        q = np.asarray(q, dtype=np.float32)
+        qs = np.atleast_2d(q)
+        m = self.vectors if rows is None else self.vectors[rows]
+        n = self.norms if rows is None else self.norms[rows]
+        dots = m @ qs.T
+        if self.space == "cosine":
+            denom = np.sqrt(n)[:, None] * np.maximum(np.linalg.norm(qs, axis=1), 1e-12)[None, :]
+            d = 1.0 - dots / np.maximum(denom, 1e-12)
+        elif self.space == "ip":
+            d = 1.0 - dots
+        else:
+            d = np.maximum(n[:, None] - 2.0 * dots + (qs * qs).sum(axis=1)[None, :], 0.0)
+        return d[:, 0] if q.ndim == 1 else d
@@ -0,0 +1,205 @@
+# bench_embed_backends.py
+"""
+埋め込みバックエンド（torch / onnx / onnx+int8）の一致確認と速度・メモリ計測。
+
+  python bench/bench_embed_backends.py                       # torch / onnx / onnx+int8(avx2)
+  python bench/bench_embed_backends.py --quantize avx512_vnni
+  python bench/bench_embed_backends.py --articles ./articles --texts 2000
+  python bench/bench_embed_backends.py --check               # 一致度が閾値未満なら終了コード 1
+
+一致確認は torch の出力を基準に、同じテキストのベクトルのコサイン類似度（平均・最小）と、
+質問ごとの上位 k 件の重なり（overlap@k）を見る。コーパスは --articles の *.txt（無ければ
+bench/html_corpus の HTML を本文にしたもの）を 400 字ずつに切ったもの、質問は各チャンクの書き出し。
+メモリはバックエンドごとに別プロセスで読み込み、読み込み後の RSS とピーク（VmHWM）を測る。
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing as mp
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from chunker import CharChunker  # noqa: E402
+
+HTML_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html_corpus")
+# (平均コサインの下限, 最小コサインの下限, overlap@k の下限)
+THRESHOLDS = {"fp32": (0.9999, 0.999, 0.98), "int8": (0.98, 0.90, 0.80)}
+
+
+def load_texts(articles: str, n: int, seed: int = 0) -> List[str]:
+    docs: List[str] = []
+    for p in sorted(glob.glob(os.path.join(articles, "*.txt")))[:5000]:
+        with open(p, "r", encoding="utf-8", errors="ignore") as f:
+            docs.append(f.read().strip())
+    if not docs:
+        import html_extract
+
+        for p in sorted(glob.glob(os.path.join(HTML_CORPUS, "*.html"))):
+            with open(p, "r", encoding="utf-8") as f:
+                docs.append(html_extract.extract_stream(f.read())[0])
+    chunker = CharChunker(400, 0)
+    texts = [c.text for d in docs for c in chunker.chunks(d) if len(c.text) >= 20]
+    if not texts:
+        raise SystemExit("コーパスが空です（--articles を確認してください）")
+    rng = random.Random(seed)
+    while len(texts) < n:  # 小さいサンプルコーパスは文の順番を入れ替えて水増しする
+        parts = rng.choice(texts).split("。")
+        rng.shuffle(parts)
+        texts.append("。".join(parts))
+    rng.shuffle(texts)
+    return texts[:n]
+
+
+def rss_mb() -> Tuple[float, float]:
+    """(現在の RSS, ピーク) MB。/proc が無ければ ru_maxrss をどちらにも使う"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+def variant_name(backend: str, quantize: str) -> str:
+    return f"{backend}-{'qint8-' + quantize if quantize else 'fp32'}"
+
+
+def worker(backend: str, quantize: str, args: Dict, texts: List[str], queries: List[str], out_dir: str,
+           result_q: "mp.Queue") -> None:
+    try:
+        from embedder import load_embedder
+
+        base = rss_mb()[0]
+        t = time.perf_counter()
+        model = load_embedder(args["model"], backend, quantize, args["onnx_dir"], threads=args["threads"])
+        load_secs = time.perf_counter() - t
+        loaded = rss_mb()[0]
+        model.encode(texts[:8], batch_size=8)  # ウォームアップ
+
+        t = time.perf_counter()
+        docs = model.encode(texts, batch_size=args["batch"], normalize_embeddings=True, show_progress_bar=False)
+        batch_secs = time.perf_counter() - t
+        lat: List[float] = []
+        qs = []
+        for q in queries:  # /query と同じ 1 件ずつ
+            t = time.perf_counter()
+            qs.append(model.encode([q], normalize_embeddings=True, show_progress_bar=False)[0])
+            lat.append((time.perf_counter() - t) * 1000)
+        name = variant_name(backend, quantize)
+        np.save(os.path.join(out_dir, f"{name}.docs.npy"), np.asarray(docs, dtype=np.float32))
+        np.save(os.path.join(out_dir, f"{name}.queries.npy"), np.asarray(qs, dtype=np.float32))
+        result_q.put({
+            "name": name,
+            "load_secs": load_secs,
+            "encodes_per_sec": len(texts) / batch_secs,
+            "query_p50_ms": float(np.percentile(lat, 50)),
+            "query_p99_ms": float(np.percentile(lat, 99)),
+            "rss_model_mb": loaded - base,
+            "rss_mb": rss_mb()[0],
+            "rss_peak_mb": rss_mb()[1],
+        })
+    except Exception as e:
+        result_q.put({"name": variant_name(backend, quantize), "error": f"{type(e).__name__}: {e}"})
+
+
+def run_backend(backend: str, quantize: str, args: Dict, texts: List[str], queries: List[str],
+                out_dir: str) -> Dict:
+    ctx = mp.get_context("spawn")  # バックエンドごとに別プロセス（RSS を混ぜない）
+    q = ctx.Queue()
+    p = ctx.Process(target=worker, args=(backend, quantize, args, texts, queries, out_dir, q))
+    p.start()
+    res = q.get()
+    p.join()
+    return res
+
+
+def parity(out_dir: str, ref: str, name: str, k: int) -> Dict[str, float]:
+    arrays = [np.load(os.path.join(out_dir, f"{n}.{kind}.npy")) for n in (ref, name) for kind in ("docs", "queries")]
+    return parity_arrays(*arrays, k=k)
+
+
+def parity_arrays(ref_docs: np.ndarray, ref_q: np.ndarray, docs: np.ndarray, qs: np.ndarray,
+                  k: int) -> Dict[str, float]:
+    """正規化済みベクトルどうしのコサイン（平均・最小）と、質問ごとの上位 k 件の重なり"""
+    cos = np.concatenate([(ref_docs * docs).sum(axis=1), (ref_q * qs).sum(axis=1)])
+    k = min(k, len(docs))
+    want = np.argsort(-(ref_q @ ref_docs.T), axis=1)[:, :k]
+    got = np.argsort(-(qs @ docs.T), axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(want, got)])
+    return {"cos_mean": float(cos.mean()), "cos_min": float(cos.min()), f"overlap@{k}": float(overlap)}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--model", default=os.environ.get("EMBED_MODEL",
+                                                      "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"))
+    ap.add_argument("--articles", default=os.environ.get("ARTICLES_DIR", "./articles"))
+    ap.add_argument("--texts", type=int, default=1000)
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--batch", type=int, default=32)
+    ap.add_argument("--threads", type=int, default=0, help="ONNX Runtime のスレッド数（0 で既定）")
+    ap.add_argument("--quantize", default="avx2", help="int8 の設定（空文字で int8 を計測しない）")
+    ap.add_argument("--onnx-dir", default=os.environ.get("EMBED_ONNX_DIR") or os.path.join(
+        os.environ.get("CHROMA_PERSIST_DIR", "./chroma_db"), "onnx"))
+    ap.add_argument("--check", action="store_true", help="一致度が閾値未満なら終了コード 1")
+    ap.add_argument("--json", help="結果を JSON で保存するパス")
+    args = ap.parse_args()
+
+    texts = load_texts(args.articles, args.texts)
+    queries = [t[:40] for t in random.Random(1).sample(texts, min(args.queries, len(texts)))]
+    print(f"model={args.model} texts={len(texts)} queries={len(queries)} batch={args.batch}")
+    opts = {"model": args.model, "onnx_dir": args.onnx_dir, "threads": args.threads, "batch": args.batch}
+
+    variants = [("torch", ""), ("onnx", "")] + ([("onnx", args.quantize)] if args.quantize else [])
+    results: List[Dict] = []
+    failed: List[str] = []
+    compared = 0
+    with tempfile.TemporaryDirectory(prefix="bench_embed_") as tmp:
+        for backend, quantize in variants:
+            res = run_backend(backend, quantize, opts, texts, queries, tmp)
+            results.append(res)
+            if "error" in res:
+                print(f"  {res['name']:<16} skipped ({res['error']})")
+                continue
+            ref: Optional[str] = results[0]["name"] if "error" not in results[0] else None
+            if ref and res["name"] != ref:
+                res.update(parity(tmp, ref, res["name"], args.k))
+            print(f"  {res['name']:<16} {res['encodes_per_sec']:8.1f} enc/s  query p50={res['query_p50_ms']:6.1f}ms "
+                  f"p99={res['query_p99_ms']:6.1f}ms  load={res['load_secs']:5.1f}s  "
+                  f"rss(model)={res['rss_model_mb']:6.0f}MB peak={res['rss_peak_mb']:6.0f}MB"
+                  + (f"  cos mean={res['cos_mean']:.5f} min={res['cos_min']:.5f} "
+                     f"overlap@{args.k}={res[f'overlap@{args.k}']:.3f}" if "cos_mean" in res else ""))
+            compared += "cos_mean" in res
+            if args.check and "cos_mean" in res:
+                mean_min, cos_min, ov_min = THRESHOLDS["int8" if quantize else "fp32"]
+                if res["cos_mean"] < mean_min or res["cos_min"] < cos_min or res[f"overlap@{args.k}"] < ov_min:
+                    failed.append(res["name"])
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"model": args.model, "texts": len(texts), "results": results}, f, ensure_ascii=False, indent=2)
+    if failed:
+        print(f"parity check failed: {', '.join(failed)}")
+        sys.exit(1)
+    if args.check and not compared:
+        print("parity check failed: torch と比べられたバックエンドがありません")
+        sys.exit(1)
+    if args.check:
+        print("parity check ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# bench_html_extract.py
+"""
+fetch_notes.py の HTML→テキスト抽出エンジン（bs4 / stream）の一致確認とスループット計測。
+
+  python bench/bench_html_extract.py                 # golden との一致確認 + 計測
+  python bench/bench_html_extract.py --corpus DIR    # 任意の *.html（または詳細 API の *.json）で計測
+  python bench/bench_html_extract.py --write-golden  # bs4 エンジンの出力で golden を作り直す
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import html_extract  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html_corpus")
+GOLDEN_PATH = os.path.join(CORPUS_DIR, "golden.json")
+
+
+def load_corpus(path: str) -> Dict[str, str]:
+    docs: Dict[str, str] = {}
+    for p in sorted(glob.glob(os.path.join(path, "*.html"))):
+        with open(p, "r", encoding="utf-8") as f:
+            docs[os.path.basename(p)] = f.read()
+    for p in sorted(glob.glob(os.path.join(path, "*.json"))):
+        if os.path.abspath(p) == GOLDEN_PATH:
+            continue
+        with open(p, "r", encoding="utf-8") as f:
+            body = ((json.load(f) or {}).get("data") or {}).get("body")
+        if isinstance(body, str):
+            docs[os.path.basename(p)] = body
+    return docs
+
+
+def check(docs: Dict[str, str], golden: Dict[str, Dict]) -> List[str]:
+    """golden（あれば）と、両エンジンの出力同士を突き合わせる"""
+    errors: List[str] = []
+    for name, html in docs.items():
+        outs = {}
+        for engine, fn in html_extract.ENGINES.items():
+            try:
+                text, links = fn(html)
+                outs[engine] = {"text": text, "links": links}
+            except Exception as e:  # bs4 版は入れ子の figure で落ちることがある
+                outs[engine] = {"error": f"{type(e).__name__}: {e}"}
+        if name in golden and outs["stream"] != golden[name]:
+            errors.append(f"{name}: stream != golden")
+        if "error" not in outs["bs4"] and outs["stream"] != outs["bs4"]:
+            errors.append(f"{name}: stream != bs4")
+    return errors
+
+
+def bench(docs: Dict[str, str], seconds: float) -> Dict[str, float]:
+    htmls = list(docs.values())
+    result: Dict[str, float] = {}
+    for engine, fn in html_extract.ENGINES.items():
+        n, t0 = 0, time.perf_counter()
+        while time.perf_counter() - t0 < seconds:
+            for h in htmls:
+                try:
+                    fn(h)
+                except Exception:
+                    pass
+                n += 1
+        result[engine] = n / (time.perf_counter() - t0)
+    return result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--corpus", default=CORPUS_DIR)
+    ap.add_argument("--seconds", type=float, default=2.0, help="エンジンごとの計測時間")
+    ap.add_argument("--write-golden", action="store_true")
+    args = ap.parse_args()
+
+    docs = load_corpus(args.corpus)
+    if not docs:
+        print(f"[bench] corpus is empty: {args.corpus}")
+        raise SystemExit(1)
+
+    if args.write_golden:
+        golden = {}
+        for name, html in docs.items():
+            text, links = html_extract.extract_bs4(html)
+            golden[name] = {"text": text, "links": links}
+        with open(GOLDEN_PATH, "w", encoding="utf-8") as f:
+            json.dump(golden, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"[bench] wrote {GOLDEN_PATH} ({len(golden)} docs)")
+        return
+
+    golden = {}
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH, "r", encoding="utf-8") as f:
+            golden = json.load(f)
+    errors = check(docs, golden)
+    for e in errors:
+        print(f"[bench] MISMATCH {e}")
+    print(f"[bench] parity: {len(docs) - len(errors)}/{len(docs)} docs ok")
+
+    rates = bench(docs, args.seconds)
+    for engine, rate in rates.items():
+        print(f"[bench] {engine:>6}: {rate:,.0f} articles/s")
+    if rates.get("bs4"):
+        print(f"[bench] speedup stream/bs4: {rates['stream'] / rates['bs4']:.2f}x")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
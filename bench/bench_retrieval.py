@@ -0,0 +1,143 @@
+# bench_retrieval.py
+"""
+ベクトル検索バックエンド（Chroma / 行列）の QPS・レイテンシ・再現率の計測。
+
+  python bench/bench_retrieval.py                         # 合成ベクトル 20k 件、dim=384
+  python bench/bench_retrieval.py --rows 200000 --dim 768
+  python bench/bench_retrieval.py --batch 16              # query_many でまとめて投げたときの QPS も計測
+
+再現率は float32 の総当たり（Chroma と同じ二乗 l2）の上位 k 件に対する recall@k。
+chromadb が入っていれば同じベクトルを一時ディレクトリの PersistentClient に入れて比較する。
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from retrieval_backend import ChromaBackend, MatrixBackend, RetrievalBackend  # noqa: E402
+from vector_snapshot import write_snapshot  # noqa: E402
+
+COLLECTION = "bench"
+
+
+def synthetic(rows: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """クラスタ構造のある埋め込みもどき（一様乱数だと近似索引が不利すぎる）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    assign = rng.integers(0, clusters, size=rows)
+    return (centers[assign] + 0.6 * rng.normal(size=(rows, dim))).astype(np.float32)
+
+
+def exact_top(mat: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    norms = (mat * mat).sum(axis=1)
+    out = []
+    for q in queries:
+        d = norms - 2.0 * (mat @ q)
+        out.append(set(np.argpartition(d, k - 1)[:k].tolist()))
+    return out
+
+
+def pct(xs: List[float], p: float) -> float:
+    return float(np.percentile(np.asarray(xs), p)) if xs else 0.0
+
+
+def run(name: str, backend: RetrievalBackend, queries: np.ndarray, truth: List[set], k: int,
+        batch: int) -> Dict[str, float]:
+    backend.query(queries[0], k)  # 初回の memmap 読み込み・索引ロードを除く
+    lat: List[float] = []
+    hits = 0
+    t0 = time.perf_counter()
+    for q, want in zip(queries, truth):
+        t = time.perf_counter()
+        ids, _, _, _ = backend.query(q, k)
+        lat.append((time.perf_counter() - t) * 1000)
+        hits += len(want & {int(i) for i in ids})
+    qps = len(queries) / (time.perf_counter() - t0)
+
+    batch_qps = 0.0
+    if batch > 1:
+        t0 = time.perf_counter()
+        for i in range(0, len(queries), batch):
+            backend.query_many(queries[i:i + batch], k)
+        batch_qps = len(queries) / (time.perf_counter() - t0)
+
+    row = {"qps": qps, "p50_ms": pct(lat, 50), "p99_ms": pct(lat, 99),
+           "recall": hits / (k * len(queries)), "batch_qps": batch_qps}
+    print(f"  {name:<14} qps={qps:8.1f}  p50={row['p50_ms']:7.2f}ms  p99={row['p99_ms']:7.2f}ms  "
+          f"recall@{k}={row['recall']:.3f}" + (f"  batch{batch} qps={batch_qps:8.1f}" if batch > 1 else ""))
+    return row
+
+
+def chroma_backend(tmp: str, ids: List[str], mat: np.ndarray, docs: List[str]):
+    try:
+        import chromadb
+    except ImportError:
+        print("  chroma         skipped (chromadb not installed)")
+        return None
+    client = chromadb.PersistentClient(path=os.path.join(tmp, "chroma"))
+    col = client.get_or_create_collection(COLLECTION)
+    step = 5000
+    for i in range(0, len(ids), step):
+        col.add(ids=ids[i:i + step], embeddings=mat[i:i + step].tolist(), documents=docs[i:i + step],
+                metadatas=[{"filename": d} for d in ids[i:i + step]])
+    return ChromaBackend(lambda: col)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=20000)
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--k", type=int, default=20)
+    ap.add_argument("--batch", type=int, default=16)
+    ap.add_argument("--clusters", type=int, default=200)
+    ap.add_argument("--nprobe", type=int, default=16)
+    ap.add_argument("--ef", type=int, default=128)
+    args = ap.parse_args()
+
+    mat = synthetic(args.rows, args.dim, args.clusters)
+    queries = synthetic(args.queries, args.dim, args.clusters, seed=1)
+    ids = [str(i) for i in range(args.rows)]
+    docs = [f"doc {i}" for i in range(args.rows)]
+    metas = [{"filename": d} for d in ids]
+    truth = exact_top(mat, queries, args.k)
+    print(f"rows={args.rows} dim={args.dim} queries={args.queries} k={args.k}")
+
+    variants = [
+        ("float32", dict(unit_dtype="float32", ann="none")),
+        ("float16", dict(unit_dtype="float16", ann="none")),
+        ("int8", dict(unit_dtype="int8", ann="none")),
+        ("ivf", dict(unit_dtype="float32", ann="ivf", ann_min_rows=0)),
+        ("hnsw", dict(unit_dtype="float32", ann="hnsw", ann_min_rows=0)),
+    ]
+    tmp = tempfile.mkdtemp(prefix="bench_retrieval_")
+    try:
+        chroma = chroma_backend(tmp, ids, mat, docs)
+        if chroma is not None:
+            run("chroma", chroma, queries, truth, args.k, args.batch)
+        for name, opts in variants:
+            d = os.path.join(tmp, name)
+            os.makedirs(d)
+            t = time.perf_counter()
+            write_snapshot(d, COLLECTION, ids, mat, docs, metas, model="bench", **opts)
+            backend = MatrixBackend(d, COLLECTION, nprobe=args.nprobe, ef=args.ef)
+            backend.reload()
+            if opts["ann"] not in ("none", backend.stats().get("ann")):
+                print(f"  {name:<14} skipped (hnswlib not installed)")
+                continue
+            print(f"  ({name}: snapshot written in {time.perf_counter() - t:.1f}s)")
+            run(f"matrix/{name}", backend, queries, truth, args.k, args.batch)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+# loadtest
+"""
+/query の負荷試験一式（OpenAI には繋がない。CI でも回せる）。
+
+  python -m bench.loadtest                                   # 既定: 300 記事、同時 16、30 秒
+  python -m bench.loadtest --articles 1000 --concurrency 32 --duration 60 --out results/base.json
+  python -m bench.loadtest --env RERANK=1 --env RETRIEVAL_BACKEND=matrix --baseline results/base.json
+  python -m bench.loadtest --llm-latency-ms 800 --tokens-per-sec 50 --stream 0.5
+
+1. corpus.py で合成の日本語記事（fetch_notes.py と同じ .txt + .json）を一時ディレクトリに作る
+2. embed_articles.py でその一時ディレクトリの Chroma に取り込む（所要時間も記録）
+3. openai_stub.py（OpenAI 互換の chat.completions。初回トークンまでの遅延と生成速度を指定できる）を起動
+4. main:app を uvicorn（--server gunicorn なら gunicorn.conf.py）で起動し、/health/ready を待つ
+5. loadgen.py で同時 N 本のクライアントから /query（--stream の割合で /query/stream）を投げ続ける
+6. 試験前後の /metrics の差分から処理段ごとの p50/p95/p99、クライアント側の QPS・レイテンシ、
+   サーバプロセス（子プロセス込み）の RSS をまとめて JSON に書く
+
+性能に関わる変更は、変更前後でこれを同じ引数で回し、--baseline で比べてから入れる。
+"""
@@ -0,0 +1,300 @@
+# __main__.py
+"""
+負荷試験の実行（手順は __init__.py）。結果は --out の JSON（既定 ./loadtest_<日時>.json）。
+
+  python -m bench.loadtest --help
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import datetime as dt
+import subprocess
+import threading
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from . import corpus, loadgen, openai_stub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+APP_DIR = os.path.join(ROOT, "app")
+COLLECTION = "bench_articles"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def tree_rss_mb(pid: int) -> float:
+    """pid とその子孫プロセス（uvicorn --workers / gunicorn のワーカー）の RSS 合計。/proc が無ければ 0"""
+    total = 0.0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) / 1024
+                        break
+            for tid in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{tid}/children", "r") as f:
+                    stack.extend(int(c) for c in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class RssSampler:
+    """負荷中のピーク RSS を測るため、別スレッドで定期的に読む"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, tree_rss_mb(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def parse_env(pairs: List[str]) -> Dict[str, str]:
+    out = {}
+    for p in pairs:
+        k, sep, v = p.partition("=")
+        if not sep:
+            raise SystemExit(f"--env は KEY=VALUE で指定してください: {p}")
+        out[k] = v
+    return out
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def ingest(env: Dict[str, str], log_path: str) -> float:
+    t = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.run([sys.executable, "embed_articles.py"], cwd=APP_DIR, env=env, stdout=log,
+                              stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        raise SystemExit(f"embed_articles.py が失敗しました（{log_path} を確認してください）")
+    return time.perf_counter() - t
+
+
+def start_server(args, env: Dict[str, str], port: int, log_path: str) -> subprocess.Popen:
+    if args.server == "gunicorn":
+        env = {**env, "GUNICORN_BIND": f"127.0.0.1:{port}", "WEB_CONCURRENCY": str(args.workers)}
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(args.workers), "--no-access-log"]
+    log = open(log_path, "w", encoding="utf-8")
+    # 新しいプロセスグループにして、終了時にワーカーごとまとめて止める
+    return subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+def stop_server(proc: subprocess.Popen) -> None:
+    if proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def wait_ready(base_url: str, proc: subprocess.Popen, timeout: float, log_path: str) -> float:
+    t = time.perf_counter()
+    while time.perf_counter() - t < timeout:
+        if proc.poll() is not None:
+            raise SystemExit(f"main:app が終了しました（{log_path} を確認してください）")
+        try:
+            if httpx.get(base_url + "/health/ready", timeout=2).status_code == 200:
+                return time.perf_counter() - t
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"main:app が {timeout:.0f} 秒で ready になりませんでした（{log_path} を確認してください）")
+
+
+def compare(base: Dict[str, Any], cur: Dict[str, Any]) -> List[str]:
+    """--baseline と比べた主な指標の表"""
+    def pct(a, b):
+        return f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+
+    rows = [("qps", base["load"]["qps"], cur["load"]["qps"])]
+    for q in ("p50", "p95", "p99"):
+        rows.append((f"latency {q} ms", base["load"]["latency_ms"].get(q), cur["load"]["latency_ms"].get(q)))
+    for stage, row in cur["stages"].items():
+        old = base["stages"].get(stage, {}).get("p99_ms")
+        rows.append((f"{stage} p99 ms", old, row.get("p99_ms")))
+    rows.append(("rss peak MB", base["memory"]["rss_peak_mb"], cur["memory"]["rss_peak_mb"]))
+    out = [f"  {'':<22}{'baseline':>12}{'current':>12}{'change':>10}"]
+    for name, a, b in rows:
+        if a is None or b is None:
+            continue
+        out.append(f"  {name:<22}{a:>12.2f}{b:>12.2f}{pct(a, b):>10}")
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(prog="python -m bench.loadtest", description=sys.modules[__package__].__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    g = ap.add_argument_group("コーパス")
+    g.add_argument("--articles", type=int, default=300)
+    g.add_argument("--paragraphs", type=int, default=6)
+    g.add_argument("--seed", type=int, default=0)
+    g.add_argument("--workdir", help="記事と Chroma を置くディレクトリ（既定は一時ディレクトリで、終了時に消す）")
+    g.add_argument("--skip-ingest", action="store_true", help="--workdir の取り込み済みインデックスをそのまま使う")
+    g = ap.add_argument_group("OpenAI スタブ")
+    g.add_argument("--llm-latency-ms", type=float, default=500.0, help="最初のトークンまでの待ち")
+    g.add_argument("--tokens-per-sec", type=float, default=80.0)
+    g.add_argument("--answer-tokens", type=int, default=300)
+    g.add_argument("--llm-error-rate", type=float, default=0.0)
+    g = ap.add_argument_group("サーバ")
+    g.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn")
+    g.add_argument("--workers", type=int, default=1, help="2 以上だと /metrics は応答した 1 ワーカー分の値になる")
+    g.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                   help="main:app と embed_articles.py に渡す環境変数（比べたい設定。複数可）")
+    g.add_argument("--ready-timeout", type=float, default=600.0)
+    g = ap.add_argument_group("負荷")
+    g.add_argument("--concurrency", type=int, default=16)
+    g.add_argument("--duration", type=float, default=30.0, help="秒（--requests を指定したら 0 で件数優先）")
+    g.add_argument("--requests", type=int, default=0)
+    g.add_argument("--rate", type=float, default=0.0, help="全体の QPS 上限（0 で無制限）")
+    g.add_argument("--stream", type=float, default=0.0, help="/query/stream を使う割合（0〜1）")
+    g.add_argument("--questions", type=int, default=2000, help="質問の種類（少ないほど回答キャッシュに当たる）")
+    g.add_argument("--warmup", type=int, default=8, help="計測前に投げる件数")
+    ap.add_argument("--out", help="結果の JSON（既定 ./loadtest_<日時>.json）")
+    ap.add_argument("--baseline", help="比べる過去の結果 JSON")
+    args = ap.parse_args()
+
+    out_path = args.out or f"loadtest_{dt.datetime.now():%Y%m%d-%H%M%S}.json"
+    extra_env = parse_env(args.env)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag_loadtest_")
+    os.makedirs(workdir, exist_ok=True)
+    articles_dir = os.path.join(workdir, "articles")
+    persist_dir = os.path.join(workdir, "chroma_db")
+
+    stub = openai_stub.serve(args.llm_latency_ms, args.tokens_per_sec, args.answer_tokens, args.llm_error_rate,
+                             port=0, seed=args.seed)
+    env = {
+        **os.environ,
+        "ARTICLES_DIR": articles_dir,
+        "CHROMA_PERSIST_DIR": persist_dir,
+        "CHROMA_COLLECTION": COLLECTION,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{stub.server_port}/v1",
+        "OPENAI_API_KEY": "stub",
+        "LOG_LEVEL": "WARNING",
+        "WARMUP_ON_STARTUP": "1",
+        "INGEST_ON_STARTUP": "0",
+        "MAX_INFLIGHT": str(max(64, args.concurrency * 2)),
+        **extra_env,
+    }
+    result: Dict[str, Any] = {
+        "created_at": dt.datetime.now().isoformat(timespec="seconds"),
+        "git": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "env")},
+        "env": extra_env,
+    }
+    proc: Optional[subprocess.Popen] = None
+    try:
+        ingest_secs = None
+        if not args.skip_ingest:
+            titles = corpus.write_corpus(articles_dir, args.articles, args.paragraphs, args.seed)
+            print(f"[loadtest] corpus: {len(titles)} articles -> {articles_dir}")
+            ingest_secs = ingest(env, os.path.join(workdir, "ingest.log"))
+            print(f"[loadtest] ingest: {ingest_secs:.1f}s")
+        result["ingest"] = {"secs": round(ingest_secs, 3) if ingest_secs is not None else None}
+
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server_log = os.path.join(workdir, "server.log")
+        t = time.perf_counter()
+        proc = start_server(args, env, port, server_log)
+        ready_secs = wait_ready(base_url, proc, args.ready_timeout, server_log)
+        print(f"[loadtest] {args.server} ready in {ready_secs:.1f}s (workers={args.workers})")
+        result["startup"] = {"ready_secs": round(time.perf_counter() - t, 3), "rss_mb": round(tree_rss_mb(proc.pid), 1)}
+
+        questions = corpus.make_questions(args.questions, seed=args.seed + 1)
+        if args.warmup:
+            asyncio.run(loadgen.run_load(base_url, questions[-args.warmup:], concurrency=1, requests=args.warmup))
+        before = loadgen.fetch_metrics(base_url)
+        stub_before = dict(stub.state.requests)
+        print(f"[loadtest] load: concurrency={args.concurrency} duration={args.duration}s "
+              f"requests={args.requests or '-'} stream={args.stream}")
+        with RssSampler(proc.pid) as rss:
+            res = asyncio.run(loadgen.run_load(
+                base_url, questions, args.concurrency, duration=0.0 if args.requests else args.duration,
+                requests=args.requests, stream_ratio=args.stream, rate=args.rate, seed=args.seed,
+            ))
+        after = loadgen.fetch_metrics(base_url)
+        diff = loadgen.delta(before, after)
+
+        result["load"] = res.summary()
+        result["stages"] = loadgen.histogram_summary(diff, "rag_stage_seconds", "stage")
+        result["routes"] = loadgen.histogram_summary(diff, "rag_request_seconds", "route")
+        result["tokens"] = loadgen.counter_values(diff, "rag_llm_tokens_total", "kind")
+        result["server_errors"] = loadgen.counter_values(diff, "rag_errors_total", "stage")
+        result["answer_cache"] = loadgen.counter_values(diff, "rag_answer_cache_requests_total", "result")
+        result["memory"] = {"rss_peak_mb": round(max(rss.peak, tree_rss_mb(proc.pid)), 1),
+                            "rss_end_mb": round(tree_rss_mb(proc.pid), 1)}
+        result["stub"] = {k: v - stub_before.get(k, 0) for k, v in stub.state.requests.items()}
+        result["stub"]["max_active"] = stub.state.max_active
+        result["metrics_scope"] = "process" if args.workers == 1 else "one worker (scraped)"
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        stub.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    load = result["load"]
+    lat = load["latency_ms"]
+    print(f"[loadtest] {load['ok']}/{load['requests']} ok in {load['secs']:.1f}s  qps={load['qps']:.2f}  "
+          f"p50={lat.get('p50', 0):.0f}ms p95={lat.get('p95', 0):.0f}ms p99={lat.get('p99', 0):.0f}ms  "
+          f"rss peak={result['memory']['rss_peak_mb']:.0f}MB")
+    for stage, row in result["stages"].items():
+        print(f"  {stage:<16} n={row['count']:<6} p50={row['p50_ms'] or 0:8.1f}ms p95={row['p95_ms'] or 0:8.1f}ms "
+              f"p99={row['p99_ms'] or 0:8.1f}ms")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            print(f"[loadtest] vs {args.baseline}")
+            print("\n".join(compare(json.load(f), result)))
+    print(f"[loadtest] result -> {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# corpus.py
+"""
+合成の日本語記事。fetch_notes.py と同じ形（<name>.txt と サイドカーの <name>.json）で書き出す。
+seed が同じなら同じ記事・同じ質問になるので、実行どうしを比べられる。
+
+  python -m bench.loadtest.corpus --out /tmp/articles --articles 300
+"""
+import os
+import json
+import random
+import argparse
+import datetime as dt
+from typing import Dict, List
+
+PLACES = ["鎌倉", "箱根", "小樽", "金沢", "那覇", "松本", "函館", "尾道", "高山", "別府", "倉敷", "長崎",
+          "仙台", "札幌", "京都", "奈良", "伊勢", "熊本", "松山", "高知"]
+ACTIVITIES = ["朝の散歩", "古い町並みの散策", "温泉めぐり", "美術館巡り", "食べ歩き", "サイクリング",
+              "山歩き", "カフェ巡り", "写真撮影", "市場の見学", "夜景の鑑賞", "寺社の参拝"]
+FOODS = ["海鮮丼", "そば", "ラーメン", "和菓子", "地ビール", "おでん", "カレー", "焼き魚", "甘味", "寿司"]
+SEASONS = ["春", "初夏", "梅雨", "真夏", "秋", "晩秋", "冬", "年末"]
+FEELINGS = ["思ったより混んでいなかった", "少し肌寒かった", "歩き疲れたが満足した", "また来たいと思った",
+            "地元の人に道を教えてもらった", "予定より長居してしまった", "雨に降られて予定を変えた"]
+TIPS = ["歩きやすい靴が必須", "午前中に回るのがおすすめ", "現金しか使えない店が多い", "予約しておくと安心",
+        "駅からはバスが便利", "夕方は道が混む", "日差し対策を忘れずに"]
+
+QUESTION_TEMPLATES = [
+    "{place}で{activity}をしたときの感想を教えて",
+    "{place}で食べた{food}はどうだった？",
+    "{season}の{place}に行くときの注意点は？",
+    "{place}のおすすめの回り方は？",
+    "{activity}で気をつけることは？",
+    "{food}がおいしかった場所はどこ？",
+]
+
+
+def _sentence(rng: random.Random, place: str) -> str:
+    kind = rng.randrange(5)
+    if kind == 0:
+        return f"{rng.choice(SEASONS)}の{place}で{rng.choice(ACTIVITIES)}をした。{rng.choice(FEELINGS)}。"
+    if kind == 1:
+        return f"昼は{place}駅の近くで{rng.choice(FOODS)}を食べた。{rng.choice(FEELINGS)}。"
+    if kind == 2:
+        return f"{place}の{rng.choice(ACTIVITIES)}は{rng.choice(TIPS)}。"
+    if kind == 3:
+        return f"次は{rng.choice(PLACES)}にも足を延ばして{rng.choice(ACTIVITIES)}をしてみたい。"
+    return f"{place}では{rng.choice(ACTIVITIES)}の途中で{rng.choice(FOODS)}の店を見つけた。{rng.choice(TIPS)}。"
+
+
+def make_article(i: int, rng: random.Random, paragraphs: int, base_time: dt.datetime) -> Dict:
+    place = PLACES[i % len(PLACES)]
+    title = f"{place}{rng.choice(ACTIVITIES)}の記録 {i}"
+    body = "\n\n".join(
+        "".join(_sentence(rng, place) for _ in range(rng.randint(3, 7))) for _ in range(paragraphs)
+    )
+    published = base_time - dt.timedelta(days=i * 3 + rng.randrange(3), hours=rng.randrange(12))
+    key = f"n{i:06x}"
+    return {
+        "name": f"{i:05d}_{key}",
+        "title": title,
+        "body": body,
+        "meta": {
+            "user_id": "bench",
+            "title": title,
+            "slug": f"bench-{i}",
+            "key": key,
+            "page": i // 6 + 1,
+            "source": {"canonical": f"https://note.com/bench/n/{key}"},
+            "timestamps": {
+                "published_at": published.isoformat(timespec="seconds") + "+09:00",
+                "updated_at": published.isoformat(timespec="seconds") + "+09:00",
+            },
+            "link_count": 0,
+            "length": len(body),
+        },
+    }
+
+
+def write_corpus(out_dir: str, n: int, paragraphs: int = 6, seed: int = 0) -> List[str]:
+    """n 記事を out_dir に書き、タイトルの一覧を返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    base_time = dt.datetime(2024, 6, 1, 9, 0, 0)
+    titles = []
+    for i in range(n):
+        a = make_article(i, rng, paragraphs, base_time)
+        base = os.path.join(out_dir, a["name"])
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"タイトル: {a['title']}\n\n")
+            f.write(a["body"])
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(a["meta"], f, ensure_ascii=False, indent=2)
+        titles.append(a["title"])
+    return titles
+
+
+def make_questions(n: int, seed: int = 1) -> List[str]:
+    """負荷試験で投げる質問。n が小さいほど同じ質問が繰り返される（回答キャッシュに当たる）"""
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        out.append(rng.choice(QUESTION_TEMPLATES).format(
+            place=rng.choice(PLACES), activity=rng.choice(ACTIVITIES),
+            food=rng.choice(FOODS), season=rng.choice(SEASONS),
+        ))
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="合成の日本語記事を書き出す")
+    ap.add_argument("--out", required=True)
+    ap.add_argument("--articles", type=int, default=300)
+    ap.add_argument("--paragraphs", type=int, default=6)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    write_corpus(args.out, args.articles, args.paragraphs, args.seed)
+    print(f"[corpus] {args.articles} articles -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
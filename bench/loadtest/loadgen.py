@@ -0,0 +1,208 @@
+# loadgen.py
+"""
+負荷生成と /metrics の集計。
+
+- run_load: 同時 concurrency 本のクライアントが、前の応答を受け取ったらすぐ次を投げる（クローズドループ）。
+  rate を指定すると全体でその QPS を上限に間隔を空ける。stream の割合だけ /query/stream を使い、
+  最初の token イベントまでの時間（TTFT）も測る
+- parse_metrics / stage_summary: 試験前後の /metrics（Prometheus テキスト）の差分から、
+  ヒストグラムのバケットを線形補間して p50/p95/p99 を出す（Prometheus の histogram_quantile と同じ考え方）
+"""
+import re
+import time
+import random
+import asyncio
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+
+_SAMPLE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})?\s+(?P<value>\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+Series = Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]
+
+
+@dataclass
+class LoadResult:
+    secs: float = 0.0
+    latencies: List[float] = field(default_factory=list)   # 成功した応答の所要時間（秒）
+    ttft: List[float] = field(default_factory=list)        # /query/stream の最初の token まで
+    status: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+
+    def summary(self) -> Dict[str, Any]:
+        ok = len(self.latencies)
+        total = sum(self.status.values())
+        return {
+            "secs": round(self.secs, 3),
+            "requests": total,
+            "ok": ok,
+            "qps": round(ok / self.secs, 3) if self.secs else 0.0,
+            "error_rate": round(1 - ok / total, 4) if total else 0.0,
+            "latency_ms": percentiles(self.latencies),
+            "ttft_ms": percentiles(self.ttft),
+            "status": {str(k): v for k, v in sorted(self.status.items(), key=lambda kv: str(kv[0]))},
+            "errors": dict(self.errors),
+        }
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    a = np.asarray(values) * 1000
+    return {"mean": round(float(a.mean()), 2),
+            **{f"p{q}": round(float(np.percentile(a, q)), 2) for q in (50, 95, 99)},
+            "max": round(float(a.max()), 2)}
+
+
+async def _one(client: httpx.AsyncClient, question: str, stream: bool, res: LoadResult) -> None:
+    t = time.perf_counter()
+    try:
+        if not stream:
+            r = await client.post("/query", json={"question": question})
+            res.status[r.status_code] += 1
+            if r.status_code == 200:
+                res.latencies.append(time.perf_counter() - t)
+            return
+        async with client.stream("POST", "/query/stream", json={"question": question}) as r:
+            first = None
+            failed = r.status_code != 200
+            event = ""
+            async for line in r.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[7:]
+                    if event == "token" and first is None:
+                        first = time.perf_counter() - t
+                    elif event == "error":
+                        failed = True
+            res.status[r.status_code if not failed else "stream_error"] += 1
+            if not failed:
+                res.latencies.append(time.perf_counter() - t)
+                if first is not None:
+                    res.ttft.append(first)
+    except httpx.HTTPError as e:
+        res.status["exception"] += 1
+        res.errors[type(e).__name__] += 1
+
+
+async def run_load(base_url: str, questions: List[str], concurrency: int, duration: float = 0.0,
+                   requests: int = 0, stream_ratio: float = 0.0, rate: float = 0.0, seed: int = 0,
+                   timeout: float = 120.0) -> LoadResult:
+    """duration 秒（または requests 件）投げ続ける。両方 0 なら questions を 1 周"""
+    if not duration and not requests:
+        requests = len(questions)
+    rng = random.Random(seed)
+    res = LoadResult()
+    sent = 0
+    interval = 1.0 / rate if rate > 0 else 0.0
+    next_at = [time.perf_counter()]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        t0 = time.perf_counter()
+
+        async def worker() -> None:
+            nonlocal sent
+            while True:
+                if requests and sent >= requests:
+                    return
+                if duration and time.perf_counter() - t0 >= duration:
+                    return
+                i = sent
+                sent += 1
+                if interval:
+                    at = next_at[0]
+                    next_at[0] = max(at, time.perf_counter()) + interval
+                    await asyncio.sleep(max(0.0, at - time.perf_counter()))
+                await _one(client, questions[i % len(questions)], rng.random() < stream_ratio, res)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        res.secs = time.perf_counter() - t0
+    return res
+
+
+# ── /metrics ──────────────────────────────────────────────────────────────
+def parse_metrics(text: str) -> Series:
+    """{(名前, ((ラベル, 値), ...)): 値}"""
+    out: Series = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = _SAMPLE.match(line)
+        if not m:
+            continue
+        labels = tuple(sorted((k, v.replace('\\"', '"').replace("\\\\", "\\"))
+                              for k, v in _LABEL.findall(m.group("labels") or "")))
+        try:
+            out[(m.group("name"), labels)] = float(m.group("value").replace("+Inf", "inf"))
+        except ValueError:
+            continue
+    return out
+
+
+def fetch_metrics(base_url: str) -> Series:
+    r = httpx.get(base_url.rstrip("/") + "/metrics", timeout=10)
+    r.raise_for_status()
+    return parse_metrics(r.text)
+
+
+def delta(before: Series, after: Series) -> Series:
+    return {k: v - before.get(k, 0.0) for k, v in after.items()}
+
+
+def histogram_quantile(q: float, buckets: List[Tuple[float, float]]) -> Optional[float]:
+    """buckets は (上限, 累積数) を上限の昇順で。最後のバケット（+Inf）に入った分は 1 つ前の上限を返す"""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    prev_le, prev_n = 0.0, 0.0
+    for le, n in buckets:
+        if n >= rank:
+            if le == float("inf"):
+                return prev_le
+            if n == prev_n:
+                return le
+            return prev_le + (le - prev_le) * (rank - prev_n) / (n - prev_n)
+        prev_le, prev_n = le, n
+    return prev_le
+
+
+def histogram_summary(series: Series, name: str, by: str) -> Dict[str, Dict[str, float]]:
+    """ヒストグラム name をラベル by ごとに {count, mean_ms, p50_ms, p95_ms, p99_ms} にする"""
+    buckets: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+    sums: Dict[str, float] = defaultdict(float)
+    counts: Dict[str, float] = defaultdict(float)
+    for (metric, labels), v in series.items():
+        lab = dict(labels)
+        key = lab.get(by, "")
+        if metric == f"{name}_bucket":
+            buckets[key].append((float(lab["le"].replace("+Inf", "inf")), v))
+        elif metric == f"{name}_sum":
+            sums[key] += v
+        elif metric == f"{name}_count":
+            counts[key] += v
+    out: Dict[str, Dict[str, float]] = {}
+    for key in sorted(counts):
+        if counts[key] <= 0:
+            continue
+        # 同じ by の値で別ラベル（status など）の系列は、上限ごとに足し合わせる
+        merged: Dict[float, float] = defaultdict(float)
+        for le, n in buckets[key]:
+            merged[le] += n
+        bs = sorted(merged.items())
+        row = {"count": int(counts[key]), "mean_ms": round(sums[key] / counts[key] * 1000, 2)}
+        for q in (50, 95, 99):
+            v = histogram_quantile(q / 100, bs)
+            row[f"p{q}_ms"] = round(v * 1000, 2) if v is not None else None
+        out[key] = row
+    return out
+
+
+def counter_values(series: Series, name: str, by: str = "") -> Dict[str, float]:
+    out: Dict[str, float] = defaultdict(float)
+    for (metric, labels), v in series.items():
+        if metric == name:
+            out[dict(labels).get(by, "") if by else name] += v
+    return dict(out)
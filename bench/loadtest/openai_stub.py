@@ -0,0 +1,184 @@
+# openai_stub.py
+"""
+OpenAI 互換の chat.completions を返すローカル用スタブサーバ（負荷試験・CI 用。課金もネットワークも無し）。
+
+  python -m bench.loadtest.openai_stub --port 8766 --latency-ms 600 --tokens-per-sec 80
+  OPENAI_BASE_URL=http://127.0.0.1:8766/v1 OPENAI_API_KEY=stub uvicorn main:app
+
+- 応答は main.py の ANSWER_SCHEMA どおりの JSON 文字列（answer / suggestions）
+- latency-ms: 最初のトークンまでの待ち。tokens-per-sec: その後の生成速度（stream でなければ全部待ってから返す）
+- stream=true なら SSE で差分を返し、stream_options.include_usage があれば最後に usage だけのチャンクを送る
+- トークン数は tiktoken を使わず概算（日本語はおおよそ 1 文字 1 トークン）
+- error-rate: その割合で 500 を返す（エラー時の挙動・rag_errors_total の確認用）
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, List
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+def approx_tokens(text: str) -> int:
+    """ASCII は 4 文字、それ以外は 1 文字を 1 トークンと数える"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+
+
+def make_answer(messages: List[Dict[str, Any]], answer_tokens: int) -> str:
+    question = ""
+    for m in messages:
+        if m.get("role") == "user":
+            first = str(m.get("content") or "").splitlines()[:1]
+            question = first[0].replace("質問:", "").strip() if first else ""
+    filler = "記事によると、現地では歩きやすい靴で午前中に回るのがよいようです。"
+    body = f"「{question}」について。" + filler * max(1, answer_tokens // len(filler))
+    return json.dumps({"answer": body[:max(answer_tokens, 1)],
+                       "suggestions": ["アクセスの詳細", "季節ごとの違い", "費用の目安"]}, ensure_ascii=False)
+
+
+def split_tokens(text: str, size: int = 2) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StubState:
+    def __init__(self, latency: float, tokens_per_sec: float, answer_tokens: int, error_rate: float, seed: int):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {"ok": 0, "stream": 0, "error": 0}
+        self.active = 0
+        self.max_active = 0
+
+    def count(self, kind: str) -> None:
+        with self.lock:
+            self.requests[kind] += 1
+
+    def fail(self) -> bool:
+        with self.lock:
+            return self.error_rate > 0 and self.rng.random() < self.error_rate
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # httpx のコネクションプールを本物と同じく keep-alive で使わせる
+
+        def log_message(self, *args):  # 静かに
+            pass
+
+        def _json(self, status: int, payload: Any) -> None:
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path.rstrip("/") != CHAT_PATH:
+                return self._json(404, {"error": {"message": "unknown path"}})
+            with state.lock:
+                state.active += 1
+                state.max_active = max(state.max_active, state.active)
+            try:
+                self._complete(json.loads(body or b"{}"))
+            finally:
+                with state.lock:
+                    state.active -= 1
+
+        def _complete(self, req: Dict[str, Any]) -> None:
+            if state.latency > 0:
+                time.sleep(state.latency)
+            if state.fail():
+                state.count("error")
+                return self._json(500, {"error": {"message": "stub error", "type": "server_error"}})
+
+            messages = req.get("messages") or []
+            limit = int(req.get("max_tokens") or state.answer_tokens)
+            content = make_answer(messages, min(state.answer_tokens, limit))
+            prompt_tokens = sum(approx_tokens(str(m.get("content") or "")) for m in messages)
+            pieces = split_tokens(content)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces),
+                     "total_tokens": prompt_tokens + len(pieces)}
+            base = {"id": f"chatcmpl-stub-{time.time_ns()}", "created": int(time.time()),
+                    "model": req.get("model", "stub")}
+            per_token = 1.0 / state.tokens_per_sec if state.tokens_per_sec > 0 else 0.0
+
+            if not req.get("stream"):
+                state.count("ok")
+                time.sleep(per_token * len(pieces))
+                return self._json(200, {**base, "object": "chat.completion", "usage": usage, "choices": [
+                    {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}},
+                ]})
+
+            state.count("stream")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def event(choices: List[Dict[str, Any]], **extra: Any) -> None:
+                payload = {**base, "object": "chat.completion.chunk", "choices": choices, **extra}
+                self._chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+            event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            t0 = time.perf_counter()
+            for i, piece in enumerate(pieces):
+                # 生成速度どおりに送る（sleep の誤差が溜まらないよう開始からの経過時間で合わせる）
+                wait = t0 + i * per_token - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+            event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (req.get("stream_options") or {}).get("include_usage"):
+                event([], usage=usage)
+            self._chunk(b"data: [DONE]\n\n")
+            self._chunk(b"")
+
+    return Handler
+
+
+def serve(latency_ms: float = 500.0, tokens_per_sec: float = 80.0, answer_tokens: int = 300,
+          error_rate: float = 0.0, host: str = "127.0.0.1", port: int = 8766, seed: int = 0) -> ThreadingHTTPServer:
+    """バックグラウンドスレッドで起動したサーバを返す（server.shutdown() で停止）。port=0 なら空きポート"""
+    state = StubState(latency_ms / 1000.0, tokens_per_sec, answer_tokens, error_rate, seed)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, name="openai-stub", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="OpenAI chat.completions stub server")
+    ap.add_argument("--latency-ms", type=float, default=500.0, help="最初のトークンまでの待ち")
+    ap.add_argument("--tokens-per-sec", type=float, default=80.0, help="生成速度（0 で待たない）")
+    ap.add_argument("--answer-tokens", type=int, default=300)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8766)
+    args = ap.parse_args()
+    server = serve(args.latency_ms, args.tokens_per_sec, args.answer_tokens, args.error_rate, args.host, args.port)
+    print(f"[openai-stub] listening on http://{args.host}:{server.server_port}/v1 "
+          f"(latency={args.latency_ms}ms, {args.tokens_per_sec} tokens/s)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"[openai-stub] requests={server.state.requests} max_active={server.state.max_active}")
+
+
+if __name__ == "__main__":
+    main()
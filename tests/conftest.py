@@ -0,0 +1,10 @@
+# conftest.py
+# app/ のモジュールはフラットに import する前提（main.py と同じ）。bench/ のヘルパーも使う
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for sub in ("app", "bench"):
+    path = os.path.join(ROOT, sub)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,57 @@
+# test_embed_parity.py
+"""
+ONNX（fp32 / int8）と PyTorch の埋め込みの一致確認。
+bench/bench_embed_backends.py --check と同じ閾値・同じ指標（コサインの平均・最小、overlap@k）を、
+bench/html_corpus のサンプルコーパスで見る。optimum が無ければ skip。
+"""
+import os
+import platform
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("optimum.onnxruntime")
+
+from bench_embed_backends import THRESHOLDS, load_texts, parity_arrays  # noqa: E402
+from embedder import load_embedder  # noqa: E402
+
+MODEL = os.environ.get("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+K = 10
+INT8_CONFIG = "arm64" if platform.machine().lower() in ("arm64", "aarch64") else "avx2"
+
+
+def _encode(model, texts):
+    return np.asarray(model.encode(texts, batch_size=32, normalize_embeddings=True, show_progress_bar=False),
+                      dtype=np.float32)
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    # 存在しない記事ディレクトリを渡すと bench/html_corpus を本文にしたものになる
+    texts = load_texts("/nonexistent-articles", 200)
+    queries = [t[:40] for t in random.Random(1).sample(texts, 40)]
+    return texts, queries
+
+
+@pytest.fixture(scope="module")
+def torch_vectors(corpus):
+    texts, queries = corpus
+    try:
+        model = load_embedder(MODEL, "torch")
+    except OSError as e:  # オフラインでモデルを取得できない
+        pytest.skip(f"モデルを読み込めません: {e}")
+    return _encode(model, texts), _encode(model, queries)
+
+
+@pytest.mark.parametrize("quantize", ["", INT8_CONFIG], ids=["fp32", "int8"])
+def test_onnx_matches_torch(quantize, corpus, torch_vectors, tmp_path_factory):
+    texts, queries = corpus
+    model = load_embedder(MODEL, "onnx", quantize, str(tmp_path_factory.mktemp("onnx")))
+    res = parity_arrays(*torch_vectors, _encode(model, texts), _encode(model, queries), k=K)
+
+    mean_min, cos_min, overlap_min = THRESHOLDS["int8" if quantize else "fp32"]
+    assert res["cos_mean"] >= mean_min, res
+    assert res["cos_min"] >= cos_min, res
+    assert res[f"overlap@{K}"] >= overlap_min, res
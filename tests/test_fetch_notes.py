@@ -0,0 +1,94 @@
+# test_fetch_notes.py
+"""
+fetch_notes.main() を note_api_stub.py のスタブサーバに向けて通しで動かす。
+詳細取得の同時実行数が FETCH_CONCURRENCY を超えないこと、トークンバケットで
+リクエストの間隔が FETCH_RATE / FETCH_BURST どおりに空くこと、503 を再試行して取り切れることを見る。
+"""
+import json
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("requests")
+
+# import 時に ARTICLES_DIR を作るので、リポジトリの articles/ ではなく一時ディレクトリに向けておく
+os.environ.setdefault("ARTICLES_DIR", tempfile.mkdtemp(prefix="fetch-notes-test-"))
+import fetch_notes  # noqa: E402
+import note_api_stub  # noqa: E402
+
+
+@pytest.fixture
+def run_fetch(tmp_path, monkeypatch):
+    """スタブを起動し、fetch_notes の設定をそこへ向けて main() を 1 回走らせる"""
+    servers = []
+
+    def run(notes=12, per_page=6, latency_ms=0.0, fail_first=0, concurrency=4, rate=0.0, burst=4):
+        server = note_api_stub.serve(notes, per_page, latency_ms, port=0, fail_first=fail_first)
+        servers.append(server)
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        save_dir = tmp_path / "articles"
+        save_dir.mkdir(exist_ok=True)
+        for name, value in {
+            "BASE_LIST": f"{base}/api/v2/creators/stub/contents?kind=note&page={{page}}",
+            "DETAIL_URL": f"{base}/api/v3/notes/{{key}}",
+            "SAVE_DIR": str(save_dir),
+            "FETCH_STATE_PATH": str(save_dir / ".fetch_state.json"),
+            "FETCH_CONCURRENCY": concurrency,
+            "FETCH_RATE": rate,
+            "FETCH_BURST": burst,
+            "MAX_PAGES": None,
+            "SKIP_EXISTING": True,
+            "STOP_AT_LAST_SYNC": False,
+        }.items():
+            monkeypatch.setattr(fetch_notes, name, value)
+        fetch_notes.main()
+        return server.state, save_dir
+
+    yield run
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _saved(save_dir):
+    return sorted(p.name for p in save_dir.glob("*.txt"))
+
+
+def test_details_overlap_up_to_concurrency(run_fetch):
+    state, save_dir = run_fetch(notes=24, latency_ms=100, concurrency=4)
+    assert len(_saved(save_dir)) == 24
+    assert state.requests == {"list": 4, "detail": 24}
+    # 1 件ずつではなく重ねて取りに行き、それでも上限は超えない
+    assert 2 <= state.max_inflight <= 4
+
+
+def test_token_bucket_paces_requests(run_fetch):
+    rate, burst = 20.0, 2
+    state, save_dir = run_fetch(notes=12, rate=rate, burst=burst)
+    assert len(_saved(save_dir)) == 12
+    arrivals = sorted(state.arrivals)
+    assert len(arrivals) == 2 + 12
+    # 最初の burst 件は即座に、以降は 1/rate 秒ごとにしかトークンが補充されない
+    for i, t in enumerate(arrivals):
+        assert t - arrivals[0] >= (i + 1 - burst) / rate - 0.02
+
+
+def test_retries_transient_errors(run_fetch):
+    state, save_dir = run_fetch(notes=12, fail_first=1)
+    assert len(_saved(save_dir)) == 12
+    assert state.requests["detail"] == 12 * 2
+    assert all(n == 1 for n in state.failed.values()) and len(state.failed) == 12
+    # 取り切れたので失敗は残らず、同期時刻が進む
+    with open(save_dir / ".fetch_state.json", encoding="utf-8") as f:
+        saved_state = json.load(f)
+    assert saved_state["last_sync"]
+    assert len(saved_state["notes"]) == 12
+
+
+def test_second_run_skips_unchanged(run_fetch):
+    run_fetch(notes=12)
+    state, save_dir = run_fetch(notes=12)
+    # 一覧の updated_at が前回と同じなので詳細は取りに行かない
+    assert state.requests == {"list": 2, "detail": 0}
+    assert len(_saved(save_dir)) == 12